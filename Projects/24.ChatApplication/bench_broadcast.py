@@ -0,0 +1,73 @@
+# bench_broadcast.py
+# Micro-benchmark for ChatServer.broadcast(): how much memory does fanning out ONE message
+# allocate as the room grows? No sockets are involved, only the encode + enqueue path.
+import argparse
+import time
+import tracemalloc
+
+from chat_outbound import OutboundQueue
+from chat_server import ChatServer, ClientConnection
+
+MESSAGE = "[12:00:00] alice: " + "hello everyone! " * 12
+
+def make_server(room_size):
+    server = ChatServer('127.0.0.1', 0)
+    for i in range(room_size):
+        client = object() # Stands in for a client socket, only used as a dictionary key
+        server.clients.add(client)
+        server.usernames[client] = f"user{i}"
+        server.connections[client] = ClientConnection(('127.0.0.1', i), OutboundQueue(max_bytes=1 << 30), framed=True)
+    return server
+
+def broadcast_per_recipient_encode(server, message):
+    # What broadcast() used to do: encode the text again for every recipient
+    for client in server.clients:
+        payload = message.encode('utf-8')
+        server.connections[client].queue.put((payload,), len(payload))
+
+def measure(server, broadcast):
+    for connection in server.connections.values():
+        connection.queue.take_all()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    broadcast(MESSAGE)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    # Split the allocations into message bytes (encoding) and queue bookkeeping (one pointer per recipient)
+    encoding = queueing = 0
+    for stat in after.compare_to(before, 'filename'):
+        filename = stat.traceback[0].filename
+        if filename.endswith(('chat_protocol.py', 'bench_broadcast.py')):
+            encoding += stat.size_diff
+        elif filename.endswith('chat_outbound.py'):
+            queueing += stat.size_diff
+    return encoding, queueing
+
+def time_broadcasts(server, broadcast, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        broadcast(MESSAGE)
+        for connection in server.connections.values():
+            connection.queue.take_all()
+    return (time.perf_counter() - start) / repeat
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure allocations per broadcast as the room grows")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000], help="Room sizes to test")
+    parser.add_argument('--repeat', type=int, default=20, help="Broadcasts per timing run")
+    args = parser.parse_args()
+
+    print(f"Message: {len(MESSAGE.encode('utf-8'))} bytes")
+    print(f"{'variant':<22}{'recipients':>11}{'encode bytes':>14}{'queue bytes':>13}{'bytes/recipient':>17}{'us/broadcast':>14}")
+    for room_size in args.sizes:
+        server = make_server(room_size)
+        variants = (
+            ('encode per recipient', lambda message: broadcast_per_recipient_encode(server, message)),
+            ('encode once', server.broadcast),
+        )
+        for name, broadcast in variants:
+            encoding, queueing = measure(server, broadcast)
+            seconds = time_broadcasts(server, broadcast, args.repeat)
+            per_recipient = (encoding + queueing) / room_size
+            print(f"{name:<22}{room_size:>11}{encoding:>14}{queueing:>13}{per_recipient:>17.1f}{seconds * 1e6:>14.0f}")
@@ -0,0 +1,150 @@
+# chat_attachments.py
+# File attachments streamed over the chat connection. Files travel as chunk frames, and chat
+# messages can be sent between any two chunks, so a large file never holds up the conversation.
+#
+#   client -> server: "/upload <upload id> <size> <name>", then chunk frames until <size> bytes arrived
+#   server -> room:   "📎 alice shared name (size). Type /download <id> to get it."
+#   client -> server: "/download <id>"
+#   server -> client: "/attachment <id> <size> <name>", then chunk frames, then an empty chunk
+#
+# A chunk frame's payload is a zero byte, the 4-byte upload or attachment id, and the data.
+# No text message starts with a zero byte, and neither does a binary record or a sequenced
+# frame, so chunks can't be mistaken for anything else.
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import uuid
+
+CHUNK_HEADER = struct.Struct('!BI') # Zero marker byte, upload or attachment id
+CHUNK_MARKER = b'\x00'
+CHUNK_SIZE = 64 * 1024              # Data bytes per chunk frame
+MAX_ATTACHMENT_SIZE = 64 * 1024 * 1024
+MAX_STORAGE = 1024 * 1024 * 1024    # All attachments together, uploads in progress included
+MAX_UPLOADS = 4                     # Uploads in progress at once per client
+DOWNLOAD_WINDOW = 128 * 1024        # Chunk bytes queued per client ahead of the socket
+UPLOAD = '/upload'
+DOWNLOAD = '/download'
+ATTACHMENT = '/attachment'
+
+def chunk_payload(transfer_id, data):
+    return CHUNK_HEADER.pack(0, transfer_id) + data
+
+def is_chunk(payload):
+    return payload[:1] == CHUNK_MARKER
+
+def parse_chunk(payload):
+    # Returns (id, data) with data as a view into the payload
+    _, transfer_id = CHUNK_HEADER.unpack_from(payload)
+    return transfer_id, memoryview(payload)[CHUNK_HEADER.size:]
+
+def format_size(size):
+    for unit in ('bytes', 'KiB', 'MiB'):
+        if size < 1024 or unit == 'MiB':
+            return f"{size} {unit}" if unit == 'bytes' else f"{size:.1f} {unit}"
+        size /= 1024
+
+class Attachment:
+    __slots__ = ('attachment_id', 'path', 'name', 'size')
+
+    def __init__(self, attachment_id, path, name, size):
+        self.attachment_id = attachment_id
+        self.path = path
+        self.name = name
+        self.size = size
+
+class Upload:
+    # A file being received. It is written to a spool file as it arrives, so the
+    # server never holds more than one chunk of it in memory.
+    def __init__(self, path, name, size):
+        self.path = path
+        self.name = name
+        self.size = size
+        self.received = 0
+        self.file = open(path, 'wb')
+
+    def write(self, data):
+        self.file.write(data)
+        self.received += len(data)
+        return self.received >= self.size
+
+class Download:
+    # An attachment being sent to one client, read from disk one chunk at a time
+    def __init__(self, attachment):
+        self.attachment = attachment
+        self.file = open(attachment.path, 'rb')
+
+class AttachmentStore:
+    # Every completed upload is kept in `directory` and known by a numeric id. Recipients get
+    # the id, not the data: only the clients that ask for a file download it, straight from disk.
+    # The store never grows beyond max_storage bytes: uploads that don't fit are refused.
+    def __init__(self, directory=None, max_size=MAX_ATTACHMENT_SIZE, max_storage=MAX_STORAGE):
+        self.temporary = directory is None # A directory we created is removed again on close()
+        self.directory = directory or tempfile.mkdtemp(prefix='chat-attachments-')
+        os.makedirs(self.directory, exist_ok=True)
+        self.max_size = max_size
+        self.max_storage = max_storage
+        self.used = 0 # Bytes of the stored attachments plus the announced size of uploads in progress
+        self.attachments = {}
+        self.next_id = 1
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        # Attachments from an earlier run stay downloadable: the message log still refers to them
+        for filename in os.listdir(self.directory):
+            stem, extension = os.path.splitext(filename)
+            path = os.path.join(self.directory, filename)
+            if extension == '.part': # Upload interrupted by a crash
+                os.remove(path)
+            elif extension == '.bin' and stem.isdigit():
+                try:
+                    with open(os.path.join(self.directory, f"{stem}.name"), encoding='utf-8') as f:
+                        name = f.read()
+                except FileNotFoundError:
+                    name = filename
+                attachment_id = int(stem)
+                self.attachments[attachment_id] = Attachment(attachment_id, path, name, os.path.getsize(path))
+                self.used += self.attachments[attachment_id].size
+                self.next_id = max(self.next_id, attachment_id + 1)
+
+    def begin(self, name, size):
+        # None if the file doesn't fit. Its size is reserved right away, so uploads running at
+        # the same time can't overshoot the limit together.
+        with self.lock:
+            if self.used + size > self.max_storage:
+                return None
+            self.used += size
+        return Upload(os.path.join(self.directory, f"upload-{uuid.uuid4().hex}.part"), name, size)
+
+    def finish(self, upload):
+        upload.file.close()
+        with self.lock:
+            attachment_id = self.next_id
+            self.next_id += 1
+        path = os.path.join(self.directory, f"{attachment_id}.bin")
+        with open(os.path.join(self.directory, f"{attachment_id}.name"), 'w', encoding='utf-8') as f:
+            f.write(upload.name)
+        os.replace(upload.path, path)
+        attachment = Attachment(attachment_id, path, upload.name, upload.size)
+        with self.lock:
+            self.attachments[attachment_id] = attachment
+        return attachment
+
+    def abort(self, upload):
+        upload.file.close()
+        with self.lock:
+            self.used -= upload.size
+        try:
+            os.remove(upload.path)
+        except OSError:
+            pass
+
+    def get(self, attachment_id):
+        with self.lock:
+            return self.attachments.get(attachment_id)
+
+    def close(self):
+        if self.temporary:
+            shutil.rmtree(self.directory, ignore_errors=True)
@@ -1,17 +1,25 @@
 # chat_client.py
+import argparse
 import socket
 import threading
 import sys
 
+from chat_protocol import PING, PONG, FrameDecoder, RawDecoder, encode_frame
+
 HOST = '127.0.0.1'  # The server's hostname or IP address
 PORT = 65432        # The port used by the server
 
 class ChatClient:
-    def __init__(self, host, port):
+    def __init__(self, host, port, framed=True):
         self.host = host
         self.port = port
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.username = None
+        self.framed = framed # Length-prefixed frames by default, raw text for old servers
+
+    def send(self, text):
+        payload = text.encode('utf-8')
+        self.client_socket.sendall(encode_frame(payload) if self.framed else payload)
 
     def connect(self):
         try:
@@ -26,19 +34,27 @@ class ChatClient:
             username = input("Enter your username: ").strip()
             if username:
                 self.username = username
-                self.client_socket.sendall(username.encode('utf-8'))
+                self.send(username)
                 break
             else:
                 print("Username cannot be empty. Please try again.")
 
     def receive_messages(self):
+        decoder = FrameDecoder() if self.framed else RawDecoder()
         while True:
             try:
-                message = self.client_socket.recv(4096).decode('utf-8')
-                if not message: # Server disconnected
+                data = self.client_socket.recv(65536)
+                if not data: # Server disconnected
                     print("\n[!] Server disconnected.")
                     break
-                print(f"\r{message}\n{self.username}> ", end="") # Print message and re-prompt user input
+                for payload in decoder.feed(data):
+                    message = payload.decode('utf-8')
+                    if not self.framed: # Raw text: messages end with a line break, several may come at once
+                        message = message.rstrip('\n')
+                    if message == PING: # Server checking we're still alive
+                        self.send(PONG)
+                        continue
+                    print(f"\r{message}\n{self.username}> ", end="") # Print message and re-prompt user input
             except ConnectionResetError: # Server forcefully disconnected
                 print("\n[!] Server forcefully disconnected.")
                 break
@@ -57,7 +73,7 @@ class ChatClient:
                 user_input = input(f"{self.username}> ")
                 if user_input.lower() == 'exit':
                     break
-                self.client_socket.sendall(user_input.encode('utf-8'))
+                self.send(user_input)
             except ConnectionResetError:
                 print("[!] Connection lost to server.")
                 break
@@ -83,5 +99,11 @@ class ChatClient:
         self.send_messages()
 
 if __name__ == '__main__':
-    client = ChatClient(HOST, PORT)
-    client.start()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Simple chat client")
+    parser.add_argument('--host', default=HOST, help="Server address")
+    parser.add_argument('--port', type=int, default=PORT, help="Server port")
+    parser.add_argument('--raw', action='store_true', help="Speak the old raw-text protocol instead of length-prefixed frames")
+    args = parser.parse_args()
+
+    client = ChatClient(args.host, args.port, framed=not args.raw)
+    client.start()
@@ -0,0 +1,250 @@
+# chat_client_async.py
+# asyncio chat client that survives server restarts and network blips. Instead of exiting when
+# the connection drops, it reconnects with exponential backoff and tells the server the last
+# message sequence number it saw, so the server sends only the messages it missed.
+import argparse
+import asyncio
+import collections
+import itertools
+import os
+import random
+import sys
+
+from chat_attachments import ATTACHMENT, CHUNK_SIZE, UPLOAD, chunk_payload, is_chunk, parse_chunk
+from chat_client import HOST, PORT
+from chat_protocol import FEATURES, HELLO, PING, PONG, WELCOME, FrameDecoder, ProtocolError, decode_record, encode_frame
+from chat_rooms import DEFAULT_ROOM, valid_room_name
+
+INITIAL_BACKOFF = 0.5 # Seconds before the first reconnect attempt
+MAX_BACKOFF = 30.0    # The delay doubles after every failed attempt up to this limit
+READ_TIMEOUT = 120.0  # The server pings idle clients, so this long without any data means a dead connection
+
+class ResumingChatClient:
+    def __init__(self, host, port, username, on_message=print, initial_backoff=INITIAL_BACKOFF,
+                 max_backoff=MAX_BACKOFF, read_timeout=READ_TIMEOUT, features=(), download_dir='.'):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.on_message = on_message # Called with the text of every chat message
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.read_timeout = read_timeout
+        self.features = features # Requested from the server, e.g. ('binary', 'zlib')
+        self.epoch = None # Names the server history our sequence numbers belong to
+        self.last_seq = 0 # Highest sequence number received so far
+        self.room = DEFAULT_ROOM # Rejoined automatically after a reconnect
+        self.outbox = collections.deque() # Typed messages not yet written, kept across reconnects
+        self.outbox_ready = asyncio.Event()
+        self.uploads = collections.deque() # [upload id, path, open file or None], sent one chunk at a time
+        self.upload_ids = itertools.count(1)
+        self.download_dir = download_dir
+        self.downloads = {} # Attachment id -> [file, path, expected size, bytes received]
+        self.writer = None
+        self.closed = False
+        self.sessions = 0 # Successful connections, so reconnects = sessions - 1
+
+    def send(self, text):
+        self.outbox.append(text)
+        self.outbox_ready.set()
+
+    def upload(self, path):
+        # The file is read and sent a chunk at a time between typed messages, never all at once
+        self.uploads.append([next(self.upload_ids), path, None])
+        self.outbox_ready.set()
+
+    def close(self):
+        self.closed = True
+        if self.writer is not None:
+            self.writer.close()
+
+    async def run(self):
+        backoff = self.initial_backoff
+        while not self.closed:
+            try:
+                reader, self.writer = await asyncio.open_connection(self.host, self.port)
+            except OSError as e:
+                # Full jitter: clients that lost the same server don't all come back at the same moment
+                delay = random.uniform(0, backoff)
+                print(f"[!] Could not connect to {self.host}:{self.port} ({e}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            if await self.session(reader, self.writer):
+                backoff = self.initial_backoff # The server let us in, so the next drop starts over
+            self.writer.close()
+            if not self.closed:
+                delay = random.uniform(0, backoff)
+                print(f"[!] Disconnected, reconnecting in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                backoff = min(backoff * 2, self.max_backoff)
+
+    async def session(self, reader, writer):
+        # One connection, from the HELLO handshake until it drops. Returns True if the server welcomed us.
+        welcomed = False
+        epoch = self.epoch or '-'
+        handshake = f"{HELLO} {epoch} {self.last_seq} {self.room} {self.username}"
+        if self.features:
+            handshake = f"{FEATURES} {','.join(self.features)} {handshake}"
+        writer.write(encode_frame(handshake.encode('utf-8')))
+        sender = asyncio.create_task(self.send_loop(writer))
+        decoder = FrameDecoder(inflate='zlib' in self.features)
+        binary = False # Switched on by the server's FEATURES answer
+        usernames = {} # Interned by the server once per connection
+        try:
+            while True:
+                data = await asyncio.wait_for(reader.read(65536), self.read_timeout)
+                if not data: # Server disconnected
+                    break
+                for payload in decoder.feed(data):
+                    if is_chunk(payload):
+                        self.receive_chunk(*parse_chunk(payload))
+                        continue
+                    if binary:
+                        record = decode_record(payload, usernames)
+                        if record is None:
+                            continue
+                        seq, text = record
+                    else:
+                        text = payload.decode('utf-8')
+                        if text.startswith(FEATURES + ' '):
+                            binary = 'binary' in text.split()[1].split(',')
+                            continue
+                        seq, _, text = text.partition(' ')
+                        seq = int(seq)
+                    if text == PING:
+                        writer.write(encode_frame(PONG.encode('utf-8')))
+                    elif text.startswith(WELCOME + ' '):
+                        welcomed = True
+                        self.sessions += 1
+                        epoch = text.split()[1]
+                        if epoch != self.epoch: # A new history: our sequence number means nothing there
+                            self.epoch = epoch
+                            self.last_seq = 0
+                    elif text.startswith(ATTACHMENT + ' '):
+                        self.start_download(text)
+                    elif seq == 0: # Announcements and command replies aren't numbered
+                        self.on_message(text)
+                    elif seq > self.last_seq: # Anything else was already shown before the reconnect
+                        self.last_seq = seq
+                        self.on_message(text)
+        except asyncio.TimeoutError:
+            print("[!] No data from the server for too long, assuming the connection is dead.")
+        except (OSError, ValueError, ProtocolError) as e:
+            print(f"[!] Connection error: {e}")
+        finally:
+            sender.cancel()
+            for upload in self.uploads: # Restarted from the beginning on the next connection
+                if upload[2] is not None:
+                    upload[2].close()
+                    upload[2] = None
+            for file, path, _, _ in self.downloads.values():
+                file.close()
+                os.remove(path) # Incomplete: type /download again after the reconnect
+            self.downloads.clear()
+        return welcomed
+
+    async def send_loop(self, writer):
+        # A message leaves the outbox only once it was handed to the socket, so anything typed
+        # while disconnected goes out after the reconnect. Uploads go out one chunk per round,
+        # after all the text waiting at that point, so chatting continues during an upload.
+        while True:
+            await self.outbox_ready.wait()
+            self.outbox_ready.clear()
+            while self.outbox:
+                text = self.outbox[0]
+                writer.write(encode_frame(text.encode('utf-8')))
+                await writer.drain()
+                self.outbox.popleft()
+                self.track_room(text)
+            if self.uploads:
+                await self.send_chunk(writer)
+                self.outbox_ready.set()
+
+    async def send_chunk(self, writer):
+        upload = self.uploads[0]
+        upload_id, path, file = upload
+        if file is None: # Announce the upload first
+            file = upload[2] = open(path, 'rb')
+            name = os.path.basename(path)
+            writer.write(encode_frame(f"{UPLOAD} {upload_id} {os.fstat(file.fileno()).st_size} {name}".encode('utf-8')))
+        data = file.read(CHUNK_SIZE)
+        if data:
+            writer.write(encode_frame(chunk_payload(upload_id, data)))
+        await writer.drain()
+        if len(data) < CHUNK_SIZE: # Everything was sent, the server shares the file when it has it all
+            file.close()
+            self.uploads.popleft()
+
+    def start_download(self, text):
+        # "/attachment <id> <size> <name>": the chunks follow
+        _, attachment_id, size, name = text.split(' ', 3)
+        os.makedirs(self.download_dir, exist_ok=True)
+        name = os.path.basename(name)
+        if name in ('', '.', '..'): # Not a file name, and opening it would fail
+            name = attachment_id
+        path = os.path.join(self.download_dir, name)
+        self.downloads[int(attachment_id)] = [open(path, 'wb'), path, int(size), 0]
+
+    def receive_chunk(self, attachment_id, data):
+        download = self.downloads.get(attachment_id)
+        if download is None:
+            return
+        if data:
+            download[0].write(data)
+            download[3] += len(data)
+            return
+        # The empty chunk ends the file
+        file, path, size, received = self.downloads.pop(attachment_id)
+        file.close()
+        if received == size:
+            self.on_message(f"[*] Saved attachment {attachment_id} to {path}")
+        else: # The server drops queued frames for clients that fall too far behind
+            os.remove(path)
+            self.on_message(f"[!] Attachment {attachment_id} arrived incomplete ({received} of {size} bytes), try again.")
+
+    def track_room(self, text):
+        command, _, argument = text.strip().partition(' ')
+        if command == '/join' and valid_room_name(argument.strip()):
+            self.room = argument.strip()
+        elif command == '/leave':
+            self.room = DEFAULT_ROOM
+
+async def main(args):
+    username = args.username
+    while not username:
+        username = input("Enter your username: ").strip()
+    features = [name for name, wanted in (('binary', args.binary), ('zlib', args.compress)) if wanted]
+    client = ResumingChatClient(args.host, args.port, username, features=features, download_dir=args.download_dir,
+                                on_message=lambda text: print(f"\r{text}\n{username}> ", end=""))
+    connection = asyncio.create_task(client.run())
+    loop = asyncio.get_running_loop()
+    print(f"[*] Connecting to {args.host}:{args.port}, type 'exit' to quit")
+    while True:
+        # input() would block the event loop, so it runs in a worker thread
+        line = await loop.run_in_executor(None, sys.stdin.readline)
+        if not line or line.strip().lower() == 'exit':
+            break
+        command, _, path = line.strip().partition(' ')
+        if command == UPLOAD: # "/upload <path>" here; the client adds the id and size for the server
+            if os.path.isfile(path):
+                client.upload(path)
+            else:
+                print(f"[!] No such file: {path}")
+        elif line.strip():
+            client.send(line.rstrip('\n'))
+    client.close()
+    connection.cancel()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Chat client that reconnects and resumes where it left off")
+    parser.add_argument('--host', default=HOST, help="Server address")
+    parser.add_argument('--port', type=int, default=PORT, help="Server port")
+    parser.add_argument('--username', help="Username (asked for when missing)")
+    parser.add_argument('--binary', action='store_true', help="Ask for the compact binary message format")
+    parser.add_argument('--compress', action='store_true', help="Ask for zlib compression of everything the server sends")
+    parser.add_argument('--download-dir', default='downloads', help="Where /download saves attachments")
+    args = parser.parse_args()
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        pass
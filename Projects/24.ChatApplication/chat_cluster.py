@@ -0,0 +1,180 @@
+# chat_cluster.py
+# Runs several chat server processes on one (Linux) machine. All workers listen on the same
+# port with SO_REUSEPORT, so the kernel spreads incoming connections across them, and every
+# broadcast is relayed to the other workers over a local Unix-socket bus.
+import asyncio
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+
+from chat_outbound import OutboundQueue, DROP_OLDEST
+from chat_protocol import HEADER, EncodedMessage, FrameDecoder, send_buffers
+
+BUS_MAX_BACKLOG = 64 * 1024 * 1024 # A worker may fall this far behind on the bus before messages are dropped
+
+class ClusterBus:
+    # Supervisor side: a hub that relays every frame from one worker to all the others.
+    # It never decodes the messages, it only copies frames along. Each worker has a bounded
+    # queue on the hub, like a client on a server: a worker that reads slowly loses its oldest
+    # frames instead of growing the hub's memory without limit.
+    def __init__(self, path):
+        self.path = path
+        self.workers = {} # StreamWriter of each connected worker -> its OutboundQueue
+
+    async def serve(self, ready):
+        server = await asyncio.start_unix_server(self.handle_worker, path=self.path)
+        ready.set()
+        async with server:
+            await server.serve_forever()
+
+    async def handle_worker(self, reader, writer):
+        # Keep the transport's own buffer small so the backlog builds up in the bounded queue
+        writer.transport.set_write_buffer_limits(high=64 * 1024)
+        ready = asyncio.Event()
+        queue = OutboundQueue(BUS_MAX_BACKLOG, DROP_OLDEST, on_ready=ready.set)
+        self.workers[writer] = queue
+        sender = asyncio.create_task(self.send_loop(writer, queue, ready))
+        try:
+            while True:
+                header = await reader.readexactly(HEADER.size)
+                _, length = HEADER.unpack(header)
+                payload = await reader.readexactly(length)
+                for other, other_queue in self.workers.items():
+                    if other is not writer:
+                        other_queue.put((header, payload), HEADER.size + length)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass # Worker exited
+        finally:
+            del self.workers[writer]
+            queue.close() # Also stops the sender
+            await sender
+            if queue.dropped:
+                print(f"[!] A worker fell behind on the cluster bus, {queue.dropped} messages were dropped.")
+            writer.close()
+
+    async def send_loop(self, writer, queue, ready):
+        while True:
+            await ready.wait()
+            ready.clear()
+            if queue.closed:
+                break
+            try:
+                writer.writelines(queue.take_all())
+                await writer.drain()
+            except (ConnectionError, OSError):
+                break # handle_worker() notices too and cleans up
+
+class BusClient:
+    # Worker side: publishes this worker's broadcasts and hands the other workers' broadcasts to the server.
+    # Each bus message is one frame whose payload is "<room>\n<record>\n<text>" (room names never contain
+    # whitespace, an empty room means "every client", record is 1 for chat messages that go into the history).
+    def __init__(self, path):
+        self.path = path
+        self.sock = None
+        self.ready = threading.Event()
+        self.queue = OutboundQueue(BUS_MAX_BACKLOG, DROP_OLDEST, on_ready=self.ready.set)
+
+    def connect(self, on_message):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+        for target, args in ((self.send_loop, ()), (self.receive_loop, (on_message,))):
+            thread = threading.Thread(target=target, args=args)
+            thread.daemon = True
+            thread.start()
+
+    def publish(self, room, text, record=False):
+        # Never blocks: a background thread writes to the bus
+        message = EncodedMessage(f"{room or ''}\n{int(record)}\n{text}")
+        self.queue.put(message.framed, message.framed_size)
+
+    def send_loop(self):
+        while True:
+            self.ready.wait()
+            self.ready.clear()
+            if self.queue.closed:
+                break
+            try:
+                send_buffers(self.sock, self.queue.take_all())
+            except OSError as e:
+                print(f"[!] Error writing to the cluster bus: {e}")
+                break
+
+    def receive_loop(self, on_message):
+        decoder = FrameDecoder()
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except OSError:
+                data = b''
+            if not data:
+                print("[!] Lost connection to the cluster bus.")
+                break
+            for payload in decoder.feed(data):
+                room, record, text = payload.decode('utf-8').split('\n', 2)
+                on_message(room or None, text, record == '1')
+
+    def close(self):
+        self.queue.close()
+        if self.sock is not None:
+            self.sock.close()
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+def run_worker(worker_id, engine, host, port, options, bus_path):
+    # The supervisor decides when workers stop: ignore Ctrl+C and turn its SIGTERM
+    # into the KeyboardInterrupt the servers already handle as a graceful shutdown
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, _interrupt)
+
+    if options.get('history_dir'):
+        # Every worker sees every message, so each one keeps a complete log of its own
+        options = dict(options, history_dir=os.path.join(options['history_dir'], f"worker-{worker_id}"))
+    if options.get('attachment_dir'):
+        options = dict(options, attachment_dir=os.path.join(options['attachment_dir'], f"worker-{worker_id}"))
+    if options.get('metrics_port'):
+        options = dict(options, metrics_port=options['metrics_port'] + worker_id) # One endpoint per worker
+
+    from chat_server import create_server
+    server = create_server(engine, host, port, reuse_port=True, **options)
+    server.bus = BusClient(bus_path)
+    print(f"[*] Worker {worker_id} running with pid {os.getpid()}")
+    server.start()
+
+def run_cluster(workers, engine, host, port, options):
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        print("[!] SO_REUSEPORT is not available on this platform, run a single server instead.")
+        return
+
+    bus_dir = tempfile.mkdtemp(prefix='chat-bus-')
+    bus = ClusterBus(os.path.join(bus_dir, 'bus.sock'))
+    ready = threading.Event()
+    hub = threading.Thread(target=lambda: asyncio.run(bus.serve(ready)))
+    hub.daemon = True
+    hub.start()
+    ready.wait()
+    print(f"[*] Cluster bus listening on {bus.path}")
+
+    processes = []
+    for worker_id in range(workers):
+        process = multiprocessing.Process(target=run_worker, args=(worker_id, engine, host, port, options, bus.path))
+        process.start()
+        processes.append(process)
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        print("\n[!] Cluster shutting down...")
+        for process in processes:
+            process.terminate() # Each worker shuts its own server down
+        for process in processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.kill()
+    finally:
+        shutil.rmtree(bus_dir, ignore_errors=True)
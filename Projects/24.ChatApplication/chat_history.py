@@ -0,0 +1,282 @@
+# chat_history.py
+import collections
+import json
+import mmap
+import os
+import secrets
+import threading
+import time
+
+from chat_search import MAX_RESULTS, SearchIndex
+
+DEFAULT_REPLAY = 20                   # Messages per room shown to a user who joins it
+DEFAULT_SEGMENT_BYTES = 16 * 1024 * 1024 # Start a new log file once the current one reaches this size
+FLUSH_INTERVAL = 0.05                 # Seconds the writer thread waits to batch up log writes
+RECENT_SEGMENTS = 2                   # Segments read back (memory-mapped) to rebuild history on startup
+MAX_RESUME = 1000                     # Most messages sent to a client that resumes after a long absence
+MAX_RINGS = 1000                      # Rooms whose recent messages are kept in memory, most recently used
+
+class MessageLog:
+    # Append-only message log split into segment files named after their first sequence number.
+    # One JSON object per line: {"seq": 1, "ts": 1700000000.0, "room": "lobby", "text": "..."}.
+    # append() only queues the record; a background thread writes batches to disk, so
+    # persistence never adds latency to message delivery.
+    def __init__(self, directory, segment_bytes=DEFAULT_SEGMENT_BYTES, flush_interval=FLUSH_INTERVAL):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.flush_interval = flush_interval
+        self.pending = [] # Records waiting for the writer thread
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.file = None
+        self.writer = None
+        self.on_flush = None # Called with every batch once it is written, e.g. SearchIndex.append
+
+    def segments(self):
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith('.log'))
+        return [os.path.join(self.directory, name) for name in names]
+
+    def read_segment(self, path):
+        # Memory-map the segment instead of reading it into one big string
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for line in iter(data.readline, b''):
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue # A damaged line loses only its own message
+
+    def repair(self):
+        # A crash in the middle of a write leaves a torn last line in the newest segment. Cut
+        # it off before appending again, or every record after it would sit behind the bad line.
+        paths = self.segments()
+        if not paths:
+            return 0
+        with open(paths[-1], 'r+b') as f:
+            end = f.seek(0, os.SEEK_END)
+            keep = 0
+            position = end
+            while position > 0: # Search backwards for the end of the last complete line
+                start = max(0, position - 65536)
+                f.seek(start)
+                newline = f.read(position - start).rfind(b'\n')
+                if newline >= 0:
+                    keep = start + newline + 1
+                    break
+                position = start
+            if keep < end:
+                f.truncate(keep)
+        return end - keep
+
+    def read_recent(self, segments=RECENT_SEGMENTS):
+        for path in self.segments()[-segments:]:
+            yield from self.read_segment(path)
+
+    def read_since(self, seq):
+        # Every record with a sequence number greater than `seq`, oldest first
+        paths = self.segments()
+        # Segment names are their first sequence number, so older segments can be skipped
+        first = 0
+        for i, path in enumerate(paths):
+            if int(os.path.basename(path)[:-4]) <= seq + 1:
+                first = i
+        for path in paths[first:]:
+            for record in self.read_segment(path):
+                if record['seq'] > seq:
+                    yield record
+
+    def open(self, next_seq):
+        os.makedirs(self.directory, exist_ok=True)
+        paths = self.segments()
+        if paths and os.path.getsize(paths[-1]) < self.segment_bytes:
+            self.file = open(paths[-1], 'ab')
+        else:
+            self.file = self._new_segment(next_seq)
+        self.writer = threading.Thread(target=self.write_loop)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def append(self, seq, room, text, timestamp):
+        with self.lock:
+            self.pending.append((seq, timestamp, room, text))
+        self.wakeup.set()
+
+    def write_loop(self):
+        while not self.closed:
+            self.wakeup.wait()
+            time.sleep(self.flush_interval) # Let more records pile up so they are written together
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            records, self.pending = self.pending, []
+        if not records:
+            return
+        lines = []
+        for seq, timestamp, room, text in records:
+            lines.append(json.dumps({'seq': seq, 'ts': timestamp, 'room': room, 'text': text},
+                                    ensure_ascii=False, separators=(',', ':')))
+        try:
+            self.file.write(('\n'.join(lines) + '\n').encode('utf-8'))
+            self.file.flush()
+            if self.file.tell() >= self.segment_bytes:
+                self.file.close()
+                self.file = self._new_segment(records[-1][0] + 1)
+        except OSError as e:
+            print(f"[!] Could not write the message log: {e}")
+            return
+        if self.on_flush is not None:
+            self.on_flush(records)
+
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+        if self.writer is not None:
+            self.writer.join(timeout=2)
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+
+    def _new_segment(self, first_seq):
+        return open(os.path.join(self.directory, f"{first_seq:020d}.log"), 'ab')
+
+class ChatHistory:
+    # Gives every recorded message a sequence number, keeps the last `replay` messages of each
+    # room in a ring buffer for new joiners, and (optionally) persists everything to a MessageLog.
+    def __init__(self, directory=None, replay=DEFAULT_REPLAY, search=True, max_rings=MAX_RINGS):
+        self.replay = replay
+        # Room -> deque of (seq, EncodedMessage), oldest first. Anyone can /join any name, so
+        # only the max_rings rooms that had a message last are kept; the others start over empty.
+        self.rings = collections.OrderedDict()
+        self.max_rings = max_rings
+        self.evicted = {} # Room -> newest seq that has left its ring buffer: older messages are only in the log
+        self.rings_dropped = 0 # Newest seq of all the rings dropped so far
+        self.log_start = 0 # Messages up to this seq weren't loaded back on startup, they are only in the log
+        self.next_seq = 1
+        self.log = MessageLog(directory) if directory else None
+        # Full-text index of the log, kept next to it
+        self.index = SearchIndex(os.path.join(directory, 'search.db')) if directory and search else None
+        # Names this sequence of numbers. Without a log, numbering restarts with the process, and
+        # so does the epoch; a client holding a sequence number from another epoch can't resume.
+        self.epoch = secrets.token_hex(4)
+        self.encode = None
+
+    def open(self, encode):
+        # Rebuild the ring buffers from the newest log segments, then start logging
+        self.encode = encode
+        if self.log is None:
+            return
+        os.makedirs(self.log.directory, exist_ok=True)
+        self.epoch = self._load_epoch()
+        torn = self.log.repair()
+        if torn:
+            print(f"[!] Message log ended in a torn record ({torn} bytes), cut it off.")
+        count = 0
+        for record in self.log.read_recent():
+            if count == 0:
+                self.log_start = record['seq'] - 1
+            self._append(record['room'], record['seq'], encode(record['text'], record['seq']))
+            self.next_seq = record['seq'] + 1
+            count += 1
+        if self.index is not None:
+            self.index.open(self.log, self.next_seq)
+            self.log.on_flush = self.index.append
+        self.log.open(self.next_seq)
+        print(f"[*] Message log in {self.log.directory}: {count} recent messages loaded, next sequence {self.next_seq}")
+
+    def record(self, room, text, message):
+        # Called with the server lock held, so sequence numbers are handed out in delivery order
+        seq = self.next_seq
+        self.next_seq += 1
+        message.seq = seq
+        self._append(room, seq, message)
+        if self.log is not None:
+            self.log.append(seq, room, text, time.time())
+        return seq
+
+    def recent(self, room):
+        return [message for _, message in self.rings.get(room, ())]
+
+    def read_missed(self, room, seq, limit=MAX_RESUME):
+        # The messages of `room` newer than `seq` that have left the ring buffer, read back from
+        # the log. Returns (seq the log was read up to, messages) for since(). This reads and
+        # parses files, so the server calls it before it takes its lock (the asyncio engine in
+        # an executor). Normally nothing is read: a client that was away briefly finds all it
+        # missed in the ring buffer.
+        forgotten = self._forgotten(room)
+        if self.log is None or forgotten <= seq:
+            return seq, []
+        older = []
+        for record in self.log.read_since(seq):
+            if record['seq'] > forgotten:
+                break
+            if record['room'] == room:
+                older.append(self.encode(record['text'], record['seq']))
+        return forgotten, older[-limit:]
+
+    def since(self, room, seq, missed=None, limit=MAX_RESUME):
+        # Messages of `room` newer than `seq`, oldest first: what read_missed() returned, then
+        # the ring buffer from where that ends. Called with the server lock held, so it never
+        # touches the disk. Returns (messages, complete). complete is False when messages the
+        # client hasn't seen left the ring after read_missed() looked, or there is no log to
+        # read them from.
+        read_up_to, older = missed if missed is not None else (seq, [])
+        ring = self.rings.get(room, ())
+        messages = older + [message for message_seq, message in ring if message_seq > read_up_to]
+        return messages[-limit:], self._forgotten(room) <= read_up_to
+
+    def search(self, room, words, limit=MAX_RESULTS):
+        # [(seq, ts, snippet)] best match first, or None without a search index.
+        # Messages show up a flush interval or so after they were sent.
+        if self.index is None:
+            return None
+        return self.index.search(room, words, limit)
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+        if self.index is not None:
+            self.index.close()
+
+    def _load_epoch(self):
+        # The log keeps its numbering across restarts, so the epoch is kept next to it
+        path = os.path.join(self.log.directory, 'epoch')
+        try:
+            with open(path) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            with open(path, 'w') as f:
+                f.write(self.epoch)
+            return self.epoch
+
+    def _ring(self, room):
+        ring = self.rings.get(room)
+        if ring is None:
+            if len(self.rings) >= self.max_rings:
+                # Least recently used room: its messages are only in the log from now on
+                name, dropped = self.rings.popitem(last=False)
+                self.evicted.pop(name, None)
+                if dropped:
+                    self.rings_dropped = max(self.rings_dropped, dropped[-1][0])
+            ring = self.rings[room] = collections.deque(maxlen=self.replay)
+            if self.rings_dropped: # The room may have been one of the dropped ones
+                self.evicted[room] = self.rings_dropped
+        else:
+            self.rings.move_to_end(room)
+        return ring
+
+    def _append(self, room, seq, message):
+        ring = self._ring(room)
+        if len(ring) == ring.maxlen: # The oldest message drops out (or this one, with --replay 0)
+            self.evicted[room] = ring[0][0] if ring else seq
+        ring.append((seq, message))
+
+    def _forgotten(self, room):
+        # Messages of `room` up to this seq can only be read from the log
+        if room not in self.rings:
+            return max(self.rings_dropped, self.log_start)
+        return max(self.evicted.get(room, 0), self.log_start)
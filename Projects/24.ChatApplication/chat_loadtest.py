@@ -0,0 +1,234 @@
+# chat_loadtest.py
+# Load generator for the chat server: thousands of simulated ChatClient bots on one asyncio
+# loop. Bots join rooms, some of them send messages at a fixed rate, and everybody measures
+# how long each message took to reach them. Results can be saved as JSON and compared later.
+# With --websocket-clients some of the bots connect as browsers would, so both kinds of client
+# share the same rooms and their latencies can be compared.
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+
+from chat_protocol import FEATURES, PING, PONG, FrameDecoder, decode_record, encode_frame
+from chat_server import HOST, PORT
+from chat_server_async import raise_open_file_limit
+from chat_websocket import WebSocketDecoder, client_frame, handshake_request
+
+class Stats:
+    def __init__(self):
+        self.connect_times = [] # Seconds from connect() until the bot was in its room
+        self.latencies = []     # Seconds from send to delivery, one sample per delivered message
+        self.websocket_latencies = [] # The same for messages delivered to WebSocket bots
+        self.sent = 0
+        self.received = 0
+        self.received_bytes = 0 # Bytes read off the sockets, to compare wire formats
+        self.errors = 0
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+class Bot:
+    def __init__(self, bot_id, room, sender, args, stats, run_id, websocket=False):
+        self.bot_id = bot_id
+        self.websocket = websocket
+        self.room = room
+        self.sender = sender
+        self.args = args
+        self.stats = stats
+        self.marker = f"bench {run_id} " # Ignore anything from other runs (e.g. replayed history)
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, limit):
+        async with limit: # Cap the number of handshakes in flight
+            start = time.perf_counter()
+            try:
+                self.reader, self.writer = await asyncio.open_connection(self.args.host, self.args.port)
+                username = f"bot{self.bot_id}"
+                if self.websocket:
+                    self.writer.write(handshake_request(self.args.host, self.args.port))
+                    response = await self.reader.readuntil(b'\r\n\r\n')
+                    if not response.startswith(b'HTTP/1.1 101'):
+                        raise OSError(f"WebSocket upgrade refused: {response.splitlines()[0]}")
+                elif self.args.features:
+                    username = f"{FEATURES} {self.args.features} {username}"
+                self.writer.write(self.encode(username))
+                self.writer.write(self.encode(f"/join {self.room}"))
+                await self.writer.drain()
+            except (OSError, asyncio.IncompleteReadError):
+                self.stats.errors += 1
+                return False
+            self.stats.connect_times.append(time.perf_counter() - start)
+            return True
+
+    def encode(self, text):
+        if self.websocket:
+            return client_frame(text.encode('utf-8'))
+        return encode_frame(text.encode('utf-8'))
+
+    async def receive(self, measuring):
+        if self.websocket:
+            decoder = WebSocketDecoder(server=False)
+        else:
+            decoder = FrameDecoder(inflate='zlib' in self.args.features.split(','))
+        latencies = self.stats.websocket_latencies if self.websocket else self.stats.latencies
+        binary = False
+        usernames = {}
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                self.stats.received_bytes += len(data)
+                payloads = decoder.feed(data)
+                for reply in decoder.take_replies(): # WebSocket heartbeat pings
+                    self.writer.write(reply)
+                for payload in payloads:
+                    if binary:
+                        record = decode_record(payload, usernames)
+                        if record is None:
+                            continue
+                        text = record[1]
+                    else:
+                        text = payload.decode('utf-8', errors='replace')
+                        if text.startswith(FEATURES + ' '):
+                            binary = 'binary' in text.split()[1].split(',')
+                            continue
+                    if text == PING:
+                        self.writer.write(self.encode(PONG))
+                        continue
+                    position = text.find(self.marker)
+                    if position < 0 or not measuring.is_set():
+                        continue
+                    sent_at = float(text[position + len(self.marker):].split()[0])
+                    latencies.append(time.perf_counter() - sent_at)
+                    self.stats.received += 1
+        except (OSError, ValueError):
+            self.stats.errors += 1
+
+    async def send(self, stop):
+        interval = 1.0 / self.args.rate
+        # Spread the senders out so they don't all fire on the same tick
+        await asyncio.sleep(random.random() * interval)
+        next_send = time.perf_counter()
+        while not stop.is_set():
+            message = f"{self.marker}{time.perf_counter():.6f} {'x' * self.args.message_size}"
+            try:
+                self.writer.write(self.encode(message))
+                await self.writer.drain()
+            except OSError:
+                self.stats.errors += 1
+                return
+            self.stats.sent += 1
+            next_send += interval
+            await asyncio.sleep(max(0.0, next_send - time.perf_counter()))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+async def run(args):
+    stats = Stats()
+    run_id = f"{os.getpid()}-{int(time.time())}"
+    bots = []
+    for bot_id in range(args.clients):
+        room_number = bot_id % args.rooms
+        # The first `senders` bots of every room send, the rest only listen
+        sender = bot_id // args.rooms < args.senders
+        # The last bots connect over WebSocket, so they sit in the same rooms as the TCP bots
+        websocket = bot_id >= args.clients - args.websocket_clients
+        bots.append(Bot(bot_id, f"load-{room_number}", sender, args, stats, run_id, websocket))
+
+    print(f"[*] Connecting {args.clients} bots to {args.host}:{args.port} ({args.rooms} rooms, "
+          f"{sum(bot.websocket for bot in bots)} over WebSocket)...")
+    limit = asyncio.Semaphore(args.connect_concurrency)
+    start = time.perf_counter()
+    results = await asyncio.gather(*(bot.connect(limit) for bot in bots))
+    connect_seconds = time.perf_counter() - start
+    bots = [bot for bot, connected in zip(bots, results) if connected]
+    print(f"[*] {len(bots)} bots connected in {connect_seconds:.2f}s")
+
+    measuring = asyncio.Event()
+    stop = asyncio.Event()
+    receivers = [asyncio.create_task(bot.receive(measuring)) for bot in bots]
+    await asyncio.sleep(args.settle) # Let joins, history replay and announcements drain
+
+    measuring.set()
+    senders = [asyncio.create_task(bot.send(stop)) for bot in bots if bot.sender]
+    print(f"[*] {len(senders)} senders at {args.rate} msg/s each for {args.duration}s...")
+    await asyncio.sleep(args.duration)
+    stop.set()
+    await asyncio.gather(*senders)
+    await asyncio.sleep(args.settle) # Collect messages still in flight
+    measuring.clear()
+
+    for bot in bots:
+        bot.close()
+    for task in receivers:
+        task.cancel()
+    await asyncio.gather(*receivers, return_exceptions=True)
+
+    return {
+        'clients': len(bots),
+        'rooms': args.rooms,
+        'senders': len(senders),
+        'connect_per_sec': len(bots) / connect_seconds if connect_seconds else 0.0,
+        'connect_p99_ms': percentile(stats.connect_times, 99) * 1000,
+        'sent_per_sec': stats.sent / args.duration,
+        'delivered_per_sec': stats.received / args.duration,
+        'received_kib_per_sec': stats.received_bytes / 1024 / (args.duration + 2 * args.settle),
+        'latency_p50_ms': percentile(stats.latencies, 50) * 1000,
+        'latency_p95_ms': percentile(stats.latencies, 95) * 1000,
+        'latency_p99_ms': percentile(stats.latencies, 99) * 1000,
+        'websocket_p50_ms': percentile(stats.websocket_latencies, 50) * 1000,
+        'websocket_p99_ms': percentile(stats.websocket_latencies, 99) * 1000,
+        'errors': stats.errors,
+    }
+
+def print_report(report, baseline=None):
+    print()
+    print(f"{'metric':<20}{'value':>14}" + (f"{'baseline':>14}{'change':>10}" if baseline else ""))
+    for key, value in report.items():
+        line = f"{key:<20}{value:>14.2f}" if isinstance(value, float) else f"{key:<20}{value:>14}"
+        if baseline and key in baseline:
+            old = baseline[key]
+            change = f"{(value - old) / old * 100:+.1f}%" if old else "n/a"
+            line += f"{old:>14.2f}{change:>10}" if isinstance(old, float) else f"{old:>14}{change:>10}"
+        print(line)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test a running chat server with simulated clients")
+    parser.add_argument('--host', default=HOST, help="Server address")
+    parser.add_argument('--port', type=int, default=PORT, help="Server port")
+    parser.add_argument('--clients', type=int, default=1000, help="Number of simulated clients")
+    parser.add_argument('--rooms', type=int, default=10, help="Clients are spread evenly over this many rooms")
+    parser.add_argument('--senders', type=int, default=1, help="Sending clients per room (the rest only listen)")
+    parser.add_argument('--rate', type=float, default=5.0, help="Messages per second per sending client")
+    parser.add_argument('--message-size', type=int, default=64, help="Padding bytes added to every message")
+    parser.add_argument('--duration', type=float, default=10.0, help="Seconds to send messages for")
+    parser.add_argument('--settle', type=float, default=1.0, help="Seconds to wait before and after the send phase")
+    parser.add_argument('--connect-concurrency', type=int, default=200, help="Connection attempts in flight at once")
+    parser.add_argument('--websocket-clients', type=int, default=0, help="How many of the clients connect over WebSocket")
+    parser.add_argument('--features', default='', help="Features the bots ask for, e.g. binary,zlib")
+    parser.add_argument('--json', help="Write the report to this JSON file")
+    parser.add_argument('--baseline', help="Compare against a report saved earlier with --json")
+    args = parser.parse_args()
+
+    raise_open_file_limit()
+    report = asyncio.run(run(args))
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\n[*] Report written to {args.json}")
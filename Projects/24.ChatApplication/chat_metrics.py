@@ -0,0 +1,134 @@
+# chat_metrics.py
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+HISTOGRAM_BUCKETS = 32 # Bucket i counts durations below 2**i microseconds (the last one is open-ended)
+RATE_COUNTERS = ('messages_in', 'messages_out') # Counters also reported as per-second rates
+
+class Histogram:
+    # Power-of-two buckets: recording a value is a bit_length() and an increment,
+    # and percentiles are accurate to within a factor of two.
+    def __init__(self):
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds):
+        index = min(int(seconds * 1_000_000).bit_length(), HISTOGRAM_BUCKETS - 1)
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, pct):
+        # Upper bound (in microseconds) of the bucket holding the pct-th percentile
+        target = self.count * pct / 100
+        seen = 0
+        for index, bucket in enumerate(self.buckets):
+            seen += bucket
+            if bucket and seen >= target:
+                return 2 ** index
+        return 0
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean_us': self.total / self.count * 1_000_000 if self.count else 0.0,
+            'p50_us': self.percentile(50),
+            'p99_us': self.percentile(99),
+        }
+
+class Metrics:
+    # Counters and histograms updated on the hot path. Each update is a dictionary
+    # increment under a lock that is almost never contended.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = dict.fromkeys(RATE_COUNTERS, 0)
+        self.histograms = {}
+        self.rates = dict.fromkeys(RATE_COUNTERS, 0.0)
+        self.started = time.time()
+
+    def inc(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def start_rate_sampler(self, interval=1.0):
+        # Background thread turning RATE_COUNTERS into per-second rates
+        def sample():
+            previous = {name: self.counters[name] for name in RATE_COUNTERS}
+            while True:
+                time.sleep(interval)
+                with self.lock:
+                    current = {name: self.counters[name] for name in RATE_COUNTERS}
+                    for name in RATE_COUNTERS:
+                        self.rates[name] = (current[name] - previous[name]) / interval
+                previous = current
+        sampler = threading.Thread(target=sample)
+        sampler.daemon = True
+        sampler.start()
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'uptime_seconds': round(time.time() - self.started, 1),
+                'counters': dict(self.counters),
+                'per_second': {name: rate for name, rate in self.rates.items()},
+                'histograms': {name: histogram.snapshot() for name, histogram in self.histograms.items()},
+            }
+
+class SampledLog:
+    # Replaces a print() per message: prints at most one line per `interval` seconds and
+    # reports how many lines were skipped in between. interval=0 prints everything.
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.last = 0.0
+        self.skipped = 0
+
+    def __call__(self, text):
+        now = time.monotonic()
+        if now - self.last < self.interval:
+            self.skipped += 1
+            return
+        if self.skipped:
+            text += f" (+{self.skipped} more since last log line)"
+        self.last = now
+        self.skipped = 0
+        print(text)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            body = self.server.chat_server.metrics_snapshot()
+        elif self.path == '/clients':
+            body = self.server.chat_server.client_snapshot()
+        else:
+            self.send_error(404, "Try /metrics or /clients")
+            return
+        data = json.dumps(body, indent=2).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass # Keep scrapes out of the chat server's console
+
+def start_metrics_server(chat_server, port, host='127.0.0.1'):
+    # Local-only HTTP endpoint: GET /metrics for totals, GET /clients for per-client queue depths
+    httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+    httpd.daemon_threads = True
+    httpd.chat_server = chat_server
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    print(f"[*] Metrics on http://{host}:{port}/metrics")
+    return httpd
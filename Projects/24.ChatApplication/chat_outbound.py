@@ -0,0 +1,102 @@
+# chat_outbound.py
+import collections
+import threading
+
+# What to do when a client can't keep up and its backlog grows past max_bytes
+DROP_OLDEST = 'drop-oldest' # Throw away the oldest queued messages (the client misses some chat)
+DISCONNECT = 'disconnect'   # Drop the client altogether
+SLOW_CONSUMER_POLICIES = (DROP_OLDEST, DISCONNECT)
+
+DEFAULT_MAX_BYTES = 256 * 1024 # Per-client backlog before the slow-consumer policy kicks in
+
+class OutboundQueue:
+    # Bounded queue of encoded messages waiting to be written to one client.
+    # Each entry is a tuple of buffers shared with every other recipient of the message.
+    # Broadcasters only call put(), which never blocks; the engine's I/O layer
+    # (a writer thread or an asyncio task) drains it with take_all().
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, policy=DROP_OLDEST, on_ready=None):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow-consumer policy: {policy}")
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.on_ready = on_ready # Called whenever there is something new for the writer (wakes it up)
+        self.on_drop = None # Called with the entries drop-oldest threw away, before put() returns
+        self.frames = collections.deque()
+        self.pinned = [] # Frames that go out before everything else and are never dropped, see pin()
+        self.kept = set() # id() of the queued entries drop-oldest must skip, see put()
+        self.pending_bytes = 0
+        self.dropped = 0 # Number of messages discarded by the drop-oldest policy
+        self.closed = False
+        self.lock = threading.Lock() # put() and take_all() may run on different threads
+
+    def put(self, buffers, size, keep=False):
+        # Returns False if the client should be disconnected as a slow consumer.
+        # keep=True: drop-oldest never throws this entry away, it stays in its place among the
+        # others (the end of a download, without which the client would wait for the file forever).
+        dropped = []
+        with self.lock:
+            if self.closed:
+                return True # Client is already on its way out, nothing to do
+            self.frames.append(buffers)
+            self.pending_bytes += size
+            if keep:
+                self.kept.add(id(buffers))
+            if self.pending_bytes > self.max_bytes:
+                if self.policy == DISCONNECT:
+                    # Close right away so later broadcasts skip this client while it is being dropped
+                    self.closed = True
+                    self.frames.clear()
+                    self.kept.clear()
+                    self.pending_bytes = 0
+                    return False
+                # Keep at least the newest message, even if it alone is over the limit
+                kept = []
+                while self.pending_bytes > self.max_bytes and len(self.frames) > 1:
+                    frame = self.frames.popleft()
+                    if id(frame) in self.kept:
+                        kept.append(frame)
+                        continue
+                    dropped.append(frame)
+                    self.pending_bytes -= sum(map(len, frame))
+                    self.dropped += 1
+                self.frames.extendleft(reversed(kept)) # Still ahead of everything queued after them
+        if dropped and self.on_drop:
+            self.on_drop(dropped)
+        if self.on_ready:
+            self.on_ready()
+        return True
+
+    def pin(self, buffers):
+        # For the handshake replies a client needs before it can read anything else: the
+        # slow-consumer policy never throws them away, however much is queued after them.
+        # They go out ahead of everything put() queued, so they must be pinned before any put().
+        with self.lock:
+            if self.closed:
+                return
+            self.pinned.append(buffers)
+        if self.on_ready:
+            self.on_ready()
+
+    def take_all(self):
+        # Hand every queued buffer to the writer (flattened, in order) and empty the queue
+        with self.lock:
+            buffers = [buffer for frame in self.pinned for buffer in frame]
+            buffers += [buffer for frame in self.frames for buffer in frame]
+            self.pinned = []
+            self.frames.clear()
+            self.kept.clear()
+            self.pending_bytes = 0
+        return buffers
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.pinned = []
+            self.frames.clear()
+            self.kept.clear()
+            self.pending_bytes = 0
+        if self.on_ready:
+            self.on_ready() # Wake the writer so it notices the queue is closed and exits
+
+    def __len__(self):
+        return len(self.pinned) + len(self.frames)
@@ -0,0 +1,235 @@
+# chat_protocol.py
+import struct
+import time
+import zlib
+
+# Every framed message is: 1 byte protocol version + 4 byte big-endian payload length + payload.
+# A framed client's very first byte is therefore PROTOCOL_VERSION (a control character no
+# username starts with), which is how the server tells it apart from the old raw-text clients.
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct('!BI')
+MAX_FRAME_SIZE = 1024 * 1024 # Refuse anything bigger than 1 MiB
+PING = '/ping' # Heartbeat: whoever receives PING answers with PONG
+PONG = '/pong'
+HELLO = '/hello'     # First frame of a resuming client: "/hello <epoch> <last seq> <room> <username>"
+WELCOME = '/welcome' # Server's answer to HELLO: "/welcome <epoch>"
+FEATURES = '/features' # Optional prefix of the first frame, "/features binary,zlib <username or HELLO>",
+                       # answered with "/features <accepted>" before anything else
+NEGOTIABLE_FEATURES = frozenset({'binary', 'zlib'})
+COMPRESSED_VERSION = 2 # "Version" byte of a frame holding the next piece of the connection's zlib stream
+
+# Binary records: the payload of every frame sent to a client that negotiated 'binary'.
+# A USER record interns a username once per connection; CHAT records then only carry its id.
+RECORD_TEXT = 1   # type, seq; then UTF-8 text (replayed history, messages relayed by other workers)
+RECORD_USER = 2   # type, user id; then the UTF-8 username
+RECORD_CHAT = 3   # type, seq, user id, Unix timestamp; then the UTF-8 message body
+RECORD_NOTICE = 4 # type; then UTF-8 text that has no sequence number (announcements, command replies)
+# WebSocket frame opcodes (RFC 6455). The handshake and the decoder are in chat_websocket.py.
+WS_CONTINUATION = 0x0
+WS_TEXT = 0x1
+WS_BINARY = 0x2
+WS_CLOSE = 0x8
+WS_PING = 0x9
+WS_PONG = 0xA
+
+TEXT_RECORD = struct.Struct('!BI')
+USER_RECORD = struct.Struct('!BI')
+CHAT_RECORD = struct.Struct('!BIII')
+COALESCE_LIMIT = 64 * 1024   # Max bytes packed into a single send() where sendmsg() isn't available
+IOV_MAX = 1024               # Max buffers handed to a single sendmsg() call
+
+class ProtocolError(Exception):
+    pass
+
+def is_framed(first_chunk):
+    # Decide from the first bytes a client sends whether it speaks the framed protocol
+    return first_chunk[:1] == bytes([PROTOCOL_VERSION])
+
+def frame_header(length):
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {length} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+    return HEADER.pack(PROTOCOL_VERSION, length)
+
+def encode_frame(payload):
+    return frame_header(len(payload)) + payload
+
+def websocket_header(opcode, length, masked=False):
+    # Every WebSocket message we send is a single frame, so FIN is always set.
+    # Only clients mask their frames; the 4-byte mask itself follows this header.
+    first = 0x80 | opcode
+    mask_bit = 0x80 if masked else 0
+    if length < 126:
+        return bytes([first, mask_bit | length])
+    if length < 65536:
+        return struct.pack('!BBH', first, mask_bit | 126, length)
+    return struct.pack('!BBQ', first, mask_bit | 127, length)
+
+class EncodedMessage:
+    # A message encoded exactly once, however many clients receive it. Every recipient's
+    # queue references the same immutable buffers; framed clients get the header and the
+    # payload as two separate buffers that are gathered by sendmsg() instead of being copied together.
+    __slots__ = ('payload', 'framed', 'raw', 'framed_size', 'raw_size', 'seq', 'author',
+                 '_sequenced', '_binary', '_websocket')
+
+    def __init__(self, text, seq=0, author=None):
+        self.payload = text.encode('utf-8')
+        self.framed = (frame_header(len(self.payload)), self.payload)
+        # Raw-text clients have no frames to tell messages apart, so a line break ends each one.
+        # Without it, everything queued for them while they were busy arrived as one long line.
+        self.raw = (self.payload, b'\n')
+        self.raw_size = len(self.payload) + 1
+        self.framed_size = HEADER.size + len(self.payload)
+        self.seq = seq # History sequence number, 0 for messages that aren't recorded
+        self.author = author # (user id, username, Unix timestamp, body) for chat messages, else None
+        self._sequenced = None
+        self._binary = None
+        self._websocket = None
+
+    def sequenced(self):
+        # Framed form for resuming clients: the payload is prefixed with "<seq> ".
+        # Built the first time such a client needs it; the payload buffer is still shared.
+        if self._sequenced is None:
+            prefix = b'%d ' % self.seq
+            size = len(prefix) + len(self.payload)
+            self._sequenced = ((frame_header(size), prefix, self.payload), HEADER.size + size)
+        return self._sequenced
+
+    def binary(self):
+        # Binary record for clients that negotiated it, built at most once like sequenced()
+        if self._binary is None:
+            if self.author is None:
+                record = TEXT_RECORD.pack(RECORD_TEXT, self.seq) if self.seq else bytes([RECORD_NOTICE])
+                body = self.payload
+            else:
+                user_id, _, sent_at, body = self.author
+                record = CHAT_RECORD.pack(RECORD_CHAT, self.seq, user_id, sent_at)
+                body = body.encode('utf-8')
+            size = len(record) + len(body)
+            self._binary = ((frame_header(size), record, body), HEADER.size + size)
+        return self._binary
+
+    def websocket(self):
+        # WebSocket text frame for browser clients, built at most once like sequenced().
+        # The heartbeat PING becomes a WebSocket ping, which browsers answer by themselves.
+        if self._websocket is None:
+            opcode = WS_PING if self.payload == PING.encode('utf-8') else WS_TEXT
+            header = websocket_header(opcode, len(self.payload))
+            self._websocket = ((header, self.payload), len(header) + len(self.payload))
+        return self._websocket
+
+    def user_record(self):
+        # Framed USER record for the author, sent to a binary client before their first message
+        user_id, username = self.author[:2]
+        return encode_frame(USER_RECORD.pack(RECORD_USER, user_id) + username.encode('utf-8'))
+
+def decode_record(payload, usernames):
+    # Client side of the binary format: returns (seq, text), or None for a USER record,
+    # which only adds a name to `usernames` (user id -> username)
+    kind = payload[0]
+    if kind == RECORD_USER:
+        _, user_id = USER_RECORD.unpack_from(payload)
+        usernames[user_id] = payload[USER_RECORD.size:].decode('utf-8')
+        return None
+    if kind == RECORD_CHAT:
+        _, seq, user_id, sent_at = CHAT_RECORD.unpack_from(payload)
+        username = usernames.get(user_id, f"user{user_id}")
+        body = payload[CHAT_RECORD.size:].decode('utf-8')
+        return seq, f"[{time.strftime('%H:%M:%S', time.localtime(sent_at))}] {username}: {body}"
+    if kind == RECORD_TEXT:
+        _, seq = TEXT_RECORD.unpack_from(payload)
+        return seq, payload[TEXT_RECORD.size:].decode('utf-8')
+    if kind == RECORD_NOTICE:
+        return 0, payload[1:].decode('utf-8')
+    raise ProtocolError(f"Unknown record type {kind}")
+
+def deflate_frames(deflater, buffers):
+    # Compress a batch of frames into the connection's zlib stream. The flush makes the batch
+    # decodable on arrival, and the compressed bytes travel in COMPRESSED_VERSION frames.
+    data = deflater.compress(b''.join(buffers)) + deflater.flush(zlib.Z_SYNC_FLUSH)
+    frames = []
+    for start in range(0, len(data), MAX_FRAME_SIZE):
+        chunk = data[start:start + MAX_FRAME_SIZE]
+        frames += [HEADER.pack(COMPRESSED_VERSION, len(chunk)), chunk]
+    return frames
+
+class FrameDecoder:
+    # Turns an arbitrary stream of received chunks back into whole payloads,
+    # no matter how TCP merged or split them. With inflate=True (clients that negotiated
+    # 'zlib') compressed frames are inflated and the frames inside them returned instead.
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE, inflate=False):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+        self.inflater = zlib.decompressobj() if inflate else None
+        self.inner = FrameDecoder(max_frame_size) if inflate else None
+
+    def feed(self, data):
+        self.buffer += data
+        payloads = []
+        offset = 0
+        while len(self.buffer) - offset >= HEADER.size:
+            version, length = HEADER.unpack_from(self.buffer, offset)
+            compressed = version == COMPRESSED_VERSION and self.inflater is not None
+            if version != PROTOCOL_VERSION and not compressed:
+                raise ProtocolError(f"Unsupported protocol version {version}")
+            if length > self.max_frame_size:
+                raise ProtocolError(f"Frame of {length} bytes exceeds the {self.max_frame_size} byte limit")
+            end = offset + HEADER.size + length
+            if end > len(self.buffer):
+                break # Wait for the rest of this frame
+            payload = bytes(self.buffer[offset + HEADER.size:end])
+            if compressed:
+                payloads.extend(self.inner.feed(self.inflater.decompress(payload)))
+            else:
+                payloads.append(payload)
+            offset = end
+        del self.buffer[:offset]
+        return payloads
+
+    def take_replies(self):
+        return () # Only WebSocketDecoder has control frames to answer
+
+class RawDecoder:
+    # Compatibility mode for the original clients: every received chunk is one message
+    def feed(self, data):
+        return [data] if data else []
+
+    def take_replies(self):
+        return ()
+
+def make_decoder(first_chunk):
+    return FrameDecoder() if is_framed(first_chunk) else RawDecoder()
+
+def send_buffers(sock, buffers):
+    # Write a list of buffers to a blocking socket with as few syscalls as possible
+    if not hasattr(sock, 'sendmsg'): # e.g. Windows: fall back to joining them
+        for data in coalesce(buffers):
+            sock.sendall(data)
+        return
+    buffers = [buffer for buffer in buffers if buffer]
+    i = 0
+    while i < len(buffers):
+        sent = sock.sendmsg(buffers[i:i + IOV_MAX])
+        # Skip past everything that was fully sent and trim a partially sent buffer
+        while sent:
+            size = len(buffers[i])
+            if sent >= size:
+                sent -= size
+                i += 1
+            else:
+                buffers[i] = memoryview(buffers[i])[sent:]
+                sent = 0
+
+def coalesce(frames, limit=COALESCE_LIMIT):
+    # Pack queued frames into as few send() calls as possible, each at most `limit` bytes
+    # (a single frame bigger than the limit is still sent on its own)
+    batch = []
+    size = 0
+    for frame in frames:
+        if batch and size + len(frame) > limit:
+            yield b''.join(batch)
+            batch = []
+            size = 0
+        batch.append(frame)
+        size += len(frame)
+    if batch:
+        yield b''.join(batch)
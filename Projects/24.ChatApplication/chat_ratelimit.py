@@ -0,0 +1,51 @@
+# chat_ratelimit.py
+import time
+
+class TokenBucket:
+    # Allows `rate` messages per second on average, in bursts of up to `burst` messages.
+    # Tokens are refilled lazily from the time elapsed since the last call, so idle
+    # buckets cost nothing and there is no timer to run.
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic() if now is None else now
+
+    def allow(self, now=None, cost=1):
+        if now is None:
+            now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return True
+        return False
+
+class BucketMap:
+    # One TokenBucket per key (e.g. per room), created on first use. Buckets that have
+    # refilled completely are the same as new ones, so they are pruned once the map grows.
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.prune_at = 1024
+
+    def allow(self, key, now=None):
+        if now is None:
+            now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.prune_at:
+                self.prune(now)
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst, now)
+        return bucket.allow(now)
+
+    def prune(self, now):
+        full = now - self.burst / self.rate # Buckets untouched since then have refilled
+        self.buckets = {key: bucket for key, bucket in self.buckets.items() if bucket.updated > full}
+        self.prune_at = max(1024, 2 * len(self.buckets))
+
+    def __len__(self):
+        return len(self.buckets)
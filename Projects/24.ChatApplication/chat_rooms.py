@@ -0,0 +1,48 @@
+# chat_rooms.py
+DEFAULT_ROOM = 'lobby' # Every client starts here
+MAX_ROOM_NAME = 32
+
+_NO_MEMBERS = frozenset()
+
+def valid_room_name(name):
+    return 0 < len(name) <= MAX_ROOM_NAME and not any(c.isspace() for c in name)
+
+class RoomIndex:
+    # Two-way index between rooms and their members. Every client is in exactly one room;
+    # joining, leaving and looking up members are all O(1), so a message only costs work
+    # proportional to the size of the room it is sent to.
+    def __init__(self):
+        self.members = {} # Room name -> set of client sockets
+        self.room_of = {} # Client socket -> room name
+
+    def join(self, client, room):
+        # Move a client into `room` and return the room it was in before (None for new clients)
+        previous = self.room_of.get(client)
+        if previous == room:
+            return previous
+        if previous is not None:
+            self._discard(client, previous)
+        self.members.setdefault(room, set()).add(client)
+        self.room_of[client] = room
+        return previous
+
+    def leave(self, client):
+        # Remove a client from the index entirely and return the room it was in
+        room = self.room_of.pop(client, None)
+        if room is not None:
+            self._discard(client, room)
+        return room
+
+    def members_of(self, room):
+        return self.members.get(room, _NO_MEMBERS)
+
+    def list_rooms(self):
+        # [(room, member count)], biggest rooms first
+        return sorted(((room, len(members)) for room, members in self.members.items()),
+                      key=lambda item: (-item[1], item[0]))
+
+    def _discard(self, client, room):
+        members = self.members[room]
+        members.discard(client)
+        if not members: # Forget empty rooms so they don't pile up
+            del self.members[room]
@@ -0,0 +1,135 @@
+# chat_search.py
+# Full-text search over the message log, with SQLite's FTS5 inverted index. The index is fed
+# the batches the log's writer thread has just written to disk and updates itself on its own
+# thread, so a broadcast never waits for it. The log stays the source of truth: an index that
+# fell behind (crash, first start with an old log) catches up from it on startup.
+import sqlite3
+import threading
+import time
+
+SEARCH = '/search'
+MAX_RESULTS = 10        # Results shown per /search
+RANK_WINDOW = 5000      # Only the newest this many matches are ranked, so common words stay fast
+CATCH_UP_BATCH = 20000  # Log records per transaction while catching up
+SNIPPET_TOKENS = 24     # Words of context around the matches in each result
+
+def room_token(room):
+    # Room names may contain characters the tokenizer splits on; hex makes each one a single word
+    return 'r' + room.encode('utf-8').hex()
+
+def fts_query(room, words):
+    # Every word has to appear, in a message of `room`. Quoting turns FTS5 operators typed by
+    # users into plain words. The room is matched inside the index rather than checked row by
+    # row afterwards, which is what keeps searching one room of a busy server fast.
+    terms = ['"' + word.replace('"', '""') + '"' for word in words.split()]
+    if not terms:
+        return None
+    return f'room : "{room_token(room)}" AND text : ({" ".join(terms)})'
+
+class SearchIndex:
+    # rowid is the message's sequence number, so the index knows how far it got in the log
+    def __init__(self, path):
+        self.path = path
+        self.pending = [] # (seq, ts, room, text) batches from the log writer
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.writer = None   # Connection used only by the indexing thread
+        self.reader = None   # Connection used by searches, one at a time
+        self.read_lock = threading.Lock()
+        self.indexed_seq = 0 # Highest sequence number in the index
+        self.thread = None
+
+    def open(self, log, next_seq):
+        # WAL lets searches read while the indexing thread writes
+        self.writer = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.writer.execute('PRAGMA journal_mode=WAL')
+        self.writer.execute('PRAGMA synchronous=NORMAL') # A lost tail is simply indexed again from the log
+        self.writer.execute("CREATE VIRTUAL TABLE IF NOT EXISTS messages USING "
+                            "fts5(text, room, ts UNINDEXED, tokenize='unicode61 remove_diacritics 2')")
+        row = self.writer.execute('SELECT rowid FROM messages ORDER BY rowid DESC LIMIT 1').fetchone()
+        self.indexed_seq = row[0] if row else 0
+        self.reader = sqlite3.connect(self.path, check_same_thread=False)
+        self.thread = threading.Thread(target=self.index_loop, args=(log, next_seq))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def append(self, records):
+        # Called by the log writer after each batch it wrote
+        with self.lock:
+            self.pending.extend(records)
+        self.wakeup.set()
+
+    def index_loop(self, log, next_seq):
+        # First whatever the log has that the index doesn't, then the new batches as they come
+        if self.indexed_seq < next_seq - 1:
+            started = time.perf_counter()
+            count = self.catch_up(log, next_seq)
+            print(f"[*] Search index caught up with {count} logged messages in {time.perf_counter() - started:.1f}s")
+        while not self.closed:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            self.flush()
+
+    def catch_up(self, log, next_seq):
+        count = 0
+        batch = []
+        for record in log.read_since(self.indexed_seq):
+            if record['seq'] >= next_seq or self.closed: # Newer records come through append()
+                break
+            batch.append((record['seq'], record['ts'], record['room'], record['text']))
+            if len(batch) >= CATCH_UP_BATCH:
+                count += self.add(batch)
+                batch = []
+        return count + self.add(batch)
+
+    def flush(self):
+        with self.lock:
+            records, self.pending = self.pending, []
+        self.add(records)
+
+    def add(self, records):
+        # One transaction per batch: the index is updated once per batch, not once per message
+        records = [record for record in records if record[0] > self.indexed_seq]
+        if not records:
+            return 0
+        try:
+            self.writer.execute('BEGIN')
+            self.writer.executemany('INSERT INTO messages (rowid, text, room, ts) VALUES (?, ?, ?, ?)',
+                                    ((seq, text, room_token(room), ts) for seq, ts, room, text in records))
+            self.writer.execute('COMMIT')
+        except sqlite3.Error as e:
+            print(f"[!] Could not update the search index: {e}")
+            if self.writer.in_transaction:
+                self.writer.execute('ROLLBACK')
+            return 0
+        self.indexed_seq = records[-1][0]
+        return len(records)
+
+    def search(self, room, words, limit=MAX_RESULTS):
+        # Best matches first (bm25), newer first among equally good ones. A word that is in half
+        # of all messages would make bm25 score hundreds of thousands of rows, so only the newest
+        # RANK_WINDOW matches are ranked: walking the index newest first is cheap, scoring isn't.
+        # Returns [(seq, ts, snippet)] with the matching words between asterisks.
+        query = fts_query(room, words)
+        if query is None:
+            return []
+        with self.read_lock:
+            row = self.reader.execute('SELECT rowid FROM messages WHERE messages MATCH ? '
+                                      'ORDER BY rowid DESC LIMIT 1 OFFSET ?', (query, RANK_WINDOW - 1)).fetchone()
+            oldest = row[0] if row else 0
+            return self.reader.execute(
+                "SELECT rowid, ts, snippet(messages, 0, '*', '*', '…', ?) FROM messages "
+                "WHERE messages MATCH ? AND rowid >= ? ORDER BY rank, rowid DESC LIMIT ?",
+                (SNIPPET_TOKENS, query, oldest, limit)).fetchall()
+
+    def close(self):
+        # After the log's close(), so its last batch is indexed too
+        self.closed = True
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+        if self.writer is not None:
+            self.flush()
+            self.writer.close()
+            self.reader.close()
@@ -1,23 +1,160 @@
 # chat_server.py
+import argparse
+import collections
 import socket
 import threading
-import datetime
+import time
+import zlib
+
+from chat_attachments import (ATTACHMENT, CHUNK_HEADER, CHUNK_SIZE, DOWNLOAD, DOWNLOAD_WINDOW, MAX_ATTACHMENT_SIZE,
+                              MAX_STORAGE, MAX_UPLOADS, UPLOAD, AttachmentStore, Download, format_size, is_chunk,
+                              parse_chunk)
+from chat_history import ChatHistory, DEFAULT_REPLAY
+from chat_metrics import Metrics, SampledLog, start_metrics_server
+from chat_outbound import OutboundQueue, DEFAULT_MAX_BYTES, DROP_OLDEST, SLOW_CONSUMER_POLICIES
+from chat_protocol import (FEATURES, HEADER, HELLO, MAX_FRAME_SIZE, NEGOTIABLE_FEATURES, PING, PONG, RECORD_USER, USER_RECORD,
+                           WELCOME, WS_BINARY, EncodedMessage, FrameDecoder, ProtocolError, deflate_frames,
+                           frame_header, make_decoder, send_buffers, websocket_header)
+from chat_ratelimit import BucketMap, TokenBucket
+from chat_rooms import DEFAULT_ROOM, RoomIndex, valid_room_name
+from chat_search import SEARCH
+from chat_timers import TimerWheel
+from chat_websocket import WebSocketDecoder, is_websocket
 
 HOST = '127.0.0.1'  # Standard loopback interface address (localhost)
 PORT = 65432        # Port to listen on (non-privileged ports are > 1023)
+HEARTBEAT_INTERVAL = 30.0 # Ping framed clients that have been silent this long (seconds)
+IDLE_TIMEOUT = 90.0       # Drop framed clients that have been silent this long, even after a ping
+RATE_LIMIT = 20.0         # Messages per second a client may send on average (0 disables the limit)
+BURST = 40                # ...and in a burst
+ROOM_BURST = 100          # Burst allowed per room when --room-rate-limit is set
+THROTTLE_NOTICE_INTERVAL = 5.0 # Seconds between "too fast" notices to the same client
+MAX_DEPARTED = 10000      # Resumable clients remembered after their leave notice, to announce their return
+MESSAGE_HEADROOM = 256    # Frame bytes kept for what goes around a chat message: "[HH:MM:SS] " and ": ",
+                          # the "<seq> " of resuming clients, and the room on the cluster bus
+
+_timestamp_cache = (None, "")
+
+def timestamp(now=None):
+    # Formatting the time is relatively slow, so a burst of messages within the same second reuses one string
+    global _timestamp_cache
+    if now is None:
+        now = int(time.time())
+    if _timestamp_cache[0] != now:
+        _timestamp_cache = (now, time.strftime("%H:%M:%S", time.localtime(now)))
+    return _timestamp_cache[1]
+
+class ClientConnection:
+    # Per-client state the server keeps next to the client's socket
+    def __init__(self, address, queue, framed, features=frozenset(), websocket=False):
+        self.address = address
+        self.queue = queue # OutboundQueue of messages waiting to be sent
+        self.framed = framed # True for clients that send whole messages, False for the old raw-text clients
+        self.websocket = websocket # Browser clients, framed by WebSocket instead of our own protocol
+        # Raw-text and WebSocket clients can't negotiate anything
+        self.features = features if framed and not websocket else frozenset()
+        self.sequenced = 'seq' in self.features # Resuming clients get "<seq> " in front of every message
+        self.binary = 'binary' in self.features # Binary records instead of text (see chat_protocol.py)
+        self.known_users = set() # User ids whose USER record was queued for this binary client
+        if self.binary:
+            queue.on_drop = self.forget_users
+        self.deflater = zlib.compressobj() if 'zlib' in self.features else None # This connection's zlib stream
+        self.last_activity = time.monotonic() # Updated on every receive, checked lazily by the timer wheel
+        self.bucket = None # TokenBucket limiting what this client may send, when rate limiting is on
+        self.throttled = 0 # Messages dropped by the rate limits
+        self.throttle_notice = 0.0 # When the client was last told it is too fast
+        self.uploads = {} # Client's upload id -> Upload in progress
+        self.downloads = collections.deque() # Downloads waiting for room in the queue, oldest first
+
+    def encoded(self, message):
+        # The already-encoded form of an EncodedMessage that this client understands, and its size
+        if self.websocket:
+            return message.websocket()
+        if self.binary:
+            buffers, size = message.binary()
+            if message.author is not None and message.author[0] not in self.known_users:
+                self.known_users.add(message.author[0])
+                user = message.user_record()
+                return (user,) + buffers, len(user) + size
+            return buffers, size
+        if self.sequenced:
+            return message.sequenced()
+        if self.framed:
+            return message.framed, message.framed_size
+        return message.raw, message.raw_size
+
+    def forget_users(self, frames):
+        # A USER record that drop-oldest threw away never reaches the client: the user is
+        # introduced again with their next message. Called from put(), which for a binary client
+        # always runs under the server lock, like encoded() that reads and fills known_users.
+        # Only a USER record is queued as a whole frame in the first buffer, everything else
+        # starts with a bare frame header.
+        for frame in frames:
+            first = frame[0]
+            if len(first) > HEADER.size and first[HEADER.size] == RECORD_USER:
+                self.known_users.discard(USER_RECORD.unpack_from(first, HEADER.size)[1])
+
+    def enqueue(self, message):
+        return self.queue.put(*self.encoded(message))
+
+    def chunk(self, attachment_id, data):
+        # Attachment chunk frame for this client. The data buffer is queued as it is, not copied.
+        header = CHUNK_HEADER.pack(0, attachment_id)
+        size = len(header) + len(data)
+        frame = websocket_header(WS_BINARY, size) if self.websocket else frame_header(size)
+        return (frame, header, data), len(frame) + size
+
+    def wire(self, buffers):
+        # What actually goes on the socket for a batch taken from the queue. Compression works on
+        # whole batches, so it is the only per-recipient encoding cost and only for clients that asked.
+        if self.deflater is None:
+            return buffers
+        return deflate_frames(self.deflater, buffers)
 
 class ChatServer:
-    def __init__(self, host, port):
+    def __init__(self, host, port, max_backlog=DEFAULT_MAX_BYTES, slow_consumer=DROP_OLDEST, reuse_port=False,
+                 history_dir=None, replay=DEFAULT_REPLAY, search=True, metrics_port=None, log_interval=1.0,
+                 heartbeat_interval=HEARTBEAT_INTERVAL, idle_timeout=IDLE_TIMEOUT,
+                 rate_limit=RATE_LIMIT, burst=BURST, room_rate_limit=0, room_burst=ROOM_BURST,
+                 attachment_dir=None, max_attachment=MAX_ATTACHMENT_SIZE, max_attachment_storage=MAX_STORAGE):
         self.host = host
         self.port = port
-        self.clients = []  # List to store connected client sockets and their addresses
+        self.reuse_port = reuse_port # Let several server processes share the port (see chat_cluster.py)
+        self.bus = None # BusClient relaying broadcasts to the other workers of a cluster
+        self.clients = set()  # Set of connected client sockets (O(1) to add and remove)
         self.usernames = {} # Dictionary to store socket -> username mapping
-        self.lock = threading.Lock() # Lock to protect shared resources (clients, usernames)
+        self.connections = {} # Dictionary to store socket -> ClientConnection
+        self.user_ids = {} # Socket -> numeric user id, what binary clients receive instead of the username
+        self.next_user_id = 1 # Never reused, so a client's interned usernames stay valid
+        self.departed = {} # Username -> room of resumable clients that dropped, oldest first (see remove_client())
+        self.rooms = RoomIndex() # Which room each client is in, and who is in each room
+        # Recent messages per room, optionally logged to disk and indexed for /search
+        self.history = ChatHistory(history_dir, replay, search)
+        self.max_backlog = max_backlog # Bytes a client may fall behind before the slow-consumer policy applies
+        self.slow_consumer = slow_consumer # DROP_OLDEST or DISCONNECT
+        self.lock = threading.Lock() # Lock to protect shared resources (clients, usernames, connections, rooms)
+        self.metrics = Metrics() # Counters and histograms, served over HTTP when metrics_port is set
+        self.metrics_port = metrics_port
+        self.log_message = SampledLog(log_interval) # Printing every message would cost more than relaying it
+        self.heartbeat_interval = heartbeat_interval # 0 disables heartbeats and idle detection
+        self.idle_timeout = idle_timeout
+        self.timers = TimerWheel() # Next heartbeat check for every framed client
+        # Token buckets checked before anything is broadcast, so a flooding client or room
+        # can only cause a bounded amount of fan-out work
+        self.rate_limit = rate_limit
+        self.burst = burst
+        self.room_buckets = BucketMap(room_rate_limit, room_burst) if room_rate_limit else None
+        self.attachment_dir = attachment_dir # None: a temporary directory, removed on shutdown
+        self.max_attachment = max_attachment
+        self.max_attachment_storage = max_attachment_storage
+        self.attachments = None # AttachmentStore, created in start_services()
 
     def start(self):
         # Create a TCP/IP socket
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # Allow reuse of address
+        if self.reuse_port:
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1) # Kernel balances accepts across workers
         
         try:
             self.server_socket.bind((self.host, self.port))
@@ -28,10 +165,13 @@ class ChatServer:
             self.server_socket.close()
             return
 
+        self.start_services()
+
         # Start accepting client connections in a loop
         while True:
             try:
                 client_socket, client_address = self.server_socket.accept()
+                client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1) # Let the OS notice dead peers too
                 print(f"[*] Accepted connection from {client_address}")
                 # Start a new thread to handle this client
                 client_handler = threading.Thread(target=self.handle_client, args=(client_socket, client_address))
@@ -44,21 +184,89 @@ class ChatServer:
             except Exception as e:
                 print(f"[!] Error accepting connection: {e}")
                 
+    def start_services(self):
+        # Everything besides client connections, started by both engines once the port is bound
+        self.history.open(EncodedMessage)
+        self.attachments = AttachmentStore(self.attachment_dir, self.max_attachment, self.max_attachment_storage)
+        if self.bus:
+            self.bus.connect(self.relay_from_bus)
+        self.metrics.start_rate_sampler()
+        if self.metrics_port:
+            start_metrics_server(self, self.metrics_port)
+        if self.heartbeat_interval:
+            self.start_heartbeats()
+
+    def start_heartbeats(self):
+        def tick():
+            while True:
+                time.sleep(self.timers.tick)
+                self.check_heartbeats()
+        ticker = threading.Thread(target=tick)
+        ticker.daemon = True
+        ticker.start()
+
+    def check_heartbeats(self):
+        # Only the clients whose timer came due are looked at, never the whole client list.
+        # Activity just updates last_activity; a timer that fires early is simply re-armed.
+        now = time.monotonic()
+        to_ping = []
+        to_drop = []
+        with self.lock:
+            for client_socket in self.timers.advance(now):
+                connection = self.connections.get(client_socket)
+                if connection is None:
+                    continue
+                idle = now - connection.last_activity
+                if idle >= self.idle_timeout:
+                    to_drop.append(client_socket)
+                    continue
+                if idle >= self.heartbeat_interval:
+                    to_ping.append(client_socket)
+                    next_check = connection.last_activity + self.idle_timeout
+                else:
+                    next_check = connection.last_activity + self.heartbeat_interval
+                self.timers.schedule(client_socket, now, next_check - now)
+        for client_socket in to_ping:
+            self.send_to(client_socket, PING)
+        if to_drop:
+            print(f"[*] Dropping {len(to_drop)} idle client(s).")
+            self.metrics.inc('idle_clients_dropped', len(to_drop))
+        for client_socket in to_drop:
+            self.drop_connection(client_socket)
+
     def handle_client(self, client_socket, client_address):
         # First, get the username from the client
         try:
-            username_bytes = client_socket.recv(1024)
-            username = username_bytes.decode('utf-8').strip()
-            if not username:
-                username = f"Guest-{client_address[1]}" # Fallback for empty username
-            
-            with self.lock:
-                self.clients.append(client_socket)
-                self.usernames[client_socket] = username
-                print(f"[*] {username} ({client_address}) has joined the chat.")
-            
-            # Announce new user to everyone
-            self.broadcast(f"📢 {username} has joined the chat.")
+            first_chunk = client_socket.recv(1024)
+            if not first_chunk: # Connected and left without saying anything
+                client_socket.close()
+                return
+            # Framed clients start with the protocol version byte, browsers with a WebSocket
+            # upgrade request, anything else is a raw-text client
+            decoder = WebSocketDecoder() if is_websocket(first_chunk) else make_decoder(first_chunk)
+            pending = decoder.feed(first_chunk)
+            while not pending: # A framed username may arrive in several pieces
+                for reply in decoder.take_replies(): # The WebSocket handshake response
+                    client_socket.sendall(reply)
+                chunk = client_socket.recv(1024)
+                if not chunk:
+                    raise ConnectionError("disconnected before sending a username")
+                pending = decoder.feed(chunk)
+            username, features, resume = self.parse_handshake(pending.pop(0).decode('utf-8'), client_address)
+            missed = self.read_missed(resume) # Before add_client() takes the lock: this may read the log
+
+            # Outgoing messages are queued and written by a dedicated sender thread,
+            # so a slow reader never blocks the clients broadcasting to it
+            ready = threading.Event()
+            queue = OutboundQueue(self.max_backlog, self.slow_consumer, on_ready=ready.set)
+            websocket = isinstance(decoder, WebSocketDecoder)
+            connection = ClientConnection(client_address, queue, websocket or isinstance(decoder, FrameDecoder),
+                                          features, websocket)
+            sender = threading.Thread(target=self.send_loop, args=(client_socket, connection, ready))
+            sender.daemon = True
+            sender.start()
+
+            self.add_client(client_socket, username, connection, resume, missed)
 
         except Exception as e:
             print(f"[!] Error receiving username from {client_address}: {e}")
@@ -68,14 +276,18 @@ class ChatServer:
         # Now, handle messages from this client
         while True:
             try:
-                message = client_socket.recv(4096).decode('utf-8')
-                if not message: # Client disconnected
+                for payload in pending:
+                    self.handle_payload(client_socket, payload)
+                data = client_socket.recv(65536)
+                if not data: # Client disconnected
                     break
-                
-                timestamp = datetime.datetime.now().strftime("%H:%M:%S")
-                formatted_message = f"[{timestamp}] {self.usernames[client_socket]}: {message}"
-                print(f"Received from {self.usernames[client_socket]} ({client_address}): {message.strip()}")
-                self.broadcast(formatted_message, sender_socket=client_socket)
+                connection.last_activity = time.monotonic()
+                pending = decoder.feed(data)
+                for reply in decoder.take_replies(): # WebSocket pongs and the closing handshake
+                    connection.queue.put((reply,), len(reply))
+            except ProtocolError as e: # Garbage on a framed connection, can't resynchronise
+                print(f"[!] Protocol error from {self.usernames.get(client_socket, 'Unknown')} ({client_address}): {e}")
+                break
             except ConnectionResetError: # Client forcefully disconnected
                 print(f"[*] {self.usernames.get(client_socket, 'Unknown')} ({client_address}) disconnected forcefully.")
                 break
@@ -88,41 +300,515 @@ class ChatServer:
 
         # Client disconnected or error occurred, clean up
         self.remove_client(client_socket)
-        
-    def broadcast(self, message, sender_socket=None):
+
+    def parse_handshake(self, text, client_address):
+        # The first message is the username, or HELLO from a client that resumes by sequence number,
+        # either of them optionally preceded by the FEATURES the client would like to use.
+        # Returns (username, features, resume) where resume is (epoch, last seq, room) or None.
+        features = set()
+        resume = None
+        if text.startswith(FEATURES + ' '):
+            fields = text.split(' ', 2)
+            if len(fields) == 3:
+                features.update(NEGOTIABLE_FEATURES.intersection(fields[1].split(',')))
+                text = fields[2]
+        if text.startswith(HELLO + ' '):
+            fields = text.split(' ', 4)
+            if len(fields) == 5 and fields[2].isdigit() and valid_room_name(fields[3]):
+                features.add('seq')
+                epoch, last_seq, room, text = fields[1:]
+                if epoch != '-': # '-' is a client that hasn't seen any message yet
+                    resume = (epoch, int(last_seq), room)
+        username = text.strip()
+        if not username:
+            username = f"Guest-{client_address[1]}" # Fallback for empty username
+        return username, frozenset(features), resume
+
+    def read_missed(self, resume):
+        # The part of a resuming client's backlog that has to be read from the message log, or None.
+        # Never called with the lock held: reading the log would stall every broadcast meanwhile.
+        if resume is None or resume[0] != self.history.epoch:
+            return None
+        epoch, last_seq, room = resume
+        return self.history.read_missed(room, last_seq)
+
+    def add_client(self, client_socket, username, connection, resume=None, missed=None):
+        # Shared by both engines once the username handshake is done
+        returning = False
         with self.lock:
-            for client_socket in self.clients:
+            self.clients.add(client_socket)
+            self.usernames[client_socket] = username
+            self.connections[client_socket] = connection
+            if self.rate_limit:
+                connection.bucket = TokenBucket(self.rate_limit, self.burst)
+            self.user_ids[client_socket] = self.next_user_id
+            self.next_user_id += 1
+            negotiated = connection.features & NEGOTIABLE_FEATURES
+            # Pinned: a big replay or resume queued right after them must not push them out
+            if negotiated: # Plain text and always first, so the client knows how to read everything after it
+                connection.queue.pin(EncodedMessage(f"{FEATURES} {','.join(sorted(negotiated))}").framed)
+            if connection.sequenced:
+                connection.queue.pin(connection.encoded(EncodedMessage(f"{WELCOME} {self.history.epoch}"))[0])
+            if resume is None:
+                self.rooms.join(client_socket, DEFAULT_ROOM)
+                self.replay_history(client_socket, DEFAULT_ROOM)
+            else:
+                self.rooms.join(client_socket, resume[2])
+                self.resume_history(client_socket, *resume, missed)
+                returning = self.departed.pop(username, None) is not None
+            if self.heartbeat_interval and connection.framed: # Raw-text clients can't answer pings
+                self.timers.schedule(client_socket, time.monotonic(), self.heartbeat_interval)
+            print(f"[*] {username} ({connection.address}) has {'joined' if resume is None else 'reconnected to'} the chat.")
+        if resume is not None:
+            # No join announcement: after a restart every client comes back at once, and a join
+            # message per client would be a broadcast to the whole room each. Only a client whose
+            # leave was announced by this server gets one, so the room knows it is back.
+            self.metrics.inc('resumed_sessions')
+            if returning:
+                self.broadcast(f"🔌 {username} is back.", sender_socket=client_socket, room=resume[2])
+            return
+        self.metrics.inc('connections')
+
+        # Announce new user to everyone in the lobby
+        self.broadcast(f"📢 {username} has joined the chat.", room=DEFAULT_ROOM)
+
+    def handle_payload(self, client_socket, payload):
+        # Everything a client sends arrives here: an attachment chunk or a text message
+        if is_chunk(payload) and self.connections[client_socket].framed:
+            self.handle_chunk(client_socket, payload)
+        else:
+            self.handle_message(client_socket, payload.decode('utf-8'))
+
+    def handle_chunk(self, client_socket, payload):
+        # Chunks skip the message rate limit, a dropped chunk would break the file. What they can
+        # cost is bounded instead: max_attachment per upload, MAX_UPLOADS per client at a time and
+        # max_attachment_storage in all, reserved when the upload is announced.
+        connection = self.connections[client_socket]
+        upload_id, data = parse_chunk(payload)
+        upload = connection.uploads.get(upload_id)
+        if upload is None:
+            return # Left over from an upload that was refused or aborted
+        if upload.received + len(data) > upload.size:
+            del connection.uploads[upload_id]
+            self.attachments.abort(upload)
+            self.send_to(client_socket, f"Upload {upload_id} is bigger than announced and was aborted.")
+            return
+        if upload.write(data):
+            del connection.uploads[upload_id]
+            self.share_attachment(client_socket, upload)
+
+    def share_attachment(self, client_socket, upload):
+        # Only a reference goes to the room; recipients download the file if they want it.
+        # Not relayed to the other workers of a cluster: the file and its id only exist in this
+        # worker's store, so their clients couldn't download it.
+        attachment = self.attachments.finish(upload)
+        self.metrics.inc('attachments_uploaded')
+        self.metrics.inc('attachment_bytes_uploaded', attachment.size)
+        room = self.rooms.room_of.get(client_socket, DEFAULT_ROOM)
+        self.send_to(client_socket, f"Uploaded {attachment.name} as attachment {attachment.attachment_id}.")
+        self.broadcast(f"[{timestamp()}] 📎 {self.usernames[client_socket]} shared {attachment.name} "
+                       f"({format_size(attachment.size)}). Type {DOWNLOAD} {attachment.attachment_id} to get it.",
+                       sender_socket=client_socket, room=room, relay=False, record=True)
+
+    def start_upload(self, client_socket, argument):
+        connection = self.connections[client_socket]
+        fields = argument.split(' ', 2)
+        if not connection.framed or len(fields) != 3 or not fields[0].isdigit() or not fields[1].isdigit():
+            self.send_to(client_socket, f"Usage: {UPLOAD} <upload id> <size> <name> (framed clients only)")
+            return
+        upload_id, size, name = int(fields[0]), int(fields[1]), fields[2].strip()
+        if size > self.max_attachment:
+            self.send_to(client_socket, f"Attachments are limited to {format_size(self.max_attachment)}.")
+        elif len(connection.uploads) >= MAX_UPLOADS or upload_id in connection.uploads:
+            self.send_to(client_socket, f"Finish your other uploads first (at most {MAX_UPLOADS} at a time).")
+        else:
+            upload = self.attachments.begin(name, size)
+            if upload is None:
+                self.metrics.inc('attachments_refused')
+                self.send_to(client_socket, "There is no room left for attachments on this server.")
+            elif size == 0:
+                self.share_attachment(client_socket, upload)
+            else:
+                connection.uploads[upload_id] = upload
+
+    def start_download(self, client_socket, argument):
+        connection = self.connections[client_socket]
+        attachment = self.attachments.get(int(argument)) if argument.isdigit() else None
+        if not connection.framed:
+            self.send_to(client_socket, "Downloads need a framed client.")
+        elif attachment is None:
+            self.send_to(client_socket, f"Usage: {DOWNLOAD} <attachment id>")
+        else:
+            self.send_to(client_socket, f"{ATTACHMENT} {attachment.attachment_id} {attachment.size} {attachment.name}")
+            connection.downloads.append(Download(attachment))
+            connection.queue.on_ready() # The sender pulls the chunks in as the queue drains
+
+    def pump_downloads(self, connection):
+        # Called by the client's sender before each write: tops the queue up with the next
+        # chunks of the client's downloads, so a file only ever has DOWNLOAD_WINDOW bytes queued
+        # and chat messages broadcast in between go out between its chunks.
+        while connection.downloads and connection.queue.pending_bytes < DOWNLOAD_WINDOW:
+            download = connection.downloads[0]
+            data = download.file.read(CHUNK_SIZE) # Read outside the lock, a slow disk doesn't hold up broadcasts
+            with self.lock: # This put may drop a USER record, and forget_users() changes known_users
+                # Drop-oldest may throw data chunks away (the client then sees the file is short),
+                # but never the empty chunk that tells the client the file is complete
+                connection.queue.put(*connection.chunk(download.attachment.attachment_id, data), keep=not data)
+            if not data:
+                download.file.close()
+                connection.downloads.popleft()
+                self.metrics.inc('attachments_downloaded')
+
+    def abort_uploads(self, connection):
+        # Uploads belong to the receiving side, downloads to the sender (see close_downloads())
+        for upload in connection.uploads.values():
+            self.attachments.abort(upload)
+        connection.uploads.clear()
+
+    def close_downloads(self, connection):
+        for download in connection.downloads:
+            download.file.close()
+        connection.downloads.clear()
+
+    def handle_message(self, client_socket, message):
+        connection = self.connections[client_socket]
+        # Commands count too (/join broadcasts to two rooms), heartbeat answers don't
+        if connection.bucket is not None and message.strip() != PONG and not connection.bucket.allow():
+            self.throttle(client_socket, connection, 'throttled_messages')
+            return
+        if message.startswith('/'):
+            self.handle_command(client_socket, message.strip())
+            return
+        username = self.usernames[client_socket]
+        # A message that arrived in a legal frame must still fit in one once the username and
+        # the timestamp are added, or encoding the broadcast would fail and drop the sender
+        limit = MAX_FRAME_SIZE - MESSAGE_HEADROOM - len(username.encode('utf-8'))
+        if len(message) * 4 > limit and len(message.encode('utf-8')) > limit: # UTF-8 needs at most 4 bytes a character
+            self.metrics.inc('oversize_messages')
+            self.send_to(client_socket, f"⚠️ Your message is too long to send, the limit is {max(limit, 0)} bytes.")
+            return
+        room = self.rooms.room_of.get(client_socket, DEFAULT_ROOM)
+        if self.room_buckets is not None:
+            with self.lock:
+                allowed = self.room_buckets.allow(room)
+            if not allowed:
+                self.throttle(client_socket, connection, 'throttled_room_messages')
+                return
+        self.metrics.inc('messages_in')
+        now = int(time.time())
+        formatted_message = f"[{timestamp(now)}] {username}: {message}"
+        self.log_message(f"Received from {username} ({connection.address}) in #{room}: {message.strip()}")
+        # Binary clients get the parts instead of the formatted text (see EncodedMessage.binary)
+        author = (self.user_ids[client_socket], username, now, message)
+        self.broadcast(formatted_message, sender_socket=client_socket, room=room, record=True, author=author)
+
+    def throttle(self, client_socket, connection, counter):
+        # The message is dropped. The sender is told at most every THROTTLE_NOTICE_INTERVAL
+        # seconds, so the notices can't turn into a flood of their own.
+        connection.throttled += 1
+        self.metrics.inc(counter)
+        now = time.monotonic()
+        if now - connection.throttle_notice >= THROTTLE_NOTICE_INTERVAL:
+            connection.throttle_notice = now
+            self.send_to(client_socket, "⚠️ You are sending messages too fast, some of them were dropped.")
+
+    def handle_command(self, client_socket, text):
+        command, _, argument = text.partition(' ')
+        argument = argument.strip()
+        if command == '/join':
+            if not valid_room_name(argument):
+                self.send_to(client_socket, "Usage: /join <room> (up to 32 characters, no spaces)")
+            else:
+                self.change_room(client_socket, argument)
+        elif command == '/leave':
+            self.change_room(client_socket, DEFAULT_ROOM)
+        elif command == UPLOAD:
+            self.start_upload(client_socket, argument)
+        elif command == DOWNLOAD:
+            self.start_download(client_socket, argument)
+        elif command == SEARCH:
+            self.search_history(client_socket, argument)
+        elif command == PING:
+            self.send_to(client_socket, PONG)
+        elif command == PONG:
+            pass # Answer to our heartbeat, receiving it already counted as activity
+        elif command == '/rooms':
+            with self.lock:
+                rooms = self.rooms.list_rooms()
+            self.send_to(client_socket, "Rooms: " + ", ".join(f"#{room} ({count})" for room, count in rooms))
+        else:
+            self.send_to(client_socket, f"Unknown command {command}. "
+                                        f"Try /join <room>, /leave, /rooms, {SEARCH} <words> or {DOWNLOAD} <id>.")
+
+    def search_history(self, client_socket, words):
+        # Searches the client's current room. The index is read on its own SQLite connection,
+        # so searching never holds the server lock.
+        room = self.rooms.room_of.get(client_socket, DEFAULT_ROOM)
+        if not words:
+            self.send_to(client_socket, f"Usage: {SEARCH} <words> (searches the messages of your room)")
+            return
+        self.run_search(client_socket, room, words)
+
+    def run_search(self, client_socket, room, words):
+        self.send_search_results(client_socket, room, words, *self.timed_search(room, words))
+
+    def timed_search(self, room, words):
+        started = time.perf_counter()
+        results = self.history.search(room, words)
+        return results, time.perf_counter() - started
+
+    def send_search_results(self, client_socket, room, words, results, elapsed):
+        if results is None:
+            self.send_to(client_socket, "Search needs the message log (start the server with --history-dir).")
+            return
+        self.metrics.inc('searches')
+        self.metrics.observe('search', elapsed)
+        lines = [f"🔎 {len(results)} result(s) for '{words}' in #{room} ({elapsed * 1000:.1f} ms)"]
+        for _, ts, snippet in results:
+            lines.append(f"  {time.strftime('%Y-%m-%d', time.localtime(ts))} {snippet}")
+        self.send_to(client_socket, "\n".join(lines))
+
+    def change_room(self, client_socket, room):
+        username = self.usernames[client_socket]
+        with self.lock:
+            previous = self.rooms.join(client_socket, room)
+            if previous != room:
+                self.replay_history(client_socket, room)
+        if previous == room:
+            self.send_to(client_socket, f"You are already in #{room}.")
+            return
+        self.broadcast(f"👋 {username} left #{previous}.", room=previous)
+        self.broadcast(f"📢 {username} joined #{room}.", sender_socket=client_socket, room=room)
+        self.send_to(client_socket, f"You are now in #{room}.")
+
+    def send_loop(self, client_socket, connection, ready):
+        # Runs in the client's sender thread: drains its outbound queue onto the socket
+        queue = connection.queue
+        while True:
+            ready.wait()
+            ready.clear()
+            if queue.closed:
+                break
+            try:
+                self.pump_downloads(connection)
+                # Everything that piled up since the last wakeup goes out in one gather write
+                send_buffers(client_socket, connection.wire(queue.take_all()))
+                if connection.downloads:
+                    ready.set() # More chunks to send once these are out
+            except OSError as e:
+                if not queue.closed: # Otherwise the client is already being removed
+                    print(f"[!] Error sending to {self.usernames.get(client_socket, 'Unknown')}: {e}")
+                self.drop_connection(client_socket)
+                break
+        self.close_downloads(connection)
+
+    def broadcast(self, message, sender_socket=None, room=None, relay=True, record=False, author=None):
+        # Sends to everyone in `room`, or to every connected client when no room is given.
+        # Only enqueues: the sender threads do the actual (possibly slow) socket writes.
+        # The message is encoded once and every recipient shares the same buffers.
+        # Chat messages (record=True) are also kept in the room's history.
+        started = time.perf_counter()
+        if relay and self.bus:
+            self.bus.publish(room, message, record) # Clients connected to the other workers get it too
+        text = message
+        message = EncodedMessage(text, author=author)
+        slow_consumers = []
+        with self.lock:
+            if record and room is not None:
+                self.history.record(room, text, message)
+            recipients = self.clients if room is None else self.rooms.members_of(room)
+            sent = 0
+            for client_socket in recipients:
                 if client_socket != sender_socket: # Don't send back to the sender
-                    try:
-                        client_socket.sendall(message.encode('utf-8'))
-                    except Exception as e:
-                        print(f"[!] Error broadcasting to a client: {e}")
-                        # Optionally, remove client if send fails consistently
-                        # self.remove_client(client_socket) # This would require careful handling with current iteration
-    
+                    sent += 1
+                    if not self.connections[client_socket].enqueue(message):
+                        slow_consumers.append(client_socket)
+        self.metrics.inc('messages_out', sent)
+        self.metrics.observe('broadcast', time.perf_counter() - started)
+        self.drop_slow_consumers(slow_consumers)
+
+    def relay_from_bus(self, room, message, record):
+        # A broadcast that happened on another worker of the cluster
+        self.broadcast(message, room=room, relay=False, record=record)
+
+    def replay_history(self, client_socket, room):
+        # Called with the lock held right after the client joined `room`, so no live message
+        # can slip in between the replayed ones. The messages are already encoded.
+        connection = self.connections[client_socket]
+        for message in self.history.recent(room):
+            connection.enqueue(message)
+
+    def resume_history(self, client_socket, epoch, last_seq, room, missed=None):
+        # Like replay_history(), but only the messages the client missed while it was away:
+        # `missed` from read_missed(), then the ring buffer. A sequence number from another epoch
+        # (a restart without a message log, another worker of a cluster) means nothing here,
+        # so that client gets the usual replay.
+        if epoch != self.history.epoch:
+            self.replay_history(client_socket, room)
+            return
+        connection = self.connections[client_socket]
+        messages, complete = self.history.since(room, last_seq, missed)
+        if not complete: # e.g. the room was so busy that messages left the ring while the log was read
+            connection.enqueue(EncodedMessage("⚠️ Some messages from while you were away could not be replayed."))
+        for message in messages:
+            connection.enqueue(message)
+
+    def send_to(self, client_socket, message):
+        # Private reply to a single client (command results, errors)
+        with self.lock:
+            connection = self.connections.get(client_socket)
+            if connection is None or connection.enqueue(EncodedMessage(message)):
+                return
+        self.drop_slow_consumers([client_socket])
+
+    def drop_slow_consumers(self, slow_consumers):
+        if slow_consumers:
+            self.metrics.inc('slow_consumers_dropped', len(slow_consumers))
+        for client_socket in slow_consumers:
+            print(f"[!] {self.usernames.get(client_socket, 'Unknown')} is too slow, disconnecting.")
+            self.drop_connection(client_socket)
+
+    def drop_connection(self, client_socket):
+        # Wake up the client's receive loop so it cleans up through remove_client()
+        try:
+            client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass # Already closed
+
     def remove_client(self, client_socket):
         with self.lock:
-            if client_socket in self.clients:
-                self.clients.remove(client_socket)
-                username = self.usernames.pop(client_socket, "Unknown User")
-                client_socket.close()
-                print(f"[*] {username} has left the chat.")
-                self.broadcast(f"💔 {username} has left the chat.")
+            if client_socket not in self.clients:
+                return
+            self.clients.discard(client_socket)
+            room = self.rooms.leave(client_socket)
+            self.timers.cancel(client_socket)
+            username = self.usernames.pop(client_socket, "Unknown User")
+            self.user_ids.pop(client_socket, None)
+            connection = self.connections.pop(client_socket)
+            connection.queue.close() # Also stops the sender thread
+            client_socket.close()
+            if connection.sequenced: # It will probably resume: announce its return then
+                self.departed.pop(username, None)
+                self.departed[username] = room
+                if len(self.departed) > MAX_DEPARTED:
+                    del self.departed[next(iter(self.departed))]
+        self.abort_uploads(connection)
+        self.metrics.inc('disconnections')
+        print(f"[*] {username} has left the chat.")
+        self.broadcast(f"💔 {username} has left the chat.", room=room) # Outside the lock: broadcast takes it again
+
+    def metrics_snapshot(self):
+        # Totals for GET /metrics. Reading the queue sizes needs no lock: a slightly stale number is fine.
+        with self.lock:
+            connections = list(self.connections.values())
+            rooms = len(self.rooms.members)
+        snapshot = self.metrics.snapshot()
+        snapshot['gauges'] = {
+            'connected_clients': len(connections),
+            'rooms': rooms,
+            'queued_bytes': sum(connection.queue.pending_bytes for connection in connections),
+            'queued_messages': sum(len(connection.queue) for connection in connections),
+            'max_client_queue_bytes': max((connection.queue.pending_bytes for connection in connections), default=0),
+            'dropped_messages': sum(connection.queue.dropped for connection in connections),
+        }
+        return snapshot
+
+    def client_snapshot(self, limit=100):
+        # Per-client queue depths for GET /clients, deepest queues first
+        with self.lock:
+            clients = [(self.usernames.get(client_socket), self.rooms.room_of.get(client_socket), connection)
+                       for client_socket, connection in self.connections.items()]
+        clients.sort(key=lambda client: client[2].queue.pending_bytes, reverse=True)
+        return [{
+            'username': username,
+            'address': str(connection.address),
+            'room': room,
+            'framed': connection.framed,
+            'websocket': connection.websocket,
+            'features': sorted(connection.features),
+            'queued_bytes': connection.queue.pending_bytes,
+            'queued_messages': len(connection.queue),
+            'dropped_messages': connection.queue.dropped,
+            'throttled_messages': connection.throttled,
+        } for username, room, connection in clients[:limit]]
 
     def shutdown(self):
         print("[*] Shutting down server...")
         with self.lock:
+            goodbye = EncodedMessage("Server is shutting down. Goodbye!")
             for client_socket in self.clients:
+                connection = self.connections[client_socket]
+                connection.queue.close()
                 try:
-                    client_socket.sendall("Server is shutting down. Goodbye!".encode('utf-8'))
+                    send_buffers(client_socket, connection.wire(list(connection.encoded(goodbye)[0])))
                     client_socket.close()
                 except Exception as e:
                     print(f"Error closing client socket during shutdown: {e}")
             self.clients.clear()
             self.usernames.clear()
+            self.user_ids.clear()
+            self.connections.clear()
+            self.rooms = RoomIndex()
+            self.timers = TimerWheel()
         self.server_socket.close()
+        self.history.close()
+        if self.attachments is not None:
+            self.attachments.close()
+        if self.bus:
+            self.bus.close()
         print("[*] Server shut down successfully.")
 
+def create_server(engine, host, port, **options):
+    if engine == 'asyncio':
+        from chat_server_async import AsyncChatServer
+        return AsyncChatServer(host, port, **options)
+    return ChatServer(host, port, **options)
+
 if __name__ == '__main__':
-    server = ChatServer(HOST, PORT)
-    server.start()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Simple multi-client chat server")
+    parser.add_argument('--host', default=HOST, help="Address to listen on")
+    parser.add_argument('--port', type=int, default=PORT, help="Port to listen on")
+    parser.add_argument('--engine', choices=('thread', 'asyncio'), default='thread',
+                        help="'thread' starts one thread per client, 'asyncio' serves every client from a single event loop")
+    parser.add_argument('--max-backlog', type=int, default=DEFAULT_MAX_BYTES,
+                        help="Bytes of unsent messages a client may accumulate before the slow-consumer policy applies")
+    parser.add_argument('--slow-consumer', choices=SLOW_CONSUMER_POLICIES, default=DROP_OLDEST,
+                        help="Drop the oldest queued messages or disconnect clients that fall behind")
+    parser.add_argument('--history-dir', help="Directory for the persistent message log (history is kept in memory only if omitted)")
+    parser.add_argument('--no-search', action='store_true', help="Don't keep the full-text index used by /search")
+    parser.add_argument('--replay', type=int, default=DEFAULT_REPLAY, help="Recent messages replayed to users joining a room")
+    parser.add_argument('--metrics-port', type=int, help="Serve JSON metrics on http://127.0.0.1:<port>/metrics")
+    parser.add_argument('--log-interval', type=float, default=1.0,
+                        help="Print at most one received message per this many seconds (0 prints every message)")
+    parser.add_argument('--heartbeat', type=float, default=HEARTBEAT_INTERVAL,
+                        help="Seconds of silence before a client is pinged (0 disables heartbeats)")
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help="Seconds of silence after which a client is considered dead and dropped")
+    parser.add_argument('--rate-limit', type=float, default=RATE_LIMIT,
+                        help="Messages per second each client may send on average (0 disables the limit)")
+    parser.add_argument('--burst', type=int, default=BURST, help="Messages each client may send in a burst")
+    parser.add_argument('--room-rate-limit', type=float, default=0,
+                        help="Messages per second allowed in each room (default: no limit)")
+    parser.add_argument('--room-burst', type=int, default=ROOM_BURST, help="Messages allowed in a burst per room")
+    parser.add_argument('--attachment-dir', help="Keep uploaded attachments in this directory (default: a temporary one)")
+    parser.add_argument('--max-attachment', type=int, default=MAX_ATTACHMENT_SIZE, help="Largest attachment in bytes")
+    parser.add_argument('--max-attachment-storage', type=int, default=MAX_STORAGE,
+                        help="Bytes all attachments together may take (per worker in a cluster)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of server processes sharing the port (Linux, uses SO_REUSEPORT)")
+    args = parser.parse_args()
+
+    options = dict(max_backlog=args.max_backlog, slow_consumer=args.slow_consumer,
+                   history_dir=args.history_dir, replay=args.replay, search=not args.no_search,
+                   metrics_port=args.metrics_port, log_interval=args.log_interval,
+                   heartbeat_interval=args.heartbeat, idle_timeout=args.idle_timeout,
+                   rate_limit=args.rate_limit, burst=args.burst,
+                   room_rate_limit=args.room_rate_limit, room_burst=args.room_burst,
+                   attachment_dir=args.attachment_dir, max_attachment=args.max_attachment,
+                   max_attachment_storage=args.max_attachment_storage)
+    if args.workers > 1:
+        from chat_cluster import run_cluster
+        run_cluster(args.workers, args.engine, args.host, args.port, options)
+    else:
+        server = create_server(args.engine, args.host, args.port, **options)
+        server.start()
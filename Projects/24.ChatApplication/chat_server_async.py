@@ -0,0 +1,215 @@
+# chat_server_async.py
+import asyncio
+import socket
+import time
+
+from chat_outbound import OutboundQueue
+from chat_protocol import EncodedMessage, FrameDecoder, ProtocolError, make_decoder
+from chat_rooms import RoomIndex
+from chat_timers import TimerWheel
+from chat_websocket import WebSocketDecoder, is_websocket
+from chat_server import ChatServer, ClientConnection, HOST, PORT
+
+try:
+    import resource # Only available on Unix
+except ImportError:
+    resource = None
+
+def raise_open_file_limit():
+    # Every client connection is a file descriptor, so lift the soft limit up to the hard limit
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            print(f"[*] Open file limit raised from {soft} to {hard}")
+        except (ValueError, OSError) as e:
+            print(f"[!] Could not raise open file limit ({soft}): {e}")
+
+class AsyncChatServer(ChatServer):
+    # Single-threaded engine: one asyncio event loop multiplexes every client connection
+    # instead of starting one OS thread per client. Join/leave/broadcast behave exactly like ChatServer.
+    def __init__(self, host, port, backlog=4096, **options):
+        super().__init__(host, port, **options)
+        self.backlog = backlog # Large accept backlog so connection bursts aren't refused
+        self.server = None # asyncio.Server, created in serve()
+        self.loop = None # The event loop everything runs on, set in serve()
+        self.tasks = set() # Strong references to background tasks (the loop only keeps weak ones)
+
+    def start(self):
+        raise_open_file_limit()
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            print("\n[!] Server shutting down...")
+
+    async def serve(self):
+        try:
+            self.server = await asyncio.start_server(self.handle_client, self.host, self.port, reuse_address=True,
+                                                     reuse_port=self.reuse_port or None, backlog=self.backlog)
+            print(f"[*] Listening on {self.host}:{self.port} (asyncio engine)")
+        except OSError as e:
+            print(f"[!] Could not bind to port {self.port}: {e}")
+            return
+
+        self.loop = asyncio.get_running_loop()
+        self.start_services()
+
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        finally:
+            self.shutdown()
+
+    def spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def start_heartbeats(self):
+        # Runs on the event loop instead of a thread, like everything else in this engine
+        async def tick():
+            while True:
+                await asyncio.sleep(self.timers.tick)
+                self.check_heartbeats()
+        self.spawn(tick())
+
+    async def handle_client(self, reader, writer):
+        client_address = writer.get_extra_info('peername')
+        writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1) # Let the OS notice dead peers too
+        print(f"[*] Accepted connection from {client_address}")
+
+        # First, get the username from the client
+        try:
+            first_chunk = await reader.read(1024)
+            if not first_chunk: # Connected and left without saying anything
+                writer.close()
+                return
+            # Framed clients start with the protocol version byte, browsers with a WebSocket
+            # upgrade request, anything else is a raw-text client
+            decoder = WebSocketDecoder() if is_websocket(first_chunk) else make_decoder(first_chunk)
+            pending = decoder.feed(first_chunk)
+            while not pending: # A framed username may arrive in several pieces
+                for reply in decoder.take_replies(): # The WebSocket handshake response
+                    writer.write(reply)
+                chunk = await reader.read(1024)
+                if not chunk:
+                    raise ConnectionError("disconnected before sending a username")
+                pending = decoder.feed(chunk)
+            username, features, resume = self.parse_handshake(pending.pop(0).decode('utf-8'), client_address)
+            # Reading the log would block the event loop: do it in a worker thread
+            missed = await self.loop.run_in_executor(None, self.read_missed, resume)
+
+            # Keep the transport's own buffer small so backlog accumulates in the bounded OutboundQueue
+            writer.transport.set_write_buffer_limits(high=64 * 1024)
+            ready = asyncio.Event()
+            queue = OutboundQueue(self.max_backlog, self.slow_consumer, on_ready=ready.set)
+            websocket = isinstance(decoder, WebSocketDecoder)
+            connection = ClientConnection(client_address, queue, websocket or isinstance(decoder, FrameDecoder),
+                                          features, websocket)
+            self.spawn(self.send_loop(writer, connection, ready))
+
+            # Everything runs on the event loop thread, so the lock taken here is never contended
+            self.add_client(writer, username, connection, resume, missed)
+
+        except Exception as e:
+            print(f"[!] Error receiving username from {client_address}: {e}")
+            writer.close()
+            return
+
+        # Now, handle messages from this client
+        while True:
+            try:
+                for payload in pending:
+                    self.handle_payload(writer, payload)
+                data = await reader.read(65536)
+                if not data: # Client disconnected
+                    break
+                connection.last_activity = time.monotonic()
+                pending = decoder.feed(data)
+                for reply in decoder.take_replies(): # WebSocket pongs and the closing handshake
+                    connection.queue.put((reply,), len(reply))
+            except ProtocolError as e: # Garbage on a framed connection, can't resynchronise
+                print(f"[!] Protocol error from {self.usernames.get(writer, 'Unknown')} ({client_address}): {e}")
+                break
+            except ConnectionResetError: # Client forcefully disconnected
+                print(f"[*] {self.usernames.get(writer, 'Unknown')} ({client_address}) disconnected forcefully.")
+                break
+            except OSError as e: # Other socket errors
+                print(f"[!] Socket error with {self.usernames.get(writer, 'Unknown')} ({client_address}): {e}")
+                break
+            except Exception as e:
+                print(f"[!] Error handling client {self.usernames.get(writer, 'Unknown')} ({client_address}): {e}")
+                break
+
+        # Client disconnected or error occurred, clean up
+        self.remove_client(writer)
+
+    async def send_loop(self, writer, connection, ready):
+        # One task per client drains its outbound queue; drain() waits while the socket is full
+        queue = connection.queue
+        while True:
+            await ready.wait()
+            ready.clear()
+            if queue.closed:
+                break
+            try:
+                self.pump_downloads(connection)
+                # Everything that piled up since the last wakeup is handed to the transport in one write
+                writer.writelines(connection.wire(queue.take_all()))
+                await writer.drain()
+                if connection.downloads:
+                    ready.set() # More chunks to send once these are out
+            except (ConnectionError, OSError) as e:
+                if not queue.closed: # Otherwise the client is already being removed
+                    print(f"[!] Error sending to {self.usernames.get(writer, 'Unknown')}: {e}")
+                self.drop_connection(writer)
+                break
+        self.close_downloads(connection)
+
+    def run_search(self, writer, room, words):
+        # SQLite lets go of the GIL while it searches: run the query in a worker thread and
+        # answer back on the event loop, so an expensive search doesn't stall every other client
+        future = self.loop.run_in_executor(None, self.timed_search, room, words)
+        future.add_done_callback(lambda done: writer in self.connections and
+                                 self.send_search_results(writer, room, words, *done.result()))
+
+    def relay_from_bus(self, room, message, record):
+        # Called on the bus thread: hop over to the event loop before touching any client state
+        self.loop.call_soon_threadsafe(super().relay_from_bus, room, message, record)
+
+    def drop_connection(self, writer):
+        # Aborting the transport makes the client's read() return EOF, so cleanup goes through remove_client()
+        writer.transport.abort()
+
+    def shutdown(self):
+        print("[*] Shutting down server...")
+        goodbye = EncodedMessage("Server is shutting down. Goodbye!")
+        for writer in self.clients:
+            connection = self.connections[writer]
+            connection.queue.close()
+            try:
+                writer.writelines(connection.wire(list(connection.encoded(goodbye)[0])))
+                writer.close()
+            except Exception as e:
+                print(f"Error closing client socket during shutdown: {e}")
+        self.clients.clear()
+        self.usernames.clear()
+        self.user_ids.clear()
+        self.connections.clear()
+        self.rooms = RoomIndex()
+        self.timers = TimerWheel()
+        if self.server is not None:
+            self.server.close()
+        self.history.close()
+        if self.attachments is not None:
+            self.attachments.close()
+        if self.bus:
+            self.bus.close()
+        print("[*] Server shut down successfully.")
+
+if __name__ == '__main__':
+    server = AsyncChatServer(HOST, PORT)
+    server.start()
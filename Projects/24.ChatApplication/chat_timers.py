@@ -0,0 +1,49 @@
+# chat_timers.py
+import math
+
+class TimerWheel:
+    # Hashed timing wheel: a ring of slots, one per tick. A timer due at tick T lives in
+    # slot T % len(slots), so scheduling and cancelling are O(1) and advancing the clock only
+    # looks at the slots that came due, never at every timer. Timers more than one turn of
+    # the wheel away stay in their slot until their own tick comes round.
+    def __init__(self, tick=1.0, slots=512):
+        self.tick = tick
+        self.slots = [dict() for _ in range(slots)] # Each slot maps key -> due tick
+        self.slot_of = {} # Key -> index of the slot holding it
+        self.current = None # Last tick that was processed
+
+    def schedule(self, key, now, delay):
+        # (Re)arm the timer for `key` to fire `delay` seconds after `now`
+        self.cancel(key)
+        due = math.ceil((now + delay) / self.tick)
+        if self.current is not None and due <= self.current:
+            due = self.current + 1 # Already passed, fire on the next tick
+        index = due % len(self.slots)
+        self.slots[index][key] = due
+        self.slot_of[key] = index
+
+    def cancel(self, key):
+        index = self.slot_of.pop(key, None)
+        if index is not None:
+            del self.slots[index][key]
+
+    def advance(self, now):
+        # Return every key whose timer is due at or before `now`, removing them from the wheel
+        target = math.floor(now / self.tick)
+        if self.current is None:
+            self.current = target - 1
+        expired = []
+        # Never walk more than one full turn: every slot has been visited by then
+        first = max(self.current + 1, target - len(self.slots) + 1)
+        for tick in range(first, target + 1):
+            slot = self.slots[tick % len(self.slots)]
+            due = [key for key, due_tick in slot.items() if due_tick <= target]
+            for key in due:
+                del slot[key]
+                del self.slot_of[key]
+            expired.extend(due)
+        self.current = max(self.current, target)
+        return expired
+
+    def __len__(self):
+        return len(self.slot_of)
@@ -0,0 +1,142 @@
+# chat_websocket.py
+# WebSocket support (RFC 6455) so browsers can chat on the same port as every other client.
+# A WebSocket connection starts with an HTTP "GET" upgrade request. After the handshake every
+# text message is handled exactly like a framed message: same rooms, history and broadcast fan-out.
+import base64
+import hashlib
+import os
+import struct
+
+from chat_protocol import (MAX_FRAME_SIZE, WS_CLOSE, WS_PING, WS_PONG, WS_TEXT, ProtocolError,
+                           websocket_header)
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11' # Fixed by the RFC, mixed into the accept key
+MAX_HANDSHAKE = 8192 # Bytes of HTTP request headers we are willing to buffer
+
+def is_websocket(first_chunk):
+    # Framed clients start with a control byte and raw clients with their username
+    return first_chunk.startswith(b'GET ')
+
+def handshake_response(request):
+    headers = {}
+    for line in request.decode('latin-1').split('\r\n')[1:]:
+        name, separator, value = line.partition(':')
+        if separator:
+            headers[name.strip().lower()] = value.strip()
+    key = headers.get('sec-websocket-key')
+    if headers.get('upgrade', '').lower() != 'websocket' or not key:
+        raise ProtocolError("HTTP request is not a WebSocket upgrade")
+    accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode('ascii')).digest()).decode('ascii')
+    return ("HTTP/1.1 101 Switching Protocols\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Accept: {accept}\r\n\r\n").encode('ascii')
+
+def handshake_request(host, port, path='/'):
+    # For test clients (see chat_loadtest.py); browsers send their own
+    key = base64.b64encode(os.urandom(16)).decode('ascii')
+    return (f"GET {path} HTTP/1.1\r\n"
+            f"Host: {host}:{port}\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Key: {key}\r\n"
+            "Sec-WebSocket-Version: 13\r\n\r\n").encode('ascii')
+
+def apply_mask(payload, mask):
+    # XOR with the repeating 4-byte mask, as one big integer operation instead of a loop per byte
+    if not payload:
+        return b''
+    repeated = (mask * (len(payload) // 4 + 1))[:len(payload)]
+    return (int.from_bytes(payload, 'big') ^ int.from_bytes(repeated, 'big')).to_bytes(len(payload), 'big')
+
+def client_frame(payload, opcode=WS_TEXT):
+    # Frames from a client to a server must be masked
+    mask = os.urandom(4)
+    return websocket_header(opcode, len(payload), masked=True) + mask + apply_mask(payload, mask)
+
+class WebSocketDecoder:
+    # Same interface as FrameDecoder: feed() turns received chunks into whole message payloads.
+    # On the server it first consumes the HTTP upgrade request. Control frames are answered
+    # through take_replies(): the handshake response, pongs and the closing handshake.
+    def __init__(self, server=True, max_message_size=MAX_FRAME_SIZE):
+        self.server = server
+        self.max_message_size = max_message_size
+        self.handshake_done = not server # Clients read the server's 101 response themselves
+        self.buffer = bytearray()
+        self.fragments = [] # Pieces of a message split over several frames
+        self.replies = []
+        self.closed = False # After a close frame everything else is ignored
+
+    def feed(self, data):
+        self.buffer += data
+        if not self.handshake_done:
+            end = self.buffer.find(b'\r\n\r\n')
+            if end < 0:
+                if len(self.buffer) > MAX_HANDSHAKE:
+                    raise ProtocolError("WebSocket handshake too long")
+                return []
+            self.replies.append(handshake_response(bytes(self.buffer[:end])))
+            del self.buffer[:end + 4]
+            self.handshake_done = True
+        messages = []
+        offset = 0
+        while len(self.buffer) - offset >= 2:
+            first, second = self.buffer[offset], self.buffer[offset + 1]
+            fin = first & 0x80
+            opcode = first & 0x0F
+            masked = second & 0x80
+            length = second & 0x7F
+            position = offset + 2
+            if length == 126:
+                if len(self.buffer) < position + 2:
+                    break
+                length = struct.unpack_from('!H', self.buffer, position)[0]
+                position += 2
+            elif length == 127:
+                if len(self.buffer) < position + 8:
+                    break
+                length = struct.unpack_from('!Q', self.buffer, position)[0]
+                position += 8
+            if length > self.max_message_size:
+                raise ProtocolError(f"WebSocket frame of {length} bytes exceeds the {self.max_message_size} byte limit")
+            mask = None
+            if masked:
+                if len(self.buffer) < position + 4:
+                    break
+                mask = bytes(self.buffer[position:position + 4])
+                position += 4
+            end = position + length
+            if end > len(self.buffer):
+                break # Wait for the rest of this frame
+            payload = bytes(self.buffer[position:end])
+            if mask is not None:
+                payload = apply_mask(payload, mask)
+            offset = end
+            if self.closed:
+                continue
+            if opcode == WS_CLOSE:
+                # Echo the status code; the peer then closes the TCP connection
+                self.closed = True
+                self.replies.append(self.frame(WS_CLOSE, payload[:2]))
+            elif opcode == WS_PING:
+                self.replies.append(self.frame(WS_PONG, payload))
+            elif opcode == WS_PONG:
+                pass # Answer to our heartbeat, receiving it already counted as activity
+            else: # Text, binary or a continuation of either
+                self.fragments.append(payload)
+                if sum(len(fragment) for fragment in self.fragments) > self.max_message_size:
+                    raise ProtocolError("Fragmented WebSocket message too large")
+                if fin:
+                    messages.append(b''.join(self.fragments))
+                    self.fragments = []
+        del self.buffer[:offset]
+        return messages
+
+    def frame(self, opcode, payload):
+        if self.server:
+            return websocket_header(opcode, len(payload)) + payload
+        return client_frame(payload, opcode)
+
+    def take_replies(self):
+        replies, self.replies = self.replies, []
+        return replies
@@ -0,0 +1,108 @@
+# test_chat_history.py
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from chat_history import ChatHistory
+from chat_protocol import EncodedMessage
+
+class TestTornLog(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def open_history(self):
+        history = ChatHistory(self.directory, replay=100, search=False)
+        with contextlib.redirect_stdout(io.StringIO()):
+            history.open(EncodedMessage)
+        return history
+
+    def record(self, history, count):
+        for i in range(count):
+            history.record('lobby', f"message {history.next_seq}", EncodedMessage(f"message {history.next_seq}"))
+
+    def segment(self):
+        return os.path.join(self.directory, sorted(name for name in os.listdir(self.directory) if name.endswith('.log'))[-1])
+
+    def test_torn_tail_is_cut_off(self):
+        history = self.open_history()
+        self.record(history, 9)
+        history.close()
+        with open(self.segment(), 'r+b') as f: # A crash halfway through writing message 9
+            f.truncate(os.path.getsize(self.segment()) - 10)
+
+        history = self.open_history()
+        self.assertEqual(history.next_seq, 9) # Message 9 is gone, its number is handed out again
+        self.record(history, 6)
+        history.close()
+
+        # Everything written after the restart is read back, and numbering carries on
+        history = self.open_history()
+        self.assertEqual(history.next_seq, 15)
+        self.assertEqual([record['seq'] for record in history.log.read_since(0)], list(range(1, 15)))
+        messages, complete = history.since('lobby', 12, history.read_missed('lobby', 12))
+        self.assertEqual([message.payload for message in messages], [b'message 13', b'message 14'])
+        self.assertTrue(complete)
+        history.close()
+
+    def test_damaged_line_is_skipped(self):
+        history = self.open_history()
+        self.record(history, 3)
+        history.close()
+        with open(self.segment(), 'rb') as f:
+            lines = f.read().split(b'\n')
+        lines[1] = b'{"seq": 2, "te'
+        with open(self.segment(), 'wb') as f:
+            f.write(b'\n'.join(lines))
+
+        history = self.open_history()
+        self.assertEqual([record['seq'] for record in history.log.read_since(0)], [1, 3])
+        self.assertEqual(history.next_seq, 4)
+        history.close()
+
+class TestRings(unittest.TestCase):
+    def test_rooms_beyond_the_limit_are_dropped(self):
+        # Any client can /join any name: only the most recently used rooms keep a ring buffer
+        history = ChatHistory(replay=5, max_rings=3)
+        for i, room in enumerate(['a', 'b', 'c', 'a', 'd', 'e']):
+            history.record(room, f"message {i}", EncodedMessage(f"message {i}"))
+        self.assertEqual(list(history.rings), ['a', 'd', 'e'])
+        self.assertLessEqual(len(history.evicted), 3)
+        self.assertEqual([message.payload for message in history.recent('a')], [b'message 0', b'message 3'])
+        self.assertEqual(history.recent('b'), [])
+
+    def test_resume_in_a_dropped_room(self):
+        # Its messages are only in the log now: without one, the client hears that some are missing
+        history = ChatHistory(replay=5, max_rings=2)
+        for room in ('a', 'b', 'c'):
+            history.record(room, room, EncodedMessage(room))
+        self.assertEqual(history.since('a', 0), ([], False))
+        history.record('a', 'again', EncodedMessage('again'))
+        messages, complete = history.since('a', 0)
+        self.assertEqual([message.payload for message in messages], [b'again'])
+        self.assertFalse(complete)
+        self.assertEqual(history.since('c', 2), ([history.rings['c'][0][1]], True))
+
+    def test_dropped_room_is_read_from_the_log(self):
+        directory = tempfile.mkdtemp()
+        try:
+            history = ChatHistory(directory, replay=5, search=False, max_rings=2)
+            with contextlib.redirect_stdout(io.StringIO()):
+                history.open(EncodedMessage)
+            for room in ('a', 'b', 'c', 'a'):
+                history.record(room, room, EncodedMessage(room))
+            history.log.flush()
+            messages, complete = history.since('a', 0, history.read_missed('a', 0))
+            self.assertEqual([message.payload for message in messages], [b'a', b'a'])
+            self.assertTrue(complete)
+            history.close()
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+# test_chat_outbound.py
+import unittest
+
+from chat_outbound import DISCONNECT, DROP_OLDEST, OutboundQueue
+
+class TestOutboundQueue(unittest.TestCase):
+    def test_drop_oldest_keeps_the_newest(self):
+        queue = OutboundQueue(10, DROP_OLDEST)
+        for i in range(5):
+            self.assertTrue(queue.put((b'%d...' % i,), 4))
+        self.assertEqual(queue.take_all(), [b'3...', b'4...'])
+        self.assertEqual(queue.dropped, 3)
+
+    def test_disconnect_policy(self):
+        queue = OutboundQueue(10, DISCONNECT)
+        self.assertTrue(queue.put((b'x' * 8,), 8))
+        self.assertFalse(queue.put((b'x' * 8,), 8))
+        self.assertTrue(queue.closed)
+
+    def test_pinned_frames_are_never_dropped(self):
+        # The handshake replies survive a resume that overflows the queue, and still go out first
+        queue = OutboundQueue(10, DROP_OLDEST)
+        queue.pin((b'/features binary',))
+        queue.pin((b'/welcome', b' epoch'))
+        for i in range(100):
+            queue.put((b'%03d' % i,), 3)
+        buffers = queue.take_all()
+        self.assertEqual(buffers[:3], [b'/features binary', b'/welcome', b' epoch'])
+        self.assertEqual(buffers[3:], [b'097', b'098', b'099'])
+        self.assertEqual(queue.take_all(), [])
+
+    def test_on_drop_gets_the_dropped_entries(self):
+        dropped = []
+        queue = OutboundQueue(4, DROP_OLDEST)
+        queue.on_drop = dropped.extend
+        queue.put((b'ab', b'cd'), 4)
+        queue.put((b'ef',), 2)
+        self.assertEqual(dropped, [(b'ab', b'cd')])
+
+    def test_kept_entries_are_never_dropped(self):
+        # Like the end of a download: it survives in its place, the entries around it don't
+        queue = OutboundQueue(10, DROP_OLDEST)
+        queue.put((b'aaa',), 3)
+        queue.put((b'end',), 3, keep=True)
+        for i in range(10):
+            queue.put((b'%03d' % i,), 3)
+        self.assertEqual(queue.take_all(), [b'end', b'008', b'009'])
+        self.assertEqual(queue.dropped, 9)
+        self.assertEqual(queue.kept, set())
+
+if __name__ == '__main__':
+    unittest.main()
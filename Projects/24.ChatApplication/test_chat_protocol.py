@@ -0,0 +1,140 @@
+# test_chat_protocol.py
+import contextlib
+import io
+import unittest
+import zlib
+
+from chat_outbound import OutboundQueue
+from chat_protocol import (MAX_FRAME_SIZE, EncodedMessage, FrameDecoder, ProtocolError, coalesce, decode_record,
+                           deflate_frames, encode_frame)
+from chat_server import ChatServer, ClientConnection
+
+MESSAGES = [b'hello', b'', 'café \U0001f600'.encode('utf-8'), b'x' * 70000]
+
+class TestFrameDecoder(unittest.TestCase):
+    def test_frames_split_byte_by_byte(self):
+        # TCP may deliver a frame in any number of pieces
+        decoder = FrameDecoder()
+        received = []
+        for byte in b''.join(encode_frame(message) for message in MESSAGES):
+            received += decoder.feed(bytes([byte]))
+        self.assertEqual(received, MESSAGES)
+
+    def test_frames_merged_in_one_read(self):
+        decoder = FrameDecoder()
+        self.assertEqual(decoder.feed(b''.join(encode_frame(message) for message in MESSAGES)), MESSAGES)
+
+    def test_frame_split_after_header(self):
+        # Header in one read, payload in the next: nothing comes out until the payload is complete
+        decoder = FrameDecoder()
+        data = encode_frame(b'hello') + encode_frame(b'world')[:3]
+        self.assertEqual(decoder.feed(data[:5]), [])
+        self.assertEqual(decoder.feed(data[5:]), [b'hello'])
+        self.assertEqual(decoder.feed(encode_frame(b'world')[3:]), [b'world'])
+
+    def test_oversize_frame_refused(self):
+        # Refused from the header alone, before any of the payload arrives
+        decoder = FrameDecoder(max_frame_size=10)
+        with self.assertRaises(ProtocolError):
+            decoder.feed(encode_frame(b'x' * 5)[:1] + (11).to_bytes(4, 'big'))
+        with self.assertRaises(ProtocolError):
+            encode_frame(b'x' * (MAX_FRAME_SIZE + 1))
+
+    def test_unknown_version_refused(self):
+        with self.assertRaises(ProtocolError):
+            FrameDecoder().feed(b'\x07\x00\x00\x00\x01x')
+
+    def test_coalesce(self):
+        # As few writes as possible, each within the limit unless a single frame is bigger
+        frames = [b'a' * 40, b'b' * 40, b'c' * 40, b'd' * 100, b'e']
+        self.assertEqual([len(batch) for batch in coalesce(frames, limit=100)], [80, 40, 100, 1])
+        self.assertEqual(b''.join(coalesce(frames, limit=100)), b''.join(frames))
+
+    def test_encoded_message_forms(self):
+        message = EncodedMessage('hi', seq=42)
+        self.assertEqual(FrameDecoder().feed(b''.join(message.framed)), [b'hi'])
+        self.assertEqual(FrameDecoder().feed(b''.join(message.sequenced()[0])), [b'42 hi'])
+        self.assertEqual(b''.join(message.raw), b'hi\n') # Raw-text clients need the line break
+        self.assertEqual(message.raw_size, 3)
+
+class TestOversizeMessages(unittest.TestCase):
+    def setUp(self):
+        self.server = ChatServer('127.0.0.1', 0, max_backlog=16 * MAX_FRAME_SIZE, rate_limit=0)
+        self.sender = ClientConnection(('test', 1), OutboundQueue(16 * MAX_FRAME_SIZE), True)
+        self.reader = ClientConnection(('test', 2), OutboundQueue(16 * MAX_FRAME_SIZE), True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.server.add_client('sender', 'alice', self.sender)
+            self.server.add_client('reader', 'bob', self.reader)
+        self.sender.queue.take_all()
+        self.reader.queue.take_all()
+
+    def test_body_that_fills_a_frame_is_refused(self):
+        # Legal as an incoming frame, too big once "[HH:MM:SS] alice: " is added
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.server.handle_message('sender', 'x' * MAX_FRAME_SIZE)
+        self.assertEqual(self.reader.queue.take_all(), [])
+        notice, = FrameDecoder().feed(b''.join(self.sender.queue.take_all()))
+        self.assertIn('too long', notice.decode('utf-8'))
+        self.assertIn('sender', self.server.clients) # Still connected
+
+    def test_body_within_the_limit_is_sent(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.server.handle_message('sender', 'é' * (MAX_FRAME_SIZE // 2 - 1024))
+        message, = FrameDecoder().feed(b''.join(self.reader.queue.take_all()))
+        self.assertTrue(message.endswith(b' alice: ' + 'é'.encode('utf-8') * (MAX_FRAME_SIZE // 2 - 1024)))
+
+class TestCompactFormats(unittest.TestCase):
+    def test_compressed_frames_need_inflate(self):
+        # Only clients that negotiated zlib accept compressed frames
+        frames = deflate_frames(zlib.compressobj(), [encode_frame(b'hello')])
+        with self.assertRaises(ProtocolError):
+            FrameDecoder().feed(b''.join(frames))
+
+    def test_inflate_split_across_reads(self):
+        # Several batches on one zlib stream, the compressed frames cut into small reads
+        deflater = zlib.compressobj()
+        data = b''
+        for message in MESSAGES:
+            data += b''.join(deflate_frames(deflater, [encode_frame(message), encode_frame(message)]))
+        decoder = FrameDecoder(inflate=True)
+        received = []
+        for start in range(0, len(data), 7):
+            received += decoder.feed(data[start:start + 7])
+        self.assertEqual(received, [message for message in MESSAGES for _ in range(2)])
+
+    def test_inflate_accepts_plain_frames(self):
+        # The /features answer comes before compression starts
+        deflater = zlib.compressobj()
+        data = encode_frame(b'/features zlib') + b''.join(deflate_frames(deflater, [encode_frame(b'hello')]))
+        self.assertEqual(FrameDecoder(inflate=True).feed(data), [b'/features zlib', b'hello'])
+
+    def test_binary_records(self):
+        usernames = {}
+        chat = EncodedMessage('[12:00:00] alice: hi', seq=7, author=(3, 'alice', 0, 'hi'))
+        self.assertIsNone(decode_record(FrameDecoder().feed(chat.user_record())[0], usernames))
+        self.assertEqual(usernames, {3: 'alice'})
+        seq, text = decode_record(FrameDecoder().feed(b''.join(chat.binary()[0]))[0], usernames)
+        self.assertEqual(seq, 7)
+        self.assertTrue(text.endswith(' alice: hi'))
+        notice = EncodedMessage('📢 bob has joined the chat.')
+        self.assertEqual(decode_record(FrameDecoder().feed(b''.join(notice.binary()[0]))[0], usernames),
+                         (0, '📢 bob has joined the chat.'))
+        with self.assertRaises(ProtocolError):
+            decode_record(b'\x09', usernames)
+
+    def test_username_sent_again_after_drop(self):
+        # Drop-oldest threw the USER record away, so the next message of that user carries it again
+        connection = ClientConnection(('test', 1), OutboundQueue(60), True, frozenset({'binary'}))
+        message = EncodedMessage('x', author=(1, 'alice', 0, 'a long enough message body'))
+        connection.enqueue(message)
+        self.assertEqual(connection.known_users, {1})
+        connection.enqueue(EncodedMessage('x', author=(2, 'bob', 0, 'another long message body')))
+        self.assertEqual(connection.known_users, {2})
+        connection.enqueue(message)
+        usernames = {}
+        for payload in FrameDecoder().feed(b''.join(connection.queue.take_all())):
+            decode_record(payload, usernames)
+        self.assertEqual(usernames, {1: 'alice'})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+# test_chat_timers.py
+import socket
+import unittest
+from unittest.mock import patch
+
+from chat_outbound import OutboundQueue
+from chat_protocol import FrameDecoder
+from chat_server import ChatServer, ClientConnection
+from chat_timers import TimerWheel
+
+class TestTimerWheel(unittest.TestCase):
+    def test_fires_when_due(self):
+        wheel = TimerWheel(tick=1.0, slots=8)
+        wheel.advance(100.0)
+        wheel.schedule('a', 100.0, 3.0)
+        self.assertEqual(wheel.advance(102.0), [])
+        self.assertEqual(wheel.advance(103.0), ['a'])
+        self.assertEqual(len(wheel), 0)
+        self.assertEqual(wheel.advance(110.0), []) # Fired once, then gone
+
+    def test_rounds_up_to_the_next_tick(self):
+        # Never early: a timer due between two ticks fires on the later one
+        wheel = TimerWheel(tick=1.0, slots=8)
+        wheel.advance(100.0)
+        wheel.schedule('a', 100.2, 1.5)
+        self.assertEqual(wheel.advance(101.9), [])
+        self.assertEqual(wheel.advance(102.0), ['a'])
+
+    def test_cancel_and_reschedule(self):
+        wheel = TimerWheel(tick=1.0, slots=8)
+        wheel.advance(0.0)
+        wheel.schedule('a', 0.0, 2.0)
+        wheel.schedule('b', 0.0, 2.0)
+        wheel.cancel('a')
+        wheel.cancel('missing') # Cancelling twice or something unknown is fine
+        wheel.schedule('b', 0.0, 5.0) # Re-arming replaces the old timer
+        self.assertEqual(wheel.advance(2.0), [])
+        self.assertEqual(wheel.advance(5.0), ['b'])
+        self.assertEqual(len(wheel), 0)
+
+    def test_more_than_one_turn_away(self):
+        # 8 slots: a timer 20 ticks away shares its slot with ticks 4 and 12 and must wait for its own turn
+        wheel = TimerWheel(tick=1.0, slots=8)
+        wheel.advance(0.0)
+        wheel.schedule('far', 0.0, 20.0)
+        wheel.schedule('near', 0.0, 4.0)
+        self.assertEqual(wheel.advance(4.0), ['near'])
+        self.assertEqual(wheel.advance(12.0), [])
+        self.assertEqual(wheel.advance(19.0), [])
+        self.assertEqual(wheel.advance(20.0), ['far'])
+
+    def test_clock_jumps_past_many_turns(self):
+        # A late advance still fires everything that came due, without walking every tick
+        wheel = TimerWheel(tick=1.0, slots=8)
+        wheel.advance(0.0)
+        for i in range(1, 30):
+            wheel.schedule(i, 0.0, float(i))
+        self.assertEqual(sorted(wheel.advance(1000.0)), list(range(1, 30)))
+        self.assertEqual(len(wheel), 0)
+
+    def test_scheduled_in_the_past(self):
+        wheel = TimerWheel(tick=1.0, slots=8)
+        wheel.advance(50.0)
+        wheel.schedule('late', 40.0, 1.0) # Due at 41, already passed
+        self.assertEqual(wheel.advance(51.0), ['late'])
+
+    def test_fractional_tick(self):
+        wheel = TimerWheel(tick=0.25, slots=16)
+        wheel.advance(10.0)
+        wheel.schedule('a', 10.0, 0.5)
+        self.assertEqual(wheel.advance(10.25), [])
+        self.assertEqual(wheel.advance(10.5), ['a'])
+
+class TestHeartbeats(unittest.TestCase):
+    def setUp(self):
+        self.server = ChatServer('127.0.0.1', 0, heartbeat_interval=30.0, idle_timeout=90.0)
+        self.client, self.peer = socket.socketpair()
+        self.connection = ClientConnection(('test', 1), OutboundQueue(), True)
+        self.server.connections[self.client] = self.connection
+        self.server.timers.schedule(self.client, 1000.0, 30.0)
+
+    def tearDown(self):
+        self.client.close()
+        self.peer.close()
+
+    def check(self, now):
+        with patch('time.monotonic', return_value=now):
+            self.server.check_heartbeats()
+
+    def test_silent_client_is_pinged_then_dropped(self):
+        self.connection.last_activity = 1000.0
+        self.check(1030.0)
+        self.assertEqual(FrameDecoder().feed(b''.join(self.connection.queue.take_all())), [b'/ping'])
+        self.peer.setblocking(False)
+        self.check(1089.0) # Not idle for long enough yet
+        with self.assertRaises(BlockingIOError):
+            self.peer.recv(1)
+        self.check(1090.0)
+        self.assertEqual(self.peer.recv(1), b'') # Shut down: the receive loop cleans up
+
+    def test_activity_postpones_the_ping(self):
+        # Receiving only sets last_activity; the timer that fires finds it and re-arms itself
+        self.connection.last_activity = 1020.0
+        self.check(1030.0)
+        self.assertEqual(self.connection.queue.take_all(), [])
+        self.check(1049.0)
+        self.assertEqual(self.connection.queue.take_all(), [])
+        self.check(1050.0)
+        self.assertEqual(FrameDecoder().feed(b''.join(self.connection.queue.take_all())), [b'/ping'])
+
+if __name__ == '__main__':
+    unittest.main()
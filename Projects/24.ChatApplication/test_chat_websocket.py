@@ -0,0 +1,79 @@
+# test_chat_websocket.py
+import unittest
+
+from chat_protocol import WS_BINARY, WS_CLOSE, WS_PING, WS_PONG, EncodedMessage, ProtocolError, websocket_header
+from chat_websocket import WebSocketDecoder, client_frame, handshake_request
+
+MESSAGES = [b'hello', b'', 'café \U0001f600'.encode('utf-8'), b'x' * 70000]
+
+class TestWebSocketDecoder(unittest.TestCase):
+    def handshaken(self):
+        decoder = WebSocketDecoder()
+        self.assertEqual(decoder.feed(handshake_request('localhost', 65432)), [])
+        self.assertTrue(decoder.take_replies()[0].startswith(b'HTTP/1.1 101 '))
+        return decoder
+
+    def test_handshake_split_across_reads(self):
+        decoder = WebSocketDecoder()
+        request = handshake_request('localhost', 65432)
+        self.assertEqual(decoder.feed(request[:20]), [])
+        self.assertEqual(decoder.take_replies(), [])
+        # The first frame may arrive in the same read as the end of the handshake
+        self.assertEqual(decoder.feed(request[20:] + client_frame(b'hello')), [b'hello'])
+        self.assertEqual(len(decoder.take_replies()), 1)
+
+    def test_not_an_upgrade(self):
+        with self.assertRaises(ProtocolError):
+            WebSocketDecoder().feed(b'GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+
+    def test_frames_split_byte_by_byte(self):
+        # Payload lengths that need the 7-bit, 16-bit and 64-bit length fields
+        decoder = self.handshaken()
+        messages = [b'hello', b'x' * 300, b'y' * 70000]
+        received = []
+        for byte in b''.join(client_frame(message) for message in messages):
+            received += decoder.feed(bytes([byte]))
+        self.assertEqual(received, messages)
+
+    def test_frames_merged_in_one_read(self):
+        decoder = self.handshaken()
+        self.assertEqual(decoder.feed(b''.join(client_frame(message) for message in MESSAGES)), MESSAGES)
+
+    def test_fragmented_message(self):
+        # A message split over a text frame and continuation frames, with a ping in between
+        decoder = self.handshaken()
+        first = client_frame(b'hel')
+        first = bytes([first[0] & 0x7F]) + first[1:] # FIN off
+        middle = client_frame(b'lo ', opcode=0)
+        middle = bytes([middle[0] & 0x7F]) + middle[1:]
+        self.assertEqual(decoder.feed(first + middle + client_frame(b'?', WS_PING)), [])
+        self.assertEqual(decoder.feed(client_frame(b'world', opcode=0)), [b'hello world'])
+        self.assertEqual(decoder.take_replies(), [websocket_header(WS_PONG, 1) + b'?'])
+
+    def test_oversize_frame_refused(self):
+        # Refused from the header, before the payload is buffered
+        decoder = self.handshaken()
+        decoder.max_message_size = 100
+        with self.assertRaises(ProtocolError):
+            decoder.feed(client_frame(b'x' * 101)[:4])
+
+    def test_oversize_fragments_refused(self):
+        decoder = self.handshaken()
+        decoder.max_message_size = 100
+        fragment = client_frame(b'x' * 60, WS_BINARY)
+        fragment = bytes([fragment[0] & 0x7F]) + fragment[1:]
+        with self.assertRaises(ProtocolError):
+            decoder.feed(fragment + client_frame(b'x' * 60, opcode=0))
+
+    def test_close_echoed_and_rest_ignored(self):
+        decoder = self.handshaken()
+        self.assertEqual(decoder.feed(client_frame(b'\x03\xe8', WS_CLOSE) + client_frame(b'late')), [])
+        self.assertEqual(decoder.take_replies(), [websocket_header(WS_CLOSE, 2) + b'\x03\xe8'])
+
+    def test_client_side_reads_unmasked_frames(self):
+        decoder = WebSocketDecoder(server=False)
+        message = EncodedMessage('hi there')
+        self.assertEqual(decoder.feed(b''.join(message.websocket()[0])), [b'hi there'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,16 +1,116 @@
 # app.py
-from flask import Flask, render_template, request, redirect, url_for, flash
+from flask import Flask, render_template, request, redirect, url_for, flash, make_response, session
+from markupsafe import Markup, escape
 import database
+import atexit
 import datetime
+import functools
+import sqlite3
+import threading
+import time
+import urllib.parse
+from page_cache import PageCache
+from view_counter import ViewCounter
 
 app = Flask(__name__)
 app.secret_key = 'your_very_secret_key_here' # Change this to a strong, random key in production!
+app.config['MAX_CONTENT_LENGTH'] = 1024 * 1024 # Bigger request bodies are refused (413) before they are parsed
 
-# Route for the homepage - displaying all posts
+MAX_POST_LENGTH = 100000 # Characters of Markdown in a post: rendering and storing it take time in proportion
+
+PAGE_CACHE_SIZE = 256 # Rendered pages kept in memory
+PAGE_CACHE_DIR = None # e.g. 'page_cache' to also keep them on disk, across restarts and processes
+page_cache = PageCache(PAGE_CACHE_SIZE, PAGE_CACHE_DIR)
+RERENDER_INTERVAL = 60 # Seconds between looks for posts without up-to-date HTML (e.g. saved by a process with an older renderer)
+VIEW_SAVE_INTERVAL = 5 # Seconds between writes of the view counts, which are kept in memory until then
+view_counter = ViewCounter(database.add_views, VIEW_SAVE_INTERVAL)
+atexit.register(view_counter.close)
+
+# Serves a page from the cache while no post has changed since it was rendered, and answers
+# a browser that already has this exact page (If-None-Match) with an empty 304.
+# `params` are the query parameters the view reads. Only those are part of the cache key, so
+# "?utm_source=..." or any made-up parameter gets the same cached page instead of a new one.
+def cached_page(*params):
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if '_flashes' in session: # A one-off message for this visitor is part of the page
+                return view(*args, **kwargs)
+            version = database.content_version()
+            key = cache_key(params)
+            page = page_cache.get(version, key)
+            if page is None:
+                body = view(*args, **kwargs)
+                if not isinstance(body, str): # A redirect or an error, not a page
+                    return body
+                page = page_cache.put(version, key, body)
+            response = make_response(page.body)
+            response.set_etag(page.etag)
+            response.headers['Cache-Control'] = 'no-cache' # Browsers may keep it, but must revalidate
+            return response.make_conditional(request)
+        return wrapper
+    return decorator
+
+def cache_key(params):
+    # The path and the values of `params`, in a fixed order
+    query = urllib.parse.urlencode([(name, request.args[name]) for name in params if name in request.args])
+    return f"{request.path}?{query}" if query else request.path
+
+# Counts a view every time a post is shown: rendered, from the cache, or to a browser that
+# already had the page (304)
+def counted_view(view):
+    @functools.wraps(view)
+    def wrapper(post_id):
+        response = make_response(view(post_id))
+        if response.status_code in (200, 304):
+            view_counter.add(post_id)
+        return response
+    return wrapper
+
+# Route for the homepage - displaying one page of posts, newest first
 @app.route('/')
+@cached_page('page_size', 'before', 'after')
 def index():
-    posts = database.get_all_posts()
-    return render_template('index.html', posts=posts)
+    page_size = request.args.get('page_size', database.PAGE_SIZE, type=int)
+    page_size = min(max(page_size, 1), database.MAX_PAGE_SIZE)
+    posts, older, newer = database.get_posts_page(before=database.decode_cursor(request.args.get('before')),
+                                                  after=database.decode_cursor(request.args.get('after')),
+                                                  limit=page_size)
+    # Keep a custom page size in the next/previous links, leave the default out of the URL
+    page_size = page_size if page_size != database.PAGE_SIZE else None
+    return render_template('index.html', posts=posts, older=older, newer=newer, page_size=page_size)
+
+# Route for reading a single post - the only page that loads a post's full content
+@app.route('/post/<int:post_id>')
+@counted_view
+@cached_page()
+def post(post_id):
+    post = database.get_post_by_id(post_id)
+    if post is None:
+        flash('Post not found!', 'error')
+        return redirect(url_for('index'))
+    # The HTML was rendered from the Markdown when the post was saved, and escaped then
+    return render_template('post.html', post=post, content=Markup(database.post_html(post)))
+
+# Route for the most viewed posts. Not cached: the counts change without the posts changing.
+# They are up to VIEW_SAVE_INTERVAL seconds behind.
+@app.route('/popular')
+def popular():
+    return render_template('popular.html', posts=database.get_most_viewed())
+
+# Turns the match markers of a search result into <mark> tags, after escaping the post's text
+@app.template_filter('highlight')
+def highlight(text):
+    escaped = str(escape(text))
+    return Markup(escaped.replace(database.HIGHLIGHT_START, '<mark>').replace(database.HIGHLIGHT_END, '</mark>'))
+
+# Route for searching posts - ranked full-text search, one page at a time
+@app.route('/search')
+def search():
+    query = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    results, has_more = database.search_posts(query, page) if query else ([], False)
+    return render_template('search.html', query=query, page=page, results=results, has_more=has_more)
 
 # Route for creating a new post
 @app.route('/create', methods=('GET', 'POST'))
@@ -24,6 +124,8 @@ def create():
             flash('Title is required!', 'error')
         elif not content:
             flash('Content is required!', 'error')
+        elif len(content) > MAX_POST_LENGTH:
+            flash(f'Content is too long! At most {MAX_POST_LENGTH} characters.', 'error')
         else:
             database.create_post(title, content, created_at)
             flash('Post created successfully!', 'success')
@@ -47,6 +149,8 @@ def edit(post_id):
             flash('Title is required!', 'error')
         elif not content:
             flash('Content is required!', 'error')
+        elif len(content) > MAX_POST_LENGTH:
+            flash(f'Content is too long! At most {MAX_POST_LENGTH} characters.', 'error')
         else:
             database.update_post(post_id, title, content)
             flash('Post updated successfully!', 'success')
@@ -65,6 +169,16 @@ def delete(post_id):
         flash(f'Post "{post[1]}" deleted successfully!', 'success')
     return redirect(url_for('index'))
 
+# Renders posts whose HTML is missing or came from an older renderer, while the app serves
+def rerender_in_background():
+    while True:
+        try:
+            database.rerender_posts()
+        except sqlite3.Error as e:
+            print(f"[!] Could not render posts: {e}")
+        time.sleep(RERENDER_INTERVAL)
+
 if __name__ == '__main__':
     database.init_db() # Initialize the database when the app starts
+    threading.Thread(target=rerender_in_background, daemon=True).start()
     app.run(debug=True) # Run in debug mode for development (auto-reloads, useful errors)
\ No newline at end of file
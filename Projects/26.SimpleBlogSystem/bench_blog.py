@@ -0,0 +1,267 @@
+# bench_blog.py
+# Load test for the blog as the posts table grows. For every size it seeds (once, then reuses)
+# a database of that many posts, and drives the homepage, pages deep in the table, single
+# posts, the edit form, edits, creates and deletes with several threads, through Flask's test
+# client or a real local WSGI server. It reports requests per second and latency percentiles;
+# results can be saved as JSON and compared later.
+import argparse
+import datetime
+import http.client
+import json
+import logging
+import os
+import random
+import threading
+import time
+import urllib.parse
+
+from werkzeug.serving import make_server
+
+import app
+import database
+from page_cache import PageCache
+
+SCENARIOS = ('index', 'page', 'post', 'edit_form', 'edit', 'create', 'delete')
+WORDS = ('the blog post python flask sqlite index query page cache write read table row database '
+         'server request thread latency percentile benchmark markdown excerpt search version').split()
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def make_post(rng):
+    title = ' '.join(rng.choices(WORDS, k=5)).capitalize()
+    content = ' '.join(rng.choices(WORDS, k=40)) + '.\n\n' + ' '.join(rng.choices(WORDS, k=30)) + '.'
+    return title, content
+
+def generate_posts(count, seed=1):
+    # The same posts every time, one every 5 minutes (1,000,000 posts span about 9.5 years)
+    rng = random.Random(seed)
+    start = datetime.datetime(2015, 1, 1)
+    for i in range(count):
+        title, content = make_post(rng)
+        yield title, content, (start + datetime.timedelta(minutes=5 * i)).strftime("%Y-%m-%d %H:%M:%S")
+
+def open_database(directory, size):
+    # Seeding a million posts takes a minute, so a database of the right size is kept and reused.
+    # The benchmark deletes exactly the posts it created, which keeps the size the same.
+    # Returns the highest id of the seeded posts.
+    path = os.path.join(directory, f"blog-{size}.db")
+    database.use_database(path)
+    if os.path.exists(path):
+        with database.connection() as conn:
+            if conn.execute('SELECT count(*) FROM posts').fetchone()[0] == size:
+                print(f"[*] Using {path} ({size} posts)")
+                return conn.execute('SELECT max(id) FROM posts').fetchone()[0] or 0
+        database.use_database(path) # Close the pooled connections before removing the files
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    print(f"[*] Seeding {path} with {size} posts...")
+    database.init_db()
+    database.insert_posts(generate_posts(size))
+    return size
+
+class TestClientDriver:
+    # Requests go straight to the WSGI app, no sockets. No cookies: otherwise every unread
+    # flash message ("Post updated successfully!") would pile up in the session cookie.
+    def __init__(self):
+        self.client = app.app.test_client(use_cookies=False)
+
+    def request(self, method, path, form=None):
+        return self.client.open(path, method=method, data=form).status_code
+
+class HttpDriver:
+    # Requests over HTTP to a local server, a new connection each time (the server is HTTP/1.0)
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+
+    def request(self, method, path, form=None):
+        conn = http.client.HTTPConnection(self.host, self.port)
+        try:
+            if form is None:
+                conn.request(method, path)
+            else:
+                conn.request(method, path, urllib.parse.urlencode(form),
+                             {'Content-Type': 'application/x-www-form-urlencoded'})
+            response = conn.getresponse()
+            response.read()
+            return response.status
+        finally:
+            conn.close()
+
+def random_posts(count):
+    # Posts from anywhere in the table, so reads miss the page cache and the database's own
+    # cache like real traffic spread over old posts would
+    with database.connection() as conn:
+        posts = conn.execute('SELECT id, created_at FROM posts ORDER BY random() LIMIT ?', (count,)).fetchall()
+    return [posts[i % len(posts)] for i in range(count)]
+
+def make_requests(scenario, count, rng, last_seeded):
+    # [(method, path, form, expected status)], built before the clock starts
+    if scenario == 'index':
+        # Always the same, cached first page: shows what the page cache serves, not the table
+        return [('GET', '/', None, 200)] * count
+    if scenario == 'page':
+        # The page of posts older than a random one, anywhere from the newest to the oldest
+        return [('GET', '/?' + urllib.parse.urlencode({'before': database.encode_cursor(post)}), None, 200)
+                for post in random_posts(count)]
+    if scenario == 'post':
+        return [('GET', f"/post/{post['id']}", None, 200) for post in random_posts(count)]
+    if scenario == 'edit_form':
+        return [('GET', f"/edit/{post['id']}", None, 200) for post in random_posts(count)]
+    if scenario == 'edit':
+        requests = []
+        for post in random_posts(count):
+            title, content = make_post(rng)
+            requests.append(('POST', f"/edit/{post['id']}", {'title': title, 'content': content}, 302))
+        return requests
+    if scenario == 'create':
+        requests = []
+        for _ in range(count):
+            title, content = make_post(rng)
+            requests.append(('POST', '/create', {'title': title, 'content': content}, 302))
+        return requests
+    # delete: the posts the create scenario just added, never seeded ones, so the size stays the same
+    with database.connection() as conn:
+        ids = [row[0] for row in conn.execute('SELECT id FROM posts WHERE id > ? ORDER BY id DESC LIMIT ?',
+                                              (last_seeded, count))]
+    return [('POST', f'/delete/{post_id}', None, 302) for post_id in ids]
+
+def run_scenario(drivers, requests):
+    # Every thread takes every len(drivers)-th request; all of them start at the same moment
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    start = threading.Barrier(len(drivers) + 1)
+
+    def work(driver, share):
+        mine = []
+        failed = 0
+        start.wait()
+        for method, path, form, expected in share:
+            began = time.perf_counter()
+            try:
+                status = driver.request(method, path, form)
+            except OSError:
+                status = None
+            mine.append(time.perf_counter() - began)
+            if status != expected:
+                failed += 1
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=work, args=(driver, requests[i::len(drivers)]))
+               for i, driver in enumerate(drivers)]
+    for thread in threads:
+        thread.start()
+    start.wait()
+    began = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - began
+    return {
+        'requests': len(requests),
+        'errors': errors[0],
+        'seconds': seconds,
+        'requests_per_sec': len(requests) / seconds if seconds else 0.0,
+        'latency_p50_ms': percentile(latencies, 50) * 1000,
+        'latency_p90_ms': percentile(latencies, 90) * 1000,
+        'latency_p99_ms': percentile(latencies, 99) * 1000,
+        'latency_max_ms': max(latencies, default=0.0) * 1000,
+    }
+
+def run(args):
+    os.makedirs(args.directory, exist_ok=True)
+    if args.no_page_cache:
+        app.page_cache = PageCache(0) # Every page is rendered
+    server = None
+    if args.wsgi:
+        logging.getLogger('werkzeug').setLevel(logging.ERROR) # Not a line per request
+        server = make_server('127.0.0.1', 0, app.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        drivers = [HttpDriver('127.0.0.1', server.server_port) for _ in range(args.concurrency)]
+    else:
+        drivers = [TestClientDriver() for _ in range(args.concurrency)]
+    rng = random.Random(args.seed)
+    results = {}
+    try:
+        for size in args.sizes:
+            last_seeded = open_database(args.directory, size)
+            app.page_cache.clear() # Content versions of different databases aren't comparable
+            for scenario in args.scenarios:
+                requests = make_requests(scenario, args.requests, rng, last_seeded)
+                drivers[0].request('GET', '/') # Warm up connections and caches
+                result = run_scenario(drivers, requests)
+                results[f"{size} {scenario}"] = result
+                print(f"[*] {size:>9} posts  {scenario:<7} {result['requests_per_sec']:>9.1f} req/s  "
+                      f"p50 {result['latency_p50_ms']:.2f} ms  p99 {result['latency_p99_ms']:.2f} ms  "
+                      f"{result['errors']} errors")
+    finally:
+        if server is not None:
+            server.shutdown()
+    return {
+        'settings': {
+            'sizes': args.sizes,
+            'scenarios': args.scenarios,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'transport': 'wsgi' if args.wsgi else 'test-client',
+            'page_cache': not args.no_page_cache,
+        },
+        'results': results,
+    }
+
+def print_report(report, baseline=None):
+    # Throughput and p99 of every size and scenario, and how they changed since the baseline
+    old_results = baseline['results'] if baseline else {}
+    print()
+    if baseline and baseline['settings'] != report['settings']:
+        print(f"[!] The baseline was run with other settings: {baseline['settings']}")
+    header = f"{'posts / scenario':<22}{'req/s':>10}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'errors':>8}"
+    print(header + (f"{'req/s chg':>11}{'p99 chg':>9}" if baseline else ""))
+    for key, result in report['results'].items():
+        line = (f"{key:<22}{result['requests_per_sec']:>10.1f}{result['latency_p50_ms']:>9.2f}"
+                f"{result['latency_p90_ms']:>9.2f}{result['latency_p99_ms']:>9.2f}{result['errors']:>8}")
+        old = old_results.get(key)
+        if old:
+            for metric in ('requests_per_sec', 'latency_p99_ms'):
+                change = f"{(result[metric] - old[metric]) / old[metric] * 100:+.1f}%" if old[metric] else "n/a"
+                line += f"{change:>11}" if metric == 'requests_per_sec' else f"{change:>9}"
+        print(line)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the blog's routes on databases of growing size")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000, 1000000], help="Posts in each database")
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS),
+                        help="GET /, GET /?before=<random cursor>, GET /post/<id>, GET /edit/<id>, POST /edit/<id>, "
+                             "POST /create, POST /delete/<id> (deletes what create added)")
+    parser.add_argument('--requests', type=int, default=2000, help="Requests per scenario and size")
+    parser.add_argument('--concurrency', type=int, default=8, help="Threads sending requests at the same time")
+    parser.add_argument('--wsgi', action='store_true', help="Go through a local HTTP server instead of the test client")
+    parser.add_argument('--no-page-cache', action='store_true', help="Render every page, as with a cold cache")
+    parser.add_argument('--directory', default='bench_data', help="Where the seeded databases are kept")
+    parser.add_argument('--seed', type=int, default=1, help="Seed for the generated edits and posts")
+    parser.add_argument('--json', help="Write the report to this JSON file")
+    parser.add_argument('--baseline', help="Compare against a report saved earlier with --json")
+    args = parser.parse_args()
+
+    if 'delete' in args.scenarios and 'create' not in args.scenarios:
+        parser.error("delete removes the posts create added, so it needs the create scenario too")
+    args.scenarios = [scenario for scenario in SCENARIOS if scenario in args.scenarios] # create before delete
+    report = run(args)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\n[*] Report written to {args.json}")
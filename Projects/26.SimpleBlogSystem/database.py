@@ -1,56 +1,481 @@
 # database.py
+import argparse
+import contextlib
+import csv
+import datetime
+import itertools
+import json
+import queue
 import sqlite3
+import sys
+import time
+
+from markdown_render import RENDERER_VERSION, plain_text, render_markdown
 
 DATABASE_NAME = 'blog.db'
+POOL_SIZE = 8             # Idle connections kept open for reuse
+BUSY_TIMEOUT = 5.0        # Seconds a writer waits for another writer before giving up
+PAGE_SIZE = 10            # Posts per page on the homepage
+MAX_PAGE_SIZE = 100
+EXCERPT_LENGTH = 200      # Characters of a post shown on the homepage
+LISTING_COLUMNS = 'id, title, excerpt, created_at' # All the homepage needs, never the full content
+SEARCH_PAGE_SIZE = 10
+MAX_SEARCH_PAGE = 50      # Every page of ranked results ranks all matches, so deep pages are refused
+RANK_WINDOW = 5000        # Only the newest this many matches are ranked, so a word in every post stays fast
+TITLE_WEIGHT = 10.0       # A word in the title counts this much more than one in the content
+# Search results mark matches with these instead of HTML tags, so the text can still be escaped safely
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_END = '\x03'
+IMPORT_BATCH = 50000      # Posts per transaction when importing
+EXPORT_COLUMNS = ('id', 'title', 'content', 'created_at')
+RERENDER_BATCH = 500      # Posts per transaction when rendering posts again in the background
+RERENDER_PAUSE = 0.05     # Seconds between those transactions, so the app's writes get their turn
+POPULAR_SIZE = 10         # Posts on the "most viewed" page
+
+# Applied once to every new connection, not once per query
+PRAGMAS = (
+    'PRAGMA journal_mode = WAL',     # Readers don't block the writer and the writer doesn't block readers
+    'PRAGMA synchronous = NORMAL',   # With WAL this is still safe against corruption, and commits skip an fsync
+    'PRAGMA foreign_keys = ON',
+    'PRAGMA cache_size = -16000',    # 16 MB page cache per connection (negative means KiB)
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA mmap_size = 268435456',  # Read the database through a 256 MB memory map
+)
+
+def make_excerpt(content, length=EXCERPT_LENGTH):
+    # The start of the post on one line, cut at a word boundary
+    text = ' '.join(content.split())
+    if len(text) <= length:
+        return text
+    cut = text.rfind(' ', 0, length)
+    return text[:cut if cut > 0 else length] + '…'
 
-def get_db_connection():
-    conn = sqlite3.connect(DATABASE_NAME)
+def render_post(content):
+    # (HTML, excerpt) of a post's Markdown. The excerpt is cut from the text of the HTML, so
+    # listings show "bold" rather than "**bold**", and never the target of a link.
+    content_html = render_markdown(content)
+    return content_html, make_excerpt(plain_text(content_html))
+
+def get_db_connection(database=None):
+    # Opens a new, fully configured connection. Queries should borrow one from the pool instead.
+    conn = sqlite3.connect(database or DATABASE_NAME, timeout=BUSY_TIMEOUT,
+                           isolation_level=None, # Autocommit: reads never sit in an open transaction
+                           check_same_thread=False) # Pooled connections move between request threads
     conn.row_factory = sqlite3.Row # Allows accessing columns by name
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
     return conn
 
+class ConnectionPool:
+    # Keeps connections open between requests, so a query no longer pays for connecting,
+    # reading the schema and preparing its statement every time. A connection is used by one
+    # thread at a time: borrowed for the duration of a `with` block, then handed back.
+    def __init__(self, database, size=POOL_SIZE):
+        self.database = database
+        self.idle = queue.LifoQueue(maxsize=size) # LIFO: the most recently used connection has the warmest cache
+
+    @contextlib.contextmanager
+    def connection(self):
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty: # All busy (or none yet): open another one
+            conn = get_db_connection(self.database)
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction: # Never hand out a connection in the middle of a transaction
+                conn.rollback()
+            try:
+                self.idle.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+_pool = ConnectionPool(DATABASE_NAME)
+
+def use_database(path):
+    # Switch to another database file (e.g. for tests or benchmarks)
+    global DATABASE_NAME, _pool
+    _pool.close()
+    DATABASE_NAME = path
+    _pool = ConnectionPool(path)
+
+def connection():
+    # with database.connection() as conn: ... (reads)
+    return _pool.connection()
+
+@contextlib.contextmanager
+def transaction():
+    # with database.transaction() as conn: ... (writes)
+    # Commits when the block ends, rolls back if it raises. BEGIN IMMEDIATE takes the write
+    # lock up front, so two writers queue on busy_timeout instead of failing halfway through.
+    with _pool.connection() as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
 def init_db():
-    conn = get_db_connection()
-    # Create posts table if it doesn't exist
+    with transaction() as conn:
+        # Create posts table if it doesn't exist
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS posts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                title TEXT NOT NULL,
+                excerpt TEXT NOT NULL DEFAULT '',
+                content TEXT NOT NULL,
+                content_html TEXT NOT NULL DEFAULT '',
+                renderer_version INTEGER NOT NULL DEFAULT 0,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        columns = [row['name'] for row in conn.execute('PRAGMA table_info(posts)')]
+        if 'excerpt' not in columns: # Database from before excerpts: add and fill the column once
+            conn.execute("ALTER TABLE posts ADD COLUMN excerpt TEXT NOT NULL DEFAULT ''")
+            conn.create_function('make_excerpt', 1, make_excerpt, deterministic=True)
+            conn.execute('UPDATE posts SET excerpt = make_excerpt(content)') # Until rerender_posts() gets to them
+        if 'content_html' not in columns: # Database from before Markdown: rendered later, by rerender_posts()
+            conn.execute("ALTER TABLE posts ADD COLUMN content_html TEXT NOT NULL DEFAULT ''")
+            conn.execute('ALTER TABLE posts ADD COLUMN renderer_version INTEGER NOT NULL DEFAULT 0')
+        # Newest-first listing walks this index and stops after one page, however big the table is.
+        # It also holds every listed column, so the homepage never reads the posts table itself
+        # (where a long post's content would have to be skipped to get to the excerpt).
+        conn.execute('DROP INDEX IF EXISTS posts_created_at') # Replaced by posts_listing
+        conn.execute('CREATE INDEX IF NOT EXISTS posts_listing ON posts (created_at DESC, id DESC, title, excerpt)')
+        # Finds the posts rendered by an older renderer without reading the whole table
+        conn.execute('CREATE INDEX IF NOT EXISTS posts_renderer_version ON posts (renderer_version)')
+        create_search_index(conn)
+        create_content_version(conn)
+        create_view_counts(conn)
+    print(f"[*] Database '{DATABASE_NAME}' initialized.")
+
+def create_content_version(conn):
+    # A number that changes whenever the posts change, however they were changed (this app,
+    # another process, the import command, ...). Cached pages are only valid for one version.
+    conn.execute('CREATE TABLE IF NOT EXISTS blog_meta (content_version INTEGER NOT NULL)')
+    if conn.execute('SELECT 1 FROM blog_meta').fetchone() is None:
+        conn.execute('INSERT INTO blog_meta (content_version) VALUES (1)')
+    for event in ('INSERT', 'DELETE', 'UPDATE OF title, content, created_at'):
+        name = 'posts_version_' + event.split()[0].lower()
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON posts BEGIN
+                UPDATE blog_meta SET content_version = content_version + 1;
+            END
+        ''')
+
+def create_view_counts(conn):
+    # Views live in a table of their own. The rows are tiny, so saving a batch of counts only
+    # rewrites a few pages, and it never touches the posts or their indexes and triggers.
     conn.execute('''
-        CREATE TABLE IF NOT EXISTS posts (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            title TEXT NOT NULL,
-            content TEXT NOT NULL,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        CREATE TABLE IF NOT EXISTS post_views (
+            post_id INTEGER PRIMARY KEY REFERENCES posts (id) ON DELETE CASCADE,
+            views INTEGER NOT NULL
         )
     ''')
-    conn.commit()
-    conn.close()
-    print(f"[*] Database '{DATABASE_NAME}' initialized.")
+    # "Most viewed" walks this index from the top and stops after one page
+    conn.execute('CREATE INDEX IF NOT EXISTS post_views_views ON post_views (views DESC, post_id DESC)')
+
+def content_version():
+    with connection() as conn:
+        return conn.execute('SELECT content_version FROM blog_meta').fetchone()[0]
+
+def create_search_index(conn):
+    # Full-text index of titles and contents. It is an FTS5 "external content" table: it holds
+    # only the inverted index and reads the text itself from `posts`, so nothing is stored twice.
+    # Triggers keep it in sync in the same transaction as every write to `posts`.
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'posts_fts'").fetchone()
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(
+            title, content, content='posts', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+        )
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS posts_fts_insert AFTER INSERT ON posts BEGIN
+            INSERT INTO posts_fts (rowid, title, content) VALUES (new.id, new.title, new.content);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS posts_fts_delete AFTER DELETE ON posts BEGIN
+            INSERT INTO posts_fts (posts_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+        END
+    ''')
+    # Only for changes to the indexed columns, other updates don't touch the index
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS posts_fts_update AFTER UPDATE OF title, content ON posts BEGIN
+            INSERT INTO posts_fts (posts_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+            INSERT INTO posts_fts (rowid, title, content) VALUES (new.id, new.title, new.content);
+        END
+    ''')
+    if not exists: # New index on a database that may already have posts
+        conn.execute("INSERT INTO posts_fts (posts_fts) VALUES ('rebuild')")
+
+def rebuild_search_index():
+    # Re-reads every post into the index, e.g. after posts were changed with the triggers missing
+    started = time.perf_counter()
+    with transaction() as conn:
+        conn.execute("INSERT INTO posts_fts (posts_fts) VALUES ('rebuild')")
+        conn.execute("INSERT INTO posts_fts (posts_fts) VALUES ('optimize')") # Merge into one b-tree for fast lookups
+        count = conn.execute('SELECT count(*) FROM posts').fetchone()[0]
+    print(f"[*] Search index rebuilt: {count} posts in {time.perf_counter() - started:.1f}s")
 
 def get_all_posts():
-    conn = get_db_connection()
-    posts = conn.execute('SELECT * FROM posts ORDER BY created_at DESC').fetchall()
-    conn.close()
-    return posts
+    with connection() as conn:
+        return conn.execute('SELECT * FROM posts ORDER BY created_at DESC').fetchall()
+
+def encode_cursor(post):
+    # A page boundary is the (created_at, id) of its first or last post. The id breaks ties
+    # between posts created in the same second.
+    return f"{post['created_at']}~{post['id']}"
+
+def decode_cursor(cursor):
+    # None for a missing or malformed cursor, which simply means the first page
+    created_at, _, post_id = (cursor or '').rpartition('~')
+    if not created_at or not post_id.isdigit():
+        return None
+    return created_at, int(post_id)
+
+def get_posts_page(before=None, after=None, limit=PAGE_SIZE):
+    # Keyset pagination, newest first. `before` is a decoded cursor: the page of posts older
+    # than it. `after`: the page of posts newer than it. Neither: the newest posts.
+    # Unlike OFFSET, which reads and throws away every row of the pages before it, each page
+    # is one index range scan of `limit` + 1 rows, so page 1000 costs the same as page 1.
+    # Returns (posts, older, newer) where older and newer are cursors for the neighbouring
+    # pages, or None when there are no posts in that direction.
+    with connection() as conn:
+        if after is not None:
+            rows = conn.execute(f'SELECT {LISTING_COLUMNS} FROM posts WHERE (created_at, id) > (?, ?) '
+                                'ORDER BY created_at, id LIMIT ?', (*after, limit + 1)).fetchall()
+        elif before is not None:
+            rows = conn.execute(f'SELECT {LISTING_COLUMNS} FROM posts WHERE (created_at, id) < (?, ?) '
+                                'ORDER BY created_at DESC, id DESC LIMIT ?', (*before, limit + 1)).fetchall()
+        else:
+            rows = conn.execute(f'SELECT {LISTING_COLUMNS} FROM posts ORDER BY created_at DESC, id DESC LIMIT ?',
+                                (limit + 1,)).fetchall()
+    if after is not None:
+        if len(rows) <= limit: # Reached the newest posts: show a full first page instead
+            return get_posts_page(limit=limit)
+        posts = rows[:limit][::-1] # Read oldest first, shown newest first
+        return posts, encode_cursor(posts[-1]), encode_cursor(posts[0])
+    posts = rows[:limit]
+    older = encode_cursor(posts[-1]) if len(rows) > limit else None # The extra row says whether there is more
+    newer = encode_cursor(posts[0]) if before is not None and posts else None
+    return posts, older, newer
+
+def search_query(text):
+    # Every word has to appear. Quoting turns FTS5 syntax typed into the search box into plain words.
+    return ' '.join('"' + word.replace('"', '""') + '"' for word in text.split())
+
+def search_posts(text, page=1, limit=SEARCH_PAGE_SIZE):
+    # Best matches first (bm25, with title matches weighted up). Returns (posts, has_more):
+    # each post has id, created_at, the title with its matches marked and a snippet of the
+    # content around them (see HIGHLIGHT_START).
+    # Walking the index newest first is cheap, scoring isn't: a word that is in every post would
+    # have bm25 score the whole blog. So only the newest RANK_WINDOW matches are ranked.
+    query = search_query(text)
+    if not query or page > MAX_SEARCH_PAGE:
+        return [], False
+    with connection() as conn:
+        row = conn.execute('SELECT rowid FROM posts_fts WHERE posts_fts MATCH ? ORDER BY rowid DESC LIMIT 1 OFFSET ?',
+                           (query, RANK_WINDOW - 1)).fetchone()
+        oldest = row[0] if row else 0
+        rows = conn.execute(
+            'SELECT posts.id, posts.created_at, '
+            '       highlight(posts_fts, 0, ?, ?) AS title, '
+            "       snippet(posts_fts, 1, ?, ?, '…', 32) AS snippet "
+            'FROM posts_fts JOIN posts ON posts.id = posts_fts.rowid '
+            'WHERE posts_fts MATCH ? AND posts_fts.rowid >= ? ORDER BY bm25(posts_fts, ?, 1.0) LIMIT ? OFFSET ?',
+            (HIGHLIGHT_START, HIGHLIGHT_END, HIGHLIGHT_START, HIGHLIGHT_END,
+             query, oldest, TITLE_WEIGHT, limit + 1, (page - 1) * limit)).fetchall()
+    return rows[:limit], len(rows) > limit
+
+def get_most_viewed(limit=POPULAR_SIZE):
+    # Listing columns and the view count of the most viewed posts, most viewed first
+    with connection() as conn:
+        return conn.execute('SELECT posts.id, posts.title, posts.excerpt, posts.created_at, post_views.views '
+                            'FROM post_views JOIN posts ON posts.id = post_views.post_id '
+                            'ORDER BY post_views.views DESC, post_views.post_id DESC LIMIT ?', (limit,)).fetchall()
 
 def get_post_by_id(post_id):
-    conn = get_db_connection()
-    post = conn.execute('SELECT * FROM posts WHERE id = ?', (post_id,)).fetchone()
-    conn.close()
-    return post
+    # The only place the full content is read: one post, by primary key
+    with connection() as conn:
+        return conn.execute('SELECT * FROM posts WHERE id = ?', (post_id,)).fetchone()
+
+def post_html(post):
+    # The HTML stored with the post, or, for a post the background re-render hasn't got to yet,
+    # rendered right now
+    if post['renderer_version'] < RENDERER_VERSION:
+        return render_markdown(post['content'])
+    return post['content_html']
 
 def create_post(title, content, created_at):
-    conn = get_db_connection()
-    conn.execute('INSERT INTO posts (title, content, created_at) VALUES (?, ?, ?)',
-                 (title, content, created_at))
-    conn.commit()
-    conn.close()
+    # The Markdown is rendered here, once, before the write lock is taken
+    content_html, excerpt = render_post(content)
+    with transaction() as conn:
+        conn.execute('INSERT INTO posts (title, excerpt, content, content_html, renderer_version, created_at) '
+                     'VALUES (?, ?, ?, ?, ?, ?)',
+                     (title, excerpt, content, content_html, RENDERER_VERSION, created_at))
 
 def update_post(post_id, title, content):
-    conn = get_db_connection()
-    conn.execute('UPDATE posts SET title = ?, content = ? WHERE id = ?',
-                 (title, content, post_id))
-    conn.commit()
-    conn.close()
+    content_html, excerpt = render_post(content)
+    with transaction() as conn:
+        conn.execute('UPDATE posts SET title = ?, excerpt = ?, content = ?, content_html = ?, renderer_version = ? '
+                     'WHERE id = ?', (title, excerpt, content, content_html, RENDERER_VERSION, post_id))
+
+def add_views(counts):
+    # {post_id: views since the last time} in one transaction. The counts are added to what is
+    # stored rather than written over it, so several processes can count the same post.
+    # A post deleted in the meantime is skipped.
+    with transaction() as conn:
+        conn.executemany('INSERT INTO post_views (post_id, views) '
+                         'SELECT ?, ? WHERE EXISTS (SELECT 1 FROM posts WHERE id = ?) '
+                         'ON CONFLICT (post_id) DO UPDATE SET views = views + excluded.views',
+                         ((post_id, views, post_id) for post_id, views in counts.items()))
 
 def delete_post(post_id):
-    conn = get_db_connection()
-    conn.execute('DELETE FROM posts WHERE id = ?', (post_id,))
-    conn.commit()
-    conn.close()
\ No newline at end of file
+    with transaction() as conn:
+        conn.execute('DELETE FROM posts WHERE id = ?', (post_id,))
+
+def rerender_posts(batch_size=RERENDER_BATCH, pause=RERENDER_PAUSE):
+    # Renders again every post whose HTML is missing (from before Markdown) or came from an
+    # older RENDERER_VERSION, and cuts its excerpt again. Posts are rendered outside of any
+    # transaction and written RERENDER_BATCH at a time, so the blog keeps serving and saving
+    # posts meanwhile.
+    started = time.perf_counter()
+    count = 0
+    while True:
+        with connection() as conn:
+            rows = conn.execute('SELECT id, content FROM posts WHERE renderer_version < ? LIMIT ?',
+                                (RENDERER_VERSION, batch_size)).fetchall()
+        if not rows:
+            break
+        rendered = [(*render_post(content), RENDERER_VERSION, post_id, RENDERER_VERSION) for post_id, content in rows]
+        with transaction() as conn:
+            # A post edited since it was read already has the HTML of its new content: leave it
+            conn.executemany('UPDATE posts SET content_html = ?, excerpt = ?, renderer_version = ? '
+                             'WHERE id = ? AND renderer_version < ?', rendered)
+            # Listings show the new excerpts, and post pages cached by a process with an older
+            # renderer its HTML
+            conn.execute('UPDATE blog_meta SET content_version = content_version + 1')
+        count += len(rows)
+        time.sleep(pause)
+    if count:
+        print(f"[*] Rendered {count} posts again in {time.perf_counter() - started:.1f}s")
+    return count
+
+def file_format(path, format=None):
+    # jsonl unless told otherwise or the file name ends in .csv
+    return format or ('csv' if path.lower().endswith('.csv') else 'jsonl')
+
+@contextlib.contextmanager
+def open_stream(path, mode):
+    # '-' means stdin or stdout, so exports can be piped straight into gzip, ssh, ...
+    if path == '-':
+        yield sys.stdin if mode == 'r' else sys.stdout
+    else:
+        with open(path, mode, encoding='utf-8', newline='') as f:
+            yield f
+
+def read_posts(f, format):
+    # Yields (title, content, created_at) one line at a time, never the whole file
+    if format == 'csv':
+        csv.field_size_limit(2 ** 31 - 1) # Post bodies can be far longer than the 128 KiB default
+        records = csv.DictReader(f)
+    else:
+        records = (json.loads(line) for line in f if line.strip())
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    for record in records:
+        yield record['title'], record['content'], record.get('created_at') or now
+
+def import_posts(path, format=None, batch_size=IMPORT_BATCH):
+    format = file_format(path, format)
+    with open_stream(path, 'r') as f:
+        return insert_posts(read_posts(f, format), batch_size)
+
+def insert_posts(posts, batch_size=IMPORT_BATCH):
+    # Adds the (title, content, created_at) of any iterable: a file being read, generated test
+    # data, ... One executemany and one commit per `batch_size` posts instead of a transaction
+    # per post. Each batch is rendered before its transaction starts.
+    posts = iter(posts)
+    started = time.perf_counter()
+    count = 0
+    while True:
+        batch = [(title, *render_post(content), RENDERER_VERSION, content, created_at)
+                 for title, content, created_at in itertools.islice(posts, batch_size)]
+        if not batch:
+            break
+        with transaction() as conn:
+            # The insert triggers would index the posts one at a time. Indexing the whole batch
+            # in one statement is about 2.5x faster. Nobody else can write during this
+            # transaction, and it puts the triggers back before committing, so no other
+            # connection ever sees them missing.
+            conn.execute('DROP TRIGGER posts_fts_insert')
+            conn.execute('DROP TRIGGER posts_version_insert')
+            last_id = conn.execute('SELECT coalesce(max(id), 0) FROM posts').fetchone()[0]
+            conn.executemany('INSERT INTO posts (title, content_html, excerpt, renderer_version, content, created_at) '
+                             'VALUES (?, ?, ?, ?, ?, ?)', batch)
+            conn.execute('INSERT INTO posts_fts (rowid, title, content) '
+                         'SELECT id, title, content FROM posts WHERE id > ?', (last_id,))
+            conn.execute('UPDATE blog_meta SET content_version = content_version + 1')
+            create_search_index(conn)
+            create_content_version(conn)
+        count += len(batch)
+        elapsed = time.perf_counter() - started
+        print(f"[*] Imported {count} posts ({count / elapsed:,.0f} rows/s)", file=sys.stderr)
+    return count
+
+def export_posts(path, format=None):
+    # Streams the rows from the cursor to the file: memory use doesn't grow with the blog.
+    # The SELECT reads one consistent snapshot even while the blog keeps being written to.
+    format = file_format(path, format)
+    started = time.perf_counter()
+    count = 0
+    with open_stream(path, 'w') as f, connection() as conn:
+        cursor = conn.execute(f'SELECT {", ".join(EXPORT_COLUMNS)} FROM posts ORDER BY id')
+        if format == 'csv':
+            writer = csv.writer(f)
+            writer.writerow(EXPORT_COLUMNS)
+            for row in cursor:
+                writer.writerow(row)
+                count += 1
+        else:
+            for row in cursor:
+                f.write(json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False) + '\n')
+                count += 1
+    elapsed = time.perf_counter() - started
+    print(f"[*] Exported {count} posts in {elapsed:.1f}s ({count / max(elapsed, 1e-9):,.0f} rows/s)", file=sys.stderr)
+    return count
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Maintenance commands for the blog database")
+    parser.add_argument('--database', default=DATABASE_NAME, help="SQLite database file")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('init', help="Create or upgrade the tables and indexes")
+    commands.add_parser('rebuild-search', help="Rebuild the full-text search index from the posts")
+    commands.add_parser('rerender', help="Render the posts whose HTML is missing or out of date")
+    for name, action in (('import', "Add the posts in FILE"), ('export', "Write every post to FILE")):
+        command = commands.add_parser(name, help=f"{action} (JSON lines or CSV, '-' for stdin/stdout)")
+        command.add_argument('file')
+        command.add_argument('--format', choices=('jsonl', 'csv'), help="Default: from the file name (.csv), else jsonl")
+    commands.choices['import'].add_argument('--batch-size', type=int, default=IMPORT_BATCH, help="Posts per transaction")
+    args = parser.parse_args()
+
+    use_database(args.database)
+    if args.command != 'export': # Export only reads, and its output may be stdout
+        init_db()
+    if args.command == 'rebuild-search':
+        rebuild_search_index()
+    elif args.command == 'rerender':
+        rerender_posts(pause=0)
+    elif args.command == 'import':
+        import_posts(args.file, args.format, args.batch_size)
+    elif args.command == 'export':
+        export_posts(args.file, args.format)
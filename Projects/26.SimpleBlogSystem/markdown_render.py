@@ -0,0 +1,180 @@
+# markdown_render.py
+# A small Markdown renderer for posts. Posts are rendered when they are saved and the HTML is
+# stored next to the source, so showing a post never parses Markdown.
+# Everything the author typed is escaped first: HTML in a post shows up as text, and links only
+# accept http(s), mailto and relative URLs. Supported: # headings, paragraphs (a single line
+# break is kept, like in the plain-text posts from before Markdown), **bold**, *italic*, `code`,
+# ``` code blocks, [links](url), > quotes, - and 1. lists, and --- rules.
+import html
+import re
+
+# Stored with every rendered post. Increase it whenever the HTML this module produces changes:
+# posts rendered by an older version are then rendered again in the background.
+RENDERER_VERSION = 3
+MAX_NESTING = 8 # Quotes inside quotes beyond this are shown as text
+
+# Anyone can post, so every pattern must stay linear on hostile input: none of them may scan
+# past the next marker or line break, or a post like "*a *a *a ..." makes each marker rescan
+# the rest of the paragraph (30 KB of that took seconds to render).
+HEADING = re.compile(r'(#{1,6})\s+(.*)')
+RULE = re.compile(r'(?:(?:-\s*){3,}|(?:\*\s*){3,}|(?:_\s*){3,})$')
+BULLET = re.compile(r'[-*+]\s+')
+NUMBERED = re.compile(r'(\d{1,9})[.)]\s+')
+CODE_SPAN = re.compile(r'`([^`\n]+)`')
+LINK = re.compile(r'\[([^\[\]\n]+)\]\(([^()\[\]\s]+)\)')
+# Each starts with its marker, which lets the regex engine skip ahead to it (a lookbehind for
+# the word boundaries of _ made them three times slower); see emphasis() for those
+STRONG = re.compile(r'(\*\*)(?=\S)((?:[^*\n]|\*(?!\*))+?)(?<=\S)\*\*|(__)(?=\S)((?:[^_\n]|_(?!_))+?)(?<=\S)__')
+EMPHASIS = re.compile(r'(\*)(?=\S)([^*\n]+?)(?<=\S)\*|(_)(?=\S)([^_\n]+?)(?<=\S)_')
+KEPT = re.compile(r'\x00(\d+)\x00')
+SCHEME = re.compile(r'[a-zA-Z][a-zA-Z0-9+.-]*:')
+CONTROL = re.compile(r'[\x00-\x20\x7f]') # Browsers drop these from URLs, which could unhide a scheme
+TAG = re.compile(r'<[^>]*>')
+BLOCK_STARTS = frozenset('#>-*+_`~0123456789') # A line starting with anything else is text
+
+def render_markdown(source):
+    # Markdown source -> HTML that is safe to put in a page as it is
+    lines = source.replace('\r\n', '\n').replace('\r', '\n').replace('\x00', '').split('\n')
+    return '\n'.join(render_blocks(lines))
+
+def plain_text(rendered):
+    # The text of HTML made by render_markdown(), e.g. for excerpts. Every < the author typed
+    # was escaped, so anything between < and > is one of our tags.
+    return html.unescape(TAG.sub('', rendered))
+
+def block_kind(text):
+    if not text:
+        return 'blank'
+    if text[0] not in BLOCK_STARTS: # Most lines: skip the patterns below
+        return 'text'
+    if text.startswith(('```', '~~~')):
+        return 'fence'
+    if HEADING.match(text):
+        return 'heading'
+    if RULE.match(text): # Before lists: "* * *" is a rule, not a list item
+        return 'rule'
+    if text.startswith('>'):
+        return 'quote'
+    if BULLET.match(text):
+        return 'bullet'
+    if NUMBERED.match(text):
+        return 'numbered'
+    return 'text'
+
+def render_blocks(lines, depth=0):
+    blocks = []
+    paragraph = []
+    i = 0
+    while i < len(lines):
+        text = lines[i].strip()
+        i += 1
+        kind = block_kind(text)
+        if kind == 'text' or (kind == 'quote' and depth >= MAX_NESTING):
+            paragraph.append(text)
+            continue
+        if paragraph: # A blank line or any other block ends the paragraph
+            blocks.append('<p>' + render_inline('\n'.join(paragraph)).replace('\n', '<br>\n') + '</p>')
+            paragraph = []
+        if kind == 'fence':
+            fence = text[:3]
+            code = []
+            while i < len(lines) and not lines[i].strip().startswith(fence):
+                code.append(lines[i]) # Not stripped: indentation matters in code
+                i += 1
+            i += 1 # The closing fence, if there is one
+            blocks.append(f'<pre><code>{html.escape(chr(10).join(code))}</code></pre>')
+        elif kind == 'heading':
+            hashes, title = HEADING.match(text).groups()
+            closing = title.rstrip('#') # "## Title ##", but not "# C#"
+            if closing != title and (not closing or closing[-1].isspace()):
+                title = closing.rstrip()
+            blocks.append(f'<h{len(hashes)}>{render_inline(title)}</h{len(hashes)}>')
+        elif kind == 'rule':
+            blocks.append('<hr>')
+        elif kind == 'quote':
+            quoted = [text[1:]]
+            while i < len(lines) and lines[i].strip().startswith('>'):
+                quoted.append(lines[i].strip()[1:])
+                i += 1
+            blocks.append('<blockquote>\n' + '\n'.join(render_blocks(quoted, depth + 1)) + '\n</blockquote>')
+        elif kind in ('bullet', 'numbered'):
+            marker = BULLET if kind == 'bullet' else NUMBERED
+            first = NUMBERED.match(text).group(1) if kind == 'numbered' else '1'
+            items = [[marker.sub('', text, count=1)]]
+            while i < len(lines):
+                text = lines[i].strip()
+                next_kind = block_kind(text)
+                if next_kind == kind:
+                    items.append([marker.sub('', text, count=1)])
+                elif next_kind == 'text': # The item goes on on the next line
+                    items[-1].append(text)
+                else:
+                    break
+                i += 1
+            tag = 'ul' if kind == 'bullet' else 'ol'
+            start = f' start="{int(first)}"' if int(first) != 1 else ''
+            body = ''.join('<li>' + render_inline('\n'.join(item)) + '</li>\n' for item in items)
+            blocks.append(f'<{tag}{start}>\n{body}</{tag}>')
+    if paragraph:
+        blocks.append('<p>' + render_inline('\n'.join(paragraph)).replace('\n', '<br>\n') + '</p>')
+    return blocks
+
+def safe_url(url):
+    # No javascript: or data: links. URLs without a scheme are relative and fine.
+    if CONTROL.search(html.unescape(url)):
+        return False
+    scheme = SCHEME.match(html.unescape(url))
+    return scheme is None or scheme.group(0).lower() in ('http:', 'https:', 'mailto:')
+
+def emphasis(tag):
+    def replace(match):
+        # _ and __ inside a word (snake_case_name) are not emphasis, * and ** can be
+        marker, inner = match.group(1, 2) if match.group(1) else match.group(3, 4)
+        text, start, end = match.string, match.start(), match.end()
+        if marker[0] == '_' and ((start > 0 and (text[start - 1].isalnum() or text[start - 1] == '_')) or
+                                 (end < len(text) and (text[end].isalnum() or text[end] == '_'))):
+            return match.group(0)
+        return f'<{tag}>{inner}</{tag}>'
+    return replace
+
+def render_inline(text):
+    # Escapes the text, then turns its Markdown into tags. Code spans and link targets are set
+    # aside first and put back at the end, so nothing inside them is taken for Markdown.
+    kept = []
+
+    def keep(fragment):
+        kept.append(fragment)
+        return f'\x00{len(kept) - 1}\x00'
+
+    def link(match):
+        label, url = match.groups() # Both already escaped, quotes included
+        if not safe_url(url):
+            return label # Just the text, without the link
+        return keep(f'<a href="{url}">') + label + keep('</a>')
+
+    def strong(match):
+        # Emphasis inside is rendered first and the whole element set aside, so a * left open
+        # inside can't pair with one after it (**a *b** c* made <strong>a <em>b</strong> c</em>)
+        rendered = emphasis('strong')(match)
+        if rendered == match.group(0): # __ inside a word, not emphasis
+            return rendered
+        if '*' in rendered or '_' in rendered:
+            rendered = EMPHASIS.sub(emphasis('em'), rendered)
+        return keep(rendered)
+
+    def restore(match):
+        return KEPT.sub(restore, kept[int(match.group(1))]) # A set-aside <strong> may hold code or a link
+
+    # Most text has no Markdown at all, so each pattern only runs if its marker is there
+    if '`' in text:
+        text = CODE_SPAN.sub(lambda match: keep(f'<code>{html.escape(match.group(1).strip())}</code>'), text)
+    text = html.escape(text)
+    if '](' in text:
+        text = LINK.sub(link, text)
+    if '**' in text or '__' in text:
+        text = STRONG.sub(strong, text)
+    if '*' in text or '_' in text:
+        text = EMPHASIS.sub(emphasis('em'), text)
+    if kept:
+        text = KEPT.sub(restore, text)
+    return text
@@ -0,0 +1,110 @@
+# page_cache.py
+import collections
+import hashlib
+import os
+import threading
+
+class Page:
+    __slots__ = ('etag', 'body')
+
+    def __init__(self, etag, body):
+        self.etag = etag # Strong ETag: a hash of the exact bytes
+        self.body = body
+
+def make_page(body):
+    data = body.encode('utf-8')
+    return Page(hashlib.sha256(data).hexdigest()[:32], data)
+
+class PageCache:
+    # Rendered pages, keyed by (content version, URL). Writes don't delete anything: they bump
+    # the version, and pages of older versions are never looked up again. The in-memory tier is
+    # an LRU of `max_entries` pages. The optional disk tier in `directory` keeps pages across
+    # restarts and is shared by every process serving the same blog. Each process writes at most
+    # `max_disk_pages` files per version; pages past that are only kept in memory.
+    def __init__(self, max_entries=256, directory=None, max_disk_pages=10000):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_disk_pages = max_disk_pages
+        self.pages = collections.OrderedDict() # Least recently used first
+        self.lock = threading.Lock()
+        self.disk_version = None # Version of the pages on disk, older ones are removed
+        self.disk_pages = 0 # Files this process wrote for disk_version
+        self.hits = 0
+        self.misses = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def get(self, version, url):
+        key = (version, url)
+        with self.lock:
+            page = self.pages.get(key)
+            if page is not None:
+                self.pages.move_to_end(key)
+                self.hits += 1
+                return page
+        page = self._read(version, url) if self.directory else None
+        with self.lock:
+            if page is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._remember(key, page)
+        return page
+
+    def put(self, version, url, body):
+        page = make_page(body)
+        with self.lock:
+            self._remember((version, url), page)
+        if self.directory:
+            self._write(version, url, page)
+        return page
+
+    def clear(self):
+        with self.lock:
+            self.pages.clear()
+
+    def _remember(self, key, page):
+        self.pages[key] = page
+        self.pages.move_to_end(key)
+        while len(self.pages) > self.max_entries:
+            self.pages.popitem(last=False)
+
+    def _path(self, version, url):
+        return os.path.join(self.directory, f"{version}-{hashlib.sha256(url.encode('utf-8')).hexdigest()[:32]}.html")
+
+    def _read(self, version, url):
+        # First line: the ETag, then the page
+        try:
+            with open(self._path(version, url), 'rb') as f:
+                etag = f.readline().rstrip(b'\n').decode('ascii')
+                return Page(etag, f.read())
+        except (OSError, UnicodeDecodeError):
+            return None
+
+    def _write(self, version, url, page):
+        if version != self.disk_version:
+            self._prune(version)
+        if self.disk_pages >= self.max_disk_pages:
+            return
+        self.disk_pages += 1
+        path = self._path(version, url)
+        temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temporary, 'wb') as f:
+                f.write(page.etag.encode('ascii') + b'\n' + page.body)
+            os.replace(temporary, path) # Readers see the old file or the new one, never half of it
+        except OSError as e:
+            print(f"[!] Could not write to the page cache: {e}")
+
+    def _prune(self, version):
+        # Once per new version: pages rendered for older ones can't be served any more
+        # (versions only grow; a newer one may already be in use by another process)
+        self.disk_version = version
+        self.disk_pages = 0
+        for name in os.listdir(self.directory):
+            page_version = name.partition('-')[0]
+            if name.endswith('.html') and page_version.isdigit() and int(page_version) < version:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass # Already removed by another process
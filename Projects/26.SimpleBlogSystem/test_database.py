@@ -0,0 +1,89 @@
+# test_database.py
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import database
+
+class TestPostsPage(unittest.TestCase):
+    # 25 posts, several of them created in the same second, so the id has to break ties
+    TIMES = ['2024-01-01 10:00:00'] * 3 + [f'2024-01-02 10:{minute:02d}:00' for minute in range(19)] + \
+            ['2024-01-03 10:00:00'] * 3
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.previous = database.DATABASE_NAME
+        database.use_database(os.path.join(self.directory, 'blog.db'))
+        database.init_db()
+        with contextlib.redirect_stderr(io.StringIO()): # Import progress
+            database.insert_posts((f'Post {i}', f'Content {i}', created_at) for i, created_at in enumerate(self.TIMES))
+        with database.connection() as conn:
+            self.newest_first = [row['id'] for row in
+                                 conn.execute('SELECT id FROM posts ORDER BY created_at DESC, id DESC')]
+
+    def tearDown(self):
+        database.use_database(self.previous)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def ids(self, posts):
+        return [post['id'] for post in posts]
+
+    def test_first_page(self):
+        posts, older, newer = database.get_posts_page(limit=10)
+        self.assertEqual(self.ids(posts), self.newest_first[:10])
+        self.assertIsNotNone(older)
+        self.assertIsNone(newer)
+
+    def test_walk_to_the_oldest_and_back(self):
+        # Following "older" visits every post exactly once, newest first; "newer" retraces the same pages
+        pages = []
+        cursor = None
+        while True:
+            posts, older, newer = database.get_posts_page(before=database.decode_cursor(cursor), limit=10)
+            pages.append((self.ids(posts), newer))
+            if older is None:
+                break
+            cursor = older
+        self.assertEqual([post_id for ids, _ in pages for post_id in ids], self.newest_first)
+        self.assertEqual([len(ids) for ids, _ in pages], [10, 10, 5])
+        for (ids, _), (_, newer) in zip(pages[:-1], pages[1:]):
+            posts, older, _ = database.get_posts_page(after=database.decode_cursor(newer), limit=10)
+            self.assertEqual(self.ids(posts), ids)
+            self.assertIsNotNone(older)
+
+    def test_ties_in_the_same_second(self):
+        # A page boundary in the middle of posts sharing created_at skips and repeats nothing
+        first, older, _ = database.get_posts_page(limit=2)
+        second, _, _ = database.get_posts_page(before=database.decode_cursor(older), limit=2)
+        self.assertEqual(self.ids(first) + self.ids(second), self.newest_first[:4])
+
+    def test_newer_than_the_first_page_gives_a_full_first_page(self):
+        cursor = database.decode_cursor(database.encode_cursor({'created_at': self.TIMES[-1], 'id': self.newest_first[2]}))
+        posts, _, newer = database.get_posts_page(after=cursor, limit=10)
+        self.assertEqual(self.ids(posts), self.newest_first[:10])
+        self.assertIsNone(newer)
+
+    def test_new_posts_dont_shift_older_pages(self):
+        # Unlike OFFSET, a cursor page stays the same when posts are added on top
+        _, older, _ = database.get_posts_page(limit=10)
+        before, _, _ = database.get_posts_page(before=database.decode_cursor(older), limit=10)
+        database.create_post('Newest', 'Content', '2024-02-01 00:00:00')
+        after, _, _ = database.get_posts_page(before=database.decode_cursor(older), limit=10)
+        self.assertEqual(self.ids(after), self.ids(before))
+
+    def test_malformed_cursors(self):
+        for cursor in (None, '', 'garbage', '2024-01-01 10:00:00~', '~5', '2024-01-01~abc'):
+            with self.subTest(cursor):
+                self.assertIsNone(database.decode_cursor(cursor))
+        self.assertEqual(database.decode_cursor('2024-01-01 10:00:00~12'), ('2024-01-01 10:00:00', 12))
+
+    def test_empty_blog(self):
+        with database.transaction() as conn:
+            conn.execute('DELETE FROM posts')
+        self.assertEqual(database.get_posts_page(), ([], None, None))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+# test_markdown_render.py
+import time
+import unittest
+
+import markdown_render
+
+class TestRenderTime(unittest.TestCase):
+    # Anyone can post, and posts are rendered in the request thread: hostile Markdown must not
+    # take more than linear time. Each of these took seconds before the patterns were bounded.
+    HOSTILE = {
+        'emphasis': '*a ' * 10000,
+        'underscores': '_a ' * 20000,
+        'strong': '**a ' * 10000,
+        'double underscores': '__a ' * 10000,
+        'brackets': '[' * 10000,
+        'unclosed links': '[a](' * 5000,
+        'heading spaces': '# a' + ' ' * 20000 + 'b',
+        'emphasis lines': '*a\n' * 10000,
+        'backticks': '`' * 10000 + 'a',
+    }
+
+    def test_hostile_input_renders_fast(self):
+        for name, source in self.HOSTILE.items():
+            with self.subTest(name):
+                started = time.perf_counter()
+                markdown_render.render_markdown(source)
+                self.assertLess(time.perf_counter() - started, 0.5)
+
+class TestLinks(unittest.TestCase):
+    def render(self, source):
+        return markdown_render.render_markdown(source)
+
+    def test_safe_schemes_are_links(self):
+        self.assertEqual(self.render('[home](/post/1)'), '<p><a href="/post/1">home</a></p>')
+        self.assertEqual(self.render('[x](https://example.com/?a=1&b=2)'),
+                         '<p><a href="https://example.com/?a=1&amp;b=2">x</a></p>')
+        self.assertEqual(self.render('[mail](mailto:me@example.com)'), '<p><a href="mailto:me@example.com">mail</a></p>')
+
+    def test_script_schemes_keep_only_the_label(self):
+        for url in ('javascript:alert%281%29', 'JaVaScRiPt:x', 'vbscript:x', 'data:text/html;base64,PHNjcmlwdD4='):
+            with self.subTest(url):
+                self.assertEqual(self.render(f'[click]({url})'), '<p>click</p>')
+
+    def test_entity_encoded_schemes(self):
+        # The & the author typed is escaped, so the browser reads "&#58;" as text, not as a
+        # colon: the URL has no scheme and stays a harmless relative link
+        for url in ('javascript&#58;x', 'javascript&colon;x', '&#106;avascript:x'):
+            with self.subTest(url):
+                rendered = self.render(f'[x]({url})')
+                self.assertIn('&amp;', rendered)
+                self.assertNotIn('javascript:', rendered.replace('&amp;', '&'))
+
+    def test_control_characters_in_scheme(self):
+        # Browsers drop these from URLs, which would turn java\x01script: into javascript:.
+        # Whitespace ends the URL, so those aren't links at all.
+        for character in ('\x01', '\x08', '\t', '\x0b', '\x1f', '\x7f'):
+            with self.subTest(repr(character)):
+                self.assertNotIn('<a', self.render(f'[x](java{character}script:x)'))
+                self.assertNotIn('<a', self.render(f'[x]({character}javascript:x)'))
+        self.assertEqual(self.render('[x](java\x01script:x)'), '<p>x</p>')
+
+    def test_quotes_cant_leave_href(self):
+        rendered = self.render('[x](http://example.com/"onmouseover="alert%281%29)')
+        self.assertEqual(rendered, '<p><a href="http://example.com/&quot;onmouseover=&quot;alert%281%29">x</a></p>')
+        self.assertIn('href="http://example.com/&#x27;x"', self.render("[x](http://example.com/'x)"))
+        self.assertEqual(self.render('[a"b](/)'), '<p><a href="/">a&quot;b</a></p>')
+
+class TestEscaping(unittest.TestCase):
+    def test_raw_html_is_text(self):
+        for source in ('<script>alert(1)</script>', '<img src=x onerror=alert(1)>', '<a href="javascript:x">x</a>'):
+            with self.subTest(source):
+                rendered = markdown_render.render_markdown(source)
+                self.assertNotIn('<script', rendered)
+                self.assertNotIn('<img', rendered)
+                self.assertNotIn('<a ', rendered)
+                self.assertIn('&lt;', rendered)
+
+    def test_html_in_code(self):
+        self.assertEqual(markdown_render.render_markdown('`<b>`'), '<p><code>&lt;b&gt;</code></p>')
+        self.assertEqual(markdown_render.render_markdown('```\n<script>\n```'),
+                         '<pre><code>&lt;script&gt;</code></pre>')
+
+    def test_markdown_inside_code_is_kept(self):
+        self.assertEqual(markdown_render.render_markdown('`[x](javascript:x) **b**`'),
+                         '<p><code>[x](javascript:x) **b**</code></p>')
+
+    def test_placeholder_bytes_typed_by_the_author(self):
+        # Code spans are set aside as \x00n\x00: a typed one must not pull in someone else's HTML
+        rendered = markdown_render.render_markdown('\x000\x00 `code`')
+        self.assertEqual(rendered.count('<code>'), 1)
+        self.assertNotIn('\x00', rendered)
+
+    def test_plain_text(self):
+        rendered = markdown_render.render_markdown('# Title\n\n**Bold** & <b>not bold</b>')
+        self.assertEqual(markdown_render.plain_text(rendered), 'Title\nBold & <b>not bold</b>')
+
+class TestNesting(unittest.TestCase):
+    def test_emphasis_nests_properly(self):
+        cases = {
+            '**a *b** c*': '<p><strong>a *b</strong> c*</p>', # The * left open inside stays text
+            '*a **b** c*': '<p><em>a <strong>b</strong> c</em></p>',
+            '**a *b* c**': '<p><strong>a <em>b</em> c</strong></p>',
+            '**a `*` [b](/x)** *c*': '<p><strong>a <code>*</code> <a href="/x">b</a></strong> <em>c</em></p>',
+            'snake__case__name': '<p>snake__case__name</p>',
+        }
+        for source, expected in cases.items():
+            with self.subTest(source):
+                self.assertEqual(markdown_render.render_markdown(source), expected)
+
+    def test_quotes_nest_up_to_the_limit(self):
+        depth = markdown_render.MAX_NESTING
+        rendered = markdown_render.render_markdown('>' * (depth + 5) + ' deep')
+        self.assertEqual(rendered.count('<blockquote>'), depth)
+        self.assertEqual(rendered.count('</blockquote>'), depth)
+        self.assertIn('&gt;' * 5 + ' deep', rendered) # The rest is shown as text
+
+    def test_deep_nesting_is_fast(self):
+        # Thousands of levels would overflow the stack without the limit
+        rendered = markdown_render.render_markdown('>' * 5000 + ' a')
+        self.assertEqual(rendered.count('<blockquote>'), markdown_render.MAX_NESTING)
+
+if __name__ == '__main__':
+    unittest.main()
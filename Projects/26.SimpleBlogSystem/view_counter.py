@@ -0,0 +1,49 @@
+# view_counter.py
+import collections
+import sqlite3
+import threading
+
+class ViewCounter:
+    # Counts page views in memory and hands them to `save` (database.add_views) every `interval`
+    # seconds, as one {post_id: views} dict. A view costs a dict update under a lock, where an
+    # UPDATE per view would make every page view queue up for SQLite's single writer.
+    def __init__(self, save, interval=5.0):
+        self.save = save
+        self.interval = interval
+        self.counts = collections.Counter() # Views since the last save
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def add(self, post_id):
+        with self.lock:
+            self.counts[post_id] += 1
+            if self.thread is None:
+                # Started by the first view rather than at import, so a server that forks its
+                # workers after importing the app gets a saving thread in every worker
+                self.thread = threading.Thread(target=self.save_loop)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def save_loop(self):
+        while not self.stopped.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            counts, self.counts = self.counts, collections.Counter()
+        if not counts:
+            return
+        try:
+            self.save(counts)
+        except sqlite3.Error as e:
+            print(f"[!] Could not save view counts, will try again: {e}")
+            with self.lock:
+                self.counts.update(counts) # Nothing is lost, they go with the next save
+
+    def close(self):
+        # Saves what is left, e.g. when the server shuts down
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+        self.flush()